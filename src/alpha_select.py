@@ -0,0 +1,143 @@
+"""
+alpha_select.py
+
+闭式的逐目标 (ROI) alpha 选择, 代替外层每折内嵌的 RidgeCV(cv=5) (后者对每个 alpha 重新拟合 5 次).
+
+一个训练集只做一次分解: 中心化训练设计矩阵 Xc = U diag(s) Vᵀ, 之后对任意 alpha
+    拟合值    : Ŷ(α) = U diag(d) Uᵀ Yc,  d = s² / (s² + α)
+    系数      : β(α) = V diag(s / (s² + α)) Uᵀ Yc
+验证误差有两种:
+    block : 训练行按时间切成 n_blocks 段连续块 (与不打乱的 KFold 划分相同, 保持时间连续性),
+            留出块 B 的预测残差有闭式解 e_B⁽⁻ᴮ⁾ = (I - H_BB)⁻¹ e_B, H_BB = U_B diag(d) U_Bᵀ.
+            (I - H_BB) 只与设计矩阵和 alpha 有关, 其 Cholesky 因子在被试之间复用.
+            (中心化使用全部训练行的均值, 与逐块重新中心化相差一个秩一修正, 这里忽略)
+    gcv   : GCV(α) = n ||e||² / (n - tr H)², 只需 Uᵀ Yc; 不考虑时间自相关, 通常偏向较小的 alpha.
+每个目标取验证误差最小的 alpha (per_target=False 时所有目标共用误差之和最小的 alpha).
+
+分解由中心化 Gram (LaggedDesign.gram) 的特征分解得到: XcᵀXc = V diag(s²) Vᵀ, U = Xc V diag(1/s) 用 matmul 求出,
+隐式 FIR 设计 (--implicit-fir) 不会被展开成 window 倍宽的稠密矩阵.
+"""
+from __future__ import annotations
+
+import argparse
+from typing import Iterable
+
+import numpy as np
+
+from src.config import DEFAULT_ALPHAS
+from src.lagged_design import GramRidge, LaggedDesign
+
+ALPHA_SELECT_METHODS = ("nested", "block", "gcv")
+DEFAULT_ALPHA_GRID = [float(10 ** (k / 2)) for k in range(0, 17)]  # 1 .. 1e8, 每半个数量级一个
+DEFAULT_N_BLOCKS = 5
+
+
+def add_alpha_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--alpha-select", choices=ALPHA_SELECT_METHODS, default="nested",
+                        help="alpha 选择: nested (默认, RidgeCV 内层 5 折; 单次划分时取第一个 alpha), "
+                             "block (连续块留出的闭式误差) 或 gcv; 后两者逐 ROI 选择, 结果另存 alphas_*.npy")
+    parser.add_argument("--alphas", nargs="+", type=float, default=None,
+                        help="alpha 候选 (默认 nested 为 config.DEFAULT_ALPHAS, 闭式选择为 1..1e8 的 17 个值)")
+
+
+def resolve_alphas(args: argparse.Namespace) -> list[float]:
+    if args.alphas:
+        return list(args.alphas)
+    return list(DEFAULT_ALPHAS) if args.alpha_select == "nested" else list(DEFAULT_ALPHA_GRID)
+
+
+class ClosedFormCV:
+    """
+    Parameters
+    ----------
+        design : 设计矩阵 (LaggedDesign; 稠密数组请先包成 LaggedDesign(X, [0]))
+        train : 训练行 (相对 design)
+        alphas : alpha 候选
+        method : "block" 或 "gcv"
+        n_blocks : block 方法的连续块数
+    """
+
+    def __init__(self, design: LaggedDesign, train: np.ndarray, alphas: Iterable[float],
+                 method: str = "block", n_blocks: int = DEFAULT_N_BLOCKS):
+        if method not in ("block", "gcv"):
+            raise ValueError(f"Unknown closed-form alpha selection method: {method}")
+        self.alphas = np.asarray(list(alphas), dtype=np.float64)
+        self.method = method
+        self.train = np.asarray(train)
+        n = self.train.shape[0]
+        G, col_sum = design.gram(self.train)
+        self.x_mean = col_sum / n
+        evals, evecs = np.linalg.eigh(G - n * np.outer(self.x_mean, self.x_mean))
+        evals, evecs = evals[::-1], evecs[:, ::-1]
+        # Gram 的特征值是 s² (条件数平方), 相对 1e-12 以下的方向数值上不可靠, 与零空间一起丢弃
+        keep = evals > evals[0] * 1e-12 if evals.size else evals.astype(bool)
+        self.s = np.sqrt(evals[keep])
+        self.Vt = evecs[:, keep].T
+        W = self.Vt.T / self.s
+        self.U = design.matmul(W, self.train) - self.x_mean @ W
+        # (n_alphas, rank): 各 alpha 下帽子矩阵在奇异向量上的收缩系数
+        self.shrink = self.s ** 2 / (self.s ** 2 + self.alphas[:, None])
+        self.blocks = np.array_split(np.arange(self.train.shape[0]), n_blocks) if method == "block" else []
+        self._factors: list[list[np.ndarray]] | None = None
+
+    def _block_factors(self) -> list[list[np.ndarray]]:
+        """每个 (alpha, 块) 的 chol(I - H_BB), 只与设计矩阵有关."""
+        if self._factors is None:
+            from scipy.linalg import cholesky
+
+            self._factors = []
+            for d in self.shrink:
+                factors = []
+                for block in self.blocks:
+                    Ub = self.U[block]
+                    M = np.eye(block.shape[0]) - (Ub * d) @ Ub.T
+                    factors.append(cholesky(M, lower=True))
+                self._factors.append(factors)
+        return self._factors
+
+    def cv_errors(self, y_train: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        返回 (errors, proj): errors shape (n_alphas, n_targets) 为各 alpha 的验证均方误差,
+        proj = Uᵀ Yc 供 fit 复用.
+        """
+        yc = y_train - y_train.mean(0)
+        proj = self.U.T @ yc
+        n = yc.shape[0]
+        errors = np.zeros((self.alphas.shape[0], yc.shape[1]))
+        if self.method == "gcv":
+            # ||Yc - U diag(d) proj||² = ||Yc||² - Σ (2d - d²) proj²
+            total = (yc ** 2).sum(0)
+            proj_sq = proj ** 2
+            for k, d in enumerate(self.shrink):
+                rss = total - ((2 * d - d ** 2)[:, None] * proj_sq).sum(0)
+                errors[k] = n * np.maximum(rss, 0.0) / (n - d.sum()) ** 2
+            return errors / n, proj
+
+        from scipy.linalg import cho_solve
+
+        for k, (d, factors) in enumerate(zip(self.shrink, self._block_factors())):
+            weighted = d[:, None] * proj
+            for block, L in zip(self.blocks, factors):
+                resid = yc[block] - self.U[block] @ weighted
+                errors[k] += (cho_solve((L, True), resid) ** 2).sum(0)
+        return errors / n, proj
+
+    def fit(self, y_train: np.ndarray, per_target: bool = True) -> GramRidge:
+        """选择 alpha 并用全部训练行求解; 返回模型的 alpha_ 为每个目标的 alpha, shape (n_targets,)."""
+        errors, proj = self.cv_errors(y_train)
+        if per_target:
+            best = np.argmin(errors, axis=0)
+        else:
+            best = np.full(errors.shape[1], int(np.argmin(errors.sum(1))))
+        alpha = self.alphas[best]
+        coef = self.Vt.T @ (proj * (self.s[:, None] / (self.s[:, None] ** 2 + alpha[None, :])))
+        intercept = y_train.mean(0) - self.x_mean @ coef
+        return GramRidge(coef_=coef, intercept_=intercept, alpha_=alpha)
+
+
+def alpha_summary(alpha_maps: np.ndarray) -> str:
+    """(n_subjects, n_targets) 的所选 alpha -> 一行分布摘要 (按被试几何平均后的各 ROI alpha 取整到最近的半个数量级)."""
+    roi_alpha = 10 ** np.log10(np.asarray(alpha_maps, dtype=np.float64)).mean(0)
+    values, counts = np.unique(np.round(np.log10(roi_alpha) * 2) / 2, return_counts=True)
+    parts = [f"1e{v:g}: {c / roi_alpha.size:.0%}" for v, c in zip(values, counts)]
+    return f"median={np.median(roi_alpha):.3g}, " + ", ".join(parts)
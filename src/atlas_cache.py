@@ -0,0 +1,190 @@
+"""
+atlas_cache.py
+
+MMP 图谱与 fsaverage 皮层表面的缓存. 第一次使用时用 nibabel 解析 GIFTI 文件,
+把表面坐标/面片/sulc/标签以及 ROI -> 顶点的 CSR 索引写成 .npy, 之后以 mmap 方式读取.
+缓存按源文件的 mtime/size 失效; 同一进程内所有作图与 ROI 统计共享同一个 bundle.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 1
+HEMIS = ("L", "R")
+
+_BUNDLES: dict[tuple[str, str], "AtlasBundle"] = {}
+
+
+def surf_path(atlas_root: Path, hemi: str, kind: str = "inflated") -> Path:
+    return atlas_root / "atlases" / "fsaverage" / f"tpl-fsaverage_den-41k_hemi-{hemi}_{kind}.surf.gii"
+
+
+def sulc_path(atlas_root: Path, hemi: str) -> Path:
+    return atlas_root / "atlases" / "fsaverage" / f"tpl-fsaverage_den-41k_hemi-{hemi}_desc-sulc_midthickness.shape.gii"
+
+
+def label_path(atlas_root: Path, hemi: str) -> Path:
+    return atlas_root / f"tpl-fsaverage6_hemi-{hemi}_desc-MMP_dseg.label.gii"
+
+
+@dataclass
+class AtlasBundle:
+    """
+    解析后的图谱数据 (数组均为只读 memmap).
+
+    labels[hemi] : 每个半球的 MMP 标签, 0 为 medial wall, 1..180 为 ROI
+    coords/faces/sulc[hemi] : inflated 表面与 sulc, 文件缺失时为 None
+    rois : 全脑标签 (L 在前, R 的非零标签加上 L 的最大标签, 与 extract_hemi_data_from_files 一致)
+    roi_ptr, roi_vertices : CSR 索引, ROI r 的全脑顶点为 roi_vertices[roi_ptr[r]:roi_ptr[r + 1]]
+    """
+
+    root: Path
+    fingerprint: str
+    labels: dict[str, np.ndarray]
+    coords: dict[str, np.ndarray | None]
+    faces: dict[str, np.ndarray | None]
+    sulc: dict[str, np.ndarray | None]
+    rois: np.ndarray
+    roi_ptr: np.ndarray
+    roi_vertices: np.ndarray
+
+    @property
+    def n_rois(self) -> int:
+        return int(self.roi_ptr.shape[0] - 2)
+
+    @property
+    def roi_ids(self) -> np.ndarray:
+        """有顶点的 ROI 编号 (不含 0)."""
+        counts = np.diff(self.roi_ptr)
+        return np.flatnonzero(counts[1:]) + 1
+
+    def vertices_of(self, roi: int) -> np.ndarray:
+        return self.roi_vertices[self.roi_ptr[roi]:self.roi_ptr[roi + 1]]
+
+    def has_surfaces(self) -> bool:
+        return all(self.coords[h] is not None and self.faces[h] is not None for h in HEMIS)
+
+
+def _sources(atlas_root: Path) -> dict[str, Path]:
+    sources = {}
+    for hemi in HEMIS:
+        sources[f"labels_{hemi}"] = label_path(atlas_root, hemi)
+        sources[f"surf_{hemi}"] = surf_path(atlas_root, hemi)
+        sources[f"sulc_{hemi}"] = sulc_path(atlas_root, hemi)
+    return sources
+
+
+def _manifest(sources: dict[str, Path]) -> dict:
+    files = {}
+    for name, path in sources.items():
+        if path.exists():
+            st = path.stat()
+            files[name] = {"path": path.as_posix(), "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+    return {"version": CACHE_VERSION, "files": files}
+
+
+def _save_array(cache_dir: Path, name: str, arr: np.ndarray) -> None:
+    tmp = cache_dir / f"{name}.tmp{os.getpid()}.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, cache_dir / f"{name}.npy")
+
+
+def build_roi_index(rois: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """全脑标签 -> CSR (roi_ptr, roi_vertices), 标签 0 (medial wall) 也占一个槽位."""
+    rois = np.asarray(rois).astype(np.int64)
+    counts = np.bincount(rois, minlength=int(rois.max()) + 1)
+    roi_ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    roi_vertices = np.argsort(rois, kind="stable").astype(np.int32)
+    return roi_ptr, roi_vertices
+
+
+def _build(atlas_root: Path, sources: dict[str, Path], manifest: dict, cache_dir: Path) -> None:
+    import nibabel as nib
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    files = manifest["files"]
+    labels = {}
+    for hemi in HEMIS:
+        name = f"labels_{hemi}"
+        if name not in files:
+            raise FileNotFoundError(f"Missing label GIFTI: {sources[name]}")
+        labels[hemi] = np.asarray(nib.load(sources[name]).agg_data()).astype(np.int32)
+        _save_array(cache_dir, name, labels[hemi])
+
+        if f"surf_{hemi}" in files:
+            gii = nib.load(sources[f"surf_{hemi}"])
+            _save_array(cache_dir, f"coords_{hemi}", np.asarray(gii.darrays[0].data, dtype=np.float32))
+            _save_array(cache_dir, f"faces_{hemi}", np.asarray(gii.darrays[1].data, dtype=np.int32))
+        if f"sulc_{hemi}" in files:
+            sulc = np.asarray(nib.load(sources[f"sulc_{hemi}"]).agg_data(), dtype=np.float32)
+            _save_array(cache_dir, f"sulc_{hemi}", sulc)
+
+    right = labels["R"].copy()
+    right[right != 0] += np.unique(labels["L"]).max()
+    rois = np.concatenate([labels["L"], right]).astype(np.int32)
+    roi_ptr, roi_vertices = build_roi_index(rois)
+    _save_array(cache_dir, "rois", rois)
+    _save_array(cache_dir, "roi_ptr", roi_ptr)
+    _save_array(cache_dir, "roi_vertices", roi_vertices)
+
+    # manifest 最后写入: 只有所有数组都写完, 缓存才会被视为有效
+    tmp = cache_dir / f"manifest.json.tmp{os.getpid()}"
+    tmp.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    os.replace(tmp, cache_dir / "manifest.json")
+
+
+def default_cache_dir(atlas_root: Path) -> Path:
+    return Path(atlas_root) / ".cache" / "atlas_bundle"
+
+
+def load_atlas_bundle(atlas_root: Path, cache_dir: Path | None = None) -> AtlasBundle:
+    """
+    读取 (必要时先构建) 图谱缓存. 每次调用只对源文件做 stat, 未变化时直接返回进程内的同一个 bundle.
+    """
+    atlas_root = Path(atlas_root)
+    cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir(atlas_root)
+    sources = _sources(atlas_root)
+    manifest = _manifest(sources)
+    fingerprint = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+    key = (cache_dir.resolve().as_posix(), fingerprint)
+    if key in _BUNDLES:
+        return _BUNDLES[key]
+
+    manifest_path = cache_dir / "manifest.json"
+    cached = None
+    if manifest_path.exists():
+        try:
+            cached = json.loads(manifest_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            cached = None
+    if cached != manifest:
+        print(f"[atlas] building cache: {cache_dir}", flush=True)
+        _build(atlas_root, sources, manifest, cache_dir)
+
+    def _load(name: str, source: str) -> np.ndarray | None:
+        # 源文件不存在 (或已被删除) 时不使用对应的缓存数组
+        if source not in manifest["files"]:
+            return None
+        return np.load(cache_dir / f"{name}.npy", mmap_mode="r")
+
+    bundle = AtlasBundle(
+        root=atlas_root,
+        fingerprint=fingerprint,
+        labels={h: np.load(cache_dir / f"labels_{h}.npy", mmap_mode="r") for h in HEMIS},
+        coords={h: _load(f"coords_{h}", f"surf_{h}") for h in HEMIS},
+        faces={h: _load(f"faces_{h}", f"surf_{h}") for h in HEMIS},
+        sulc={h: _load(f"sulc_{h}", f"sulc_{h}") for h in HEMIS},
+        rois=np.load(cache_dir / "rois.npy", mmap_mode="r"),
+        roi_ptr=np.load(cache_dir / "roi_ptr.npy", mmap_mode="r"),
+        roi_vertices=np.load(cache_dir / "roi_vertices.npy", mmap_mode="r"),
+    )
+    _BUNDLES[key] = bundle
+    return bundle
+
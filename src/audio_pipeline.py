@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import hashlib
 from pathlib import Path
-from typing import Iterable, Literal
+from typing import TYPE_CHECKING, Iterable, Literal
 
 import numpy as np
-import torch
-from transformers import PreTrainedModel
 
 from src.utils import extract_audio_features
 
+if TYPE_CHECKING:
+    import torch
+    from transformers import PreTrainedModel
+
+    from src.extract_checkpoint import ExtractionCheckpoint
+
 
 def chunk_audio(wav: np.ndarray, sr: int, n_trs: int, tr_seconds: float, tr_win: int) -> torch.Tensor:
+    import torch
+
     wav_tensor = torch.from_numpy(wav)
     tr_frames = int(sr * tr_seconds)
     audio_chunks = wav_tensor.flip(0).unfold(0, tr_frames * tr_win, tr_frames).flip([0, 1])
@@ -22,11 +29,89 @@ def chunk_audio(wav: np.ndarray, sr: int, n_trs: int, tr_seconds: float, tr_win:
     return audio_chunks
 
 
-def extract_audio_layers(audio_chunks: torch.Tensor, processor,
+class AudioChunks:
+    """
+    chunk_audio 的惰性版本, 内容与其逐元素相同, 但不生成 (n_chunks, tr_win * tr_frames) 的张量:
+    第 i 个 chunk 是原始波形上的零拷贝跨步视图 (sliding_window_view), 左侧补齐的 chunk 只是重复指向第一个完整 chunk 的下标.
+    extract_audio_features / extract_multimodal_layers 按 batch 取 chunk, 内存只随 batch 大小增长, 与 tr_win 无关
+    (chunk_audio 在 tr_win=6 时会物化约 1 GB). 视图只读, 下游若原地修改会直接报错而不会改坏波形.
+
+    Parameters
+    ----------
+        wav : 一维波形, float32 (其他类型会先转换一次)
+        sr : 采样率
+        n_trs : TR 数, 完整 chunk 不足时在左侧重复第一个 chunk 补齐
+        tr_seconds : TR 时长 (秒)
+        tr_win : 每个 chunk 覆盖的 TR 数
+    """
+
+    def __init__(self, wav: np.ndarray, sr: int, n_trs: int, tr_seconds: float, tr_win: int):
+        from numpy.lib.stride_tricks import sliding_window_view
+
+        self.wav = np.ascontiguousarray(wav, dtype=np.float32)
+        tr_frames = int(sr * tr_seconds)
+        chunk_len = tr_frames * tr_win
+        if self.wav.shape[0] < chunk_len:
+            raise ValueError(f"Audio shorter than one chunk: {self.wav.shape[0]} < {chunk_len} samples.")
+        num_chunks = (self.wav.shape[0] - chunk_len) // tr_frames + 1
+        # 与 chunk_audio 一致: 从末尾对齐, 开头不足一个 TR 的余数丢弃
+        self.start = (self.wav.shape[0] - chunk_len) % tr_frames
+        self.hop = tr_frames
+        self._views = sliding_window_view(self.wav[self.start:], chunk_len)[::tr_frames]
+        pad_count = max(n_trs - num_chunks, 0)
+        self._index = np.concatenate([np.zeros(pad_count, dtype=np.int64), np.arange(num_chunks, dtype=np.int64)])
+
+    def _with_index(self, index: np.ndarray) -> "AudioChunks":
+        out = AudioChunks.__new__(AudioChunks)
+        out.__dict__.update(self.__dict__)
+        out._index = index
+        return out
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return (len(self._index), int(self._views.shape[1]))
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.wav.dtype
+
+    @property
+    def nbytes(self) -> int:
+        """实际占用的内存: 只有波形缓冲本身 (追踪里的 mb 即为此值)."""
+        return int(self.wav.nbytes)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._with_index(self._index[item])
+        return self._views[self._index[item]]
+
+    def digest(self) -> str:
+        """内容摘要 (波形 + 起点/步长/窗长 + 补齐下标), 与逐个 chunk 的内容一一对应, 不需要物化 chunk."""
+        h = hashlib.sha1(f"{self.start}|{self.hop}|{self.shape[1]}".encode())
+        h.update(memoryview(self.wav).cast("B"))
+        h.update(self._index.tobytes())
+        return h.hexdigest()
+
+    def numpy(self) -> np.ndarray:
+        """物化为 (n_chunks, chunk_len) 数组 (与 chunk_audio(...).numpy() 相同), 仅用于小片段或对照."""
+        return self._views[self._index]
+
+
+def lazy_chunk_audio(wav: np.ndarray, sr: int, n_trs: int, tr_seconds: float, tr_win: int) -> AudioChunks:
+    """与 chunk_audio 参数相同, 返回惰性的 AudioChunks."""
+    return AudioChunks(wav, sr, n_trs, tr_seconds, tr_win)
+
+
+def extract_audio_layers(audio_chunks: torch.Tensor | AudioChunks, processor,
                          model: PreTrainedModel, layers: Iterable[int],
                          device: torch.device, batch_size: int,
                          autocast: bool, pooling: Literal["mean", "last"],
-                         sampling_rate: int) -> dict[int, np.ndarray]:
+                         sampling_rate: int,
+                         checkpoint: ExtractionCheckpoint | None = None,
+                         verbose: bool = True) -> dict[int, np.ndarray]:
     return extract_audio_features(
         audio_chunks=audio_chunks,
         processor=processor,
@@ -37,6 +122,8 @@ def extract_audio_layers(audio_chunks: torch.Tensor, processor,
         autocast=autocast,
         pooling=pooling,
         sampling_rate=sampling_rate,
+        checkpoint=checkpoint,
+        verbose=verbose,
     )
 
 
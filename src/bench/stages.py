@@ -0,0 +1,155 @@
+"""
+stages.py
+
+在合成数据上依次运行流水线各阶段并计时. 每个阶段的输出作为下一阶段的输入 (与 run_* 脚本的顺序一致);
+未选中的阶段只运行一次 (不计时) 以提供输入.
+"""
+from __future__ import annotations
+
+import statistics
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+from src.bench.synthetic import (
+    SyntheticScale,
+    make_align_df,
+    make_audio_model,
+    make_fmri,
+    make_text_model,
+    make_wav,
+)
+from src.config import AUDIO_SR, DEFAULT_ALPHAS, DEFAULT_FIR_OFFSET, DEFAULT_FIR_WINDOW, DEFAULT_KFOLD, TR_SECONDS
+
+CTX_WORDS = 200
+TEXT_BATCH = 64
+AUDIO_BATCH = 16
+
+
+@dataclass
+class StageResult:
+    times: list[float] = field(default_factory=list)
+    sizes: dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            # 第一次运行包含延迟 import 与各类缓存的构建, 单独记录
+            "first_s": self.times[0],
+            "min_s": min(self.times),
+            "median_s": statistics.median(self.times),
+            "runs": len(self.times),
+            "sizes": self.sizes,
+        }
+
+
+def _shape(x: Any) -> Any:
+    if isinstance(x, np.ndarray) or hasattr(x, "shape"):
+        return list(x.shape)
+    if isinstance(x, dict):
+        return {str(k): _shape(v) for k, v in list(x.items())[:1]}
+    if isinstance(x, (list, tuple)):
+        return [len(x)]
+    return None
+
+
+def _stages(scale: SyntheticScale, atlas_root: Path | None, work_dir: Path
+            ) -> list[tuple[str, Callable[[dict], Any]]]:
+    import torch
+
+    from src.audio_pipeline import chunk_audio, lazy_chunk_audio
+    from src.corr_kernel import batched_corr
+    from src.modeling import build_fir, run_cv_multi_subjects
+    from src.text_pipeline import align_word_features_to_tr, build_context_tokens, reduce_pca
+    from src.utils import corr_with_np, extract_audio_features, extract_text_features
+
+    device = torch.device("cpu")
+    layer = scale.n_layers
+    pca_dim = scale.hidden_size // 2  # 小于特征维度, 保证 PCA 真正执行
+
+    def corr(ctx: dict) -> np.ndarray:
+        fmri = ctx["fmris"][75]
+        rng = np.random.default_rng(0)
+        return corr_with_np(fmri + rng.standard_normal(fmri.shape).astype(np.float32), fmri)
+
+    def corr_batched(ctx: dict) -> np.ndarray:
+        # 全部被试堆叠为 (S, T, V), 一次 float32 计算
+        resp = np.stack([ctx["fmris"][sub] for sub in sorted(ctx["fmris"])])
+        rng = np.random.default_rng(0)
+        return batched_corr(resp + rng.standard_normal(resp.shape).astype(np.float32), resp)
+
+    def save_map(ctx: dict) -> Path | None:
+        if atlas_root is None:
+            return None
+        from src.corr_store import group_mean_map
+        from src.viz import save_corr_map
+
+        out = work_dir / "corr_map.png"
+        save_corr_map(group_mean_map(ctx["run_cv_multi_subjects"][1]), atlas_root, out)
+        return out
+
+    return [
+        ("build_context_tokens", lambda ctx: build_context_tokens(ctx["df"], ctx["tokenizer"], CTX_WORDS)),
+        ("extract_text_features", lambda ctx: extract_text_features(
+            ctx["build_context_tokens"], ctx["tokenizer"], ctx["text_model"], [layer], device,
+            batch_size=TEXT_BATCH, pooling="last")),
+        ("align_word_features_to_tr", lambda ctx: align_word_features_to_tr(
+            ctx["df"], ctx["extract_text_features"][layer], scale.n_trs)),
+        ("chunk_audio", lambda ctx: chunk_audio(ctx["wav"], AUDIO_SR, scale.n_trs, TR_SECONDS, tr_win=1)),
+        ("lazy_chunk_audio", lambda ctx: lazy_chunk_audio(ctx["wav"], AUDIO_SR, scale.n_trs, TR_SECONDS, tr_win=1)),
+        ("extract_audio_features", lambda ctx: extract_audio_features(
+            ctx["chunk_audio"], ctx["processor"], ctx["audio_model"], [layer], device,
+            batch_size=AUDIO_BATCH, pooling="mean", sampling_rate=AUDIO_SR)),
+        ("reduce_pca", lambda ctx: reduce_pca(ctx["align_word_features_to_tr"], pca_dim)),
+        ("build_fir", lambda ctx: build_fir(ctx["reduce_pca"], DEFAULT_FIR_WINDOW, DEFAULT_FIR_OFFSET)),
+        ("run_cv_multi_subjects", lambda ctx: run_cv_multi_subjects(
+            ctx["build_fir"], ctx["fmris"], sorted(ctx["fmris"]), 10, 10, DEFAULT_ALPHAS, DEFAULT_KFOLD)),
+        ("corr_with_np", corr),
+        ("batched_corr", corr_batched),
+        ("save_corr_map", save_map),
+    ]
+
+
+STAGE_NAMES = [
+    "build_context_tokens", "extract_text_features", "align_word_features_to_tr", "chunk_audio",
+    "lazy_chunk_audio", "extract_audio_features", "reduce_pca", "build_fir", "run_cv_multi_subjects", "corr_with_np", "batched_corr",
+    "save_corr_map",
+]
+
+
+def run_scale(scale: SyntheticScale, repeat: int, work_dir: Path, atlas_root: Path | None = None,
+              stages: list[str] | None = None, seed: int = 0) -> dict:
+    """
+    在一个规模上运行全部阶段, 选中的阶段 (默认全部) 重复 repeat 次计时.
+    atlas_root 为 None 时跳过 save_corr_map.
+    """
+    selected = set(stages or STAGE_NAMES)
+    tokenizer, text_model = make_text_model(scale, seed)
+    processor, audio_model = make_audio_model(scale, seed)
+    ctx: dict[str, Any] = {
+        "df": make_align_df(scale, seed),
+        "fmris": make_fmri(scale, seed),
+        "wav": make_wav(scale, seed=seed),
+        "tokenizer": tokenizer,
+        "text_model": text_model,
+        "processor": processor,
+        "audio_model": audio_model,
+    }
+    results: dict[str, dict] = {}
+    for name, fn in _stages(scale, atlas_root, work_dir):
+        if name == "save_corr_map" and atlas_root is None:
+            continue
+        n_runs = max(1, repeat) if name in selected else 1
+        result = StageResult()
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            ctx[name] = fn(ctx)
+            result.times.append(time.perf_counter() - start)
+        if name in selected:
+            result.sizes = {"output": _shape(ctx[name])}
+            results[name] = result.to_dict()
+            print(f"[bench] {scale.name} {name}: median={results[name]['median_s']:.4f}s "
+                  f"first={results[name]['first_s']:.4f}s", flush=True)
+    return results
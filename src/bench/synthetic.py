@@ -0,0 +1,177 @@
+"""
+synthetic.py
+
+离线生成与真实数据格式一致的合成输入, 用于在没有 21styear 数据的机器上计时:
+    fMRI dict {subject: (T, n_rois)}, 对齐 CSV (与 load_align_df 读取格式相同), 单声道 wav,
+    由 config 随机初始化的小型 HF 文本/音频模型 (不下载权重), 以及 ico6 球面图谱 (label/inflated/sulc GIFTI).
+所有内容由 seed 决定, 同一 seed 多次生成的数据完全相同.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.config import AUDIO_SR, TR_SECONDS
+
+
+@dataclass
+class SyntheticScale:
+    """一组数据规模. 真实数据约为 T=2249, 25 个被试, 360 个 ROI, 约 8000 个词."""
+
+    name: str
+    n_trs: int
+    n_subjects: int
+    n_rois: int = 360
+    words_per_tr: float = 3.5
+    hidden_size: int = 64
+    n_layers: int = 2
+
+
+SCALES = {
+    "small": SyntheticScale("small", n_trs=200, n_subjects=3),
+    "medium": SyntheticScale("medium", n_trs=800, n_subjects=8, hidden_size=128, n_layers=4),
+    "large": SyntheticScale("large", n_trs=2249, n_subjects=25, hidden_size=256, n_layers=6),
+}
+
+VOCAB_SIZE = 2000
+
+
+def make_words(n_words: int, seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    # 词频近似 Zipf 分布, 词表大小固定
+    ids = np.minimum(rng.zipf(1.3, size=n_words), VOCAB_SIZE) - 1
+    return [f"w{i}" for i in ids]
+
+
+def make_align_df(scale: SyntheticScale, seed: int = 0) -> pd.DataFrame:
+    """与 load_align_df 返回值相同的列: cased, uncased, start_ts, end_ts, tr."""
+    n_words = int(scale.n_trs * scale.words_per_tr)
+    rng = np.random.default_rng(seed)
+    # 开头留出几秒空白, 与真实录音一致 (首个 TR 之前没有词)
+    starts = np.sort(rng.uniform(3 * TR_SECONDS, (scale.n_trs - 1) * TR_SECONDS, size=n_words))
+    words = make_words(n_words, seed)
+    df = pd.DataFrame({
+        "cased": words,
+        "uncased": [w.lower() for w in words],
+        "start_ts": starts,
+        "end_ts": starts + 0.3,
+    })
+    df["tr"] = df.start_ts.apply(lambda x: int(np.ceil(x / TR_SECONDS)))
+    return df
+
+
+def write_align_csv(df: pd.DataFrame, path: Path) -> Path:
+    """写成 21styear_align.csv 的无表头格式, 可直接传给 load_align_df."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df[["cased", "uncased", "start_ts", "end_ts"]].to_csv(path, header=False, index=False)
+    return path
+
+
+def make_fmri(scale: SyntheticScale, seed: int = 0) -> dict[int, np.ndarray]:
+    """被试编号取 1..n_subjects 以及 75 (各 run_* 脚本用 fmris[75] 取 TR 数)."""
+    rng = np.random.default_rng(seed)
+    subjects = list(range(1, scale.n_subjects)) + [75]
+    shared = rng.standard_normal((scale.n_trs, scale.n_rois)).astype(np.float32)
+    return {sub: shared + rng.standard_normal((scale.n_trs, scale.n_rois)).astype(np.float32)
+            for sub in subjects}
+
+
+def make_wav(scale: SyntheticScale, sr: int = AUDIO_SR, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n = int(scale.n_trs * TR_SECONDS * sr)
+    t = np.arange(n, dtype=np.float32) / sr
+    tone = 0.1 * np.sin(2 * np.pi * 220.0 * t, dtype=np.float32)
+    return tone + 0.05 * rng.standard_normal(n).astype(np.float32)
+
+
+def make_text_model(scale: SyntheticScale, seed: int = 0):
+    """随机初始化的小型 GPT-2 与对应的词级 tokenizer (词表即 make_words 的词)."""
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    vocab = {"[UNK]": 0, "[EOS]": 1}
+    vocab.update({f"w{i}": i + 2 for i in range(VOCAB_SIZE)})
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="[UNK]",
+                                        eos_token="[EOS]", model_max_length=1024)
+
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(vocab), n_positions=1024, n_embd=scale.hidden_size,
+                        n_layer=scale.n_layers, n_head=4, eos_token_id=1, bos_token_id=1)
+    return tokenizer, GPT2LMHeadModel(config).eval()
+
+
+def make_audio_model(scale: SyntheticScale, seed: int = 0):
+    """随机初始化的小型 wav2vec2 与默认特征提取器."""
+    import torch
+    from transformers import Wav2Vec2Config, Wav2Vec2FeatureExtractor, Wav2Vec2Model
+
+    torch.manual_seed(seed)
+    config = Wav2Vec2Config(
+        hidden_size=scale.hidden_size, num_hidden_layers=scale.n_layers, num_attention_heads=4,
+        intermediate_size=2 * scale.hidden_size,
+        conv_dim=(32, 32, 32), conv_stride=(5, 4, 4), conv_kernel=(10, 4, 4),
+        num_conv_pos_embeddings=16, num_conv_pos_embedding_groups=4,
+    )
+    return Wav2Vec2FeatureExtractor(sampling_rate=AUDIO_SR), Wav2Vec2Model(config).eval()
+
+
+def icosphere(level: int) -> tuple[np.ndarray, np.ndarray]:
+    """单位二十面体细分 level 次, level=6 时 40962 个顶点 (与 fsaverage6 单半球相同)."""
+    t = (1 + 5 ** 0.5) / 2
+    verts = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+                      [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4],
+                      [11, 10, 2], [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8],
+                      [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+    verts /= np.linalg.norm(verts, axis=1, keepdims=True)
+    for _ in range(level):
+        edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+        uniq, inverse = np.unique(edges, axis=0, return_inverse=True)
+        mids = verts[uniq].mean(1)
+        mids /= np.linalg.norm(mids, axis=1, keepdims=True)
+        mid_idx = inverse.reshape(3, -1).T + verts.shape[0]  # 每个面三条边 (01, 12, 20) 的中点
+        verts = np.concatenate([verts, mids])
+        a, b, c = faces.T
+        ab, bc, ca = mid_idx.T
+        faces = np.concatenate([np.stack([a, ab, ca], 1), np.stack([b, bc, ab], 1),
+                                np.stack([c, ca, bc], 1), np.stack([ab, bc, ca], 1)])
+    return verts, faces
+
+
+def write_atlas(root: Path, level: int = 6, n_rois_per_hemi: int = 180, seed: int = 0) -> Path:
+    """
+    在 root 下写出合成图谱 (路径与 atlas_cache 中一致): 每个半球为一个球面,
+    ROI 为随机种子点的 Voronoi 区域, 内侧一小块标为 0 (medial wall), sulc 取 z 坐标.
+    """
+    import nibabel as nib
+    from nibabel.gifti import GiftiDataArray, GiftiImage
+
+    from src.atlas_cache import label_path, sulc_path, surf_path
+
+    root = Path(root)
+    (root / "atlases" / "fsaverage").mkdir(parents=True, exist_ok=True)
+    verts, faces = icosphere(level)
+    rng = np.random.default_rng(seed)
+    seeds = rng.standard_normal((n_rois_per_hemi, 3))
+    seeds /= np.linalg.norm(seeds, axis=1, keepdims=True)
+    labels = np.argmax(verts @ seeds.T, axis=1).astype(np.int32) + 1
+    for hemi, sign in (("L", -1.0), ("R", 1.0)):
+        hemi_labels = labels.copy()
+        hemi_labels[verts[:, 0] * sign < -0.8] = 0  # 内侧面作为 medial wall
+        coords = (verts * 50.0 + [sign * 60.0, 0.0, 0.0]).astype(np.float32)
+        surf = GiftiImage(darrays=[
+            GiftiDataArray(coords, intent="NIFTI_INTENT_POINTSET", datatype="NIFTI_TYPE_FLOAT32"),
+            GiftiDataArray(faces.astype(np.int32), intent="NIFTI_INTENT_TRIANGLE", datatype="NIFTI_TYPE_INT32"),
+        ])
+        nib.save(surf, surf_path(root, hemi))
+        nib.save(GiftiImage(darrays=[GiftiDataArray(hemi_labels, intent="NIFTI_INTENT_LABEL",
+                                                    datatype="NIFTI_TYPE_INT32")]), label_path(root, hemi))
+        nib.save(GiftiImage(darrays=[GiftiDataArray(verts[:, 2].astype(np.float32), intent="NIFTI_INTENT_SHAPE",
+                                                    datatype="NIFTI_TYPE_FLOAT32")]), sulc_path(root, hemi))
+    return root
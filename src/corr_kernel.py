@@ -0,0 +1,105 @@
+"""
+corr_kernel.py
+
+批量逐列 pearson corr. 输入为堆叠的预测/响应张量 (B, T, V) (B 为被试、折、窗口等任意批维度),
+一次调用得到 (B, V) 的 corr:
+    - 去均值写入预先分配的缓冲区 (同形状的重复调用不再分配 T x V 的临时数组);
+    - 协方差与两个平方和各由一次 einsum 规约得到, 没有逐元素乘积的临时数组, 也没有布尔索引拷贝;
+    - 计算精度默认 float32 (结果与 float64 相差约 1e-6), 也可用 float64 (corr_with_np 使用, 与旧实现一致);
+    - 常数列 (去均值后平方和为 0) 返回 nan, 与 corr_with_np 相同.
+响应可以是 (T, V), 此时在整个批次上共享 (如多个窗口/维度的预测对同一被试的 fMRI), 只去均值一次.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+class CorrEngine:
+    """
+    Parameters
+    ----------
+        dtype : 去均值与规约的计算精度, 输出 corr 也为该精度
+    """
+
+    def __init__(self, dtype: np.dtype | type = np.float32):
+        self.dtype = np.dtype(dtype)
+        self._buffers: dict[str, np.ndarray] = {}
+
+    def _buffer(self, name: str, shape: tuple[int, ...]) -> np.ndarray:
+        # 每个名字只保留最近一次的形状 (同形状的重复调用复用, 形状变化时重新分配)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self._buffers[name] = np.empty(shape, dtype=self.dtype)
+        return buf
+
+    def clear(self) -> None:
+        """释放缓存的缓冲区."""
+        self._buffers.clear()
+
+    def _center(self, name: str, x: np.ndarray) -> np.ndarray:
+        buf = self._buffer(name, x.shape)
+        np.subtract(x, x.mean(axis=-2, dtype=self.dtype, keepdims=True), out=buf, casting="same_kind")
+        return buf
+
+    def __call__(self, pred: np.ndarray, resp: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Parameters
+        ----------
+            pred : shape (B, T, V) 或 (T, V)
+            resp : shape 与 pred 相同, 或 (T, V) (在批维度上共享)
+            out : 可选的输出数组, shape (B, V) (pred 为二维时为 (V,))
+
+        Returns
+        -------
+            corrs : shape (B, V) 或 (V,), 常数列为 nan
+        """
+        pred, resp = np.asarray(pred), np.asarray(resp)
+        single = pred.ndim == 2
+        if single:
+            pred = pred[None]
+        if pred.ndim != 3:
+            raise ValueError(f"pred must be (B, T, V) or (T, V), got shape {pred.shape}.")
+        if single:
+            resp = resp[None]
+        shared = resp.ndim == 2 and resp.shape == pred.shape[1:]
+        if not shared and resp.shape != pred.shape:
+            raise ValueError("Shapes of a and b must be the same.")
+
+        a = self._center("pred", pred)
+        b = self._center("resp", resp)
+        if shared:
+            cov = np.einsum("btv,tv->bv", a, b)
+            ss_b = np.broadcast_to(np.einsum("tv,tv->v", b, b), cov.shape)
+        else:
+            cov = np.einsum("btv,btv->bv", a, b)
+            ss_b = np.einsum("btv,btv->bv", b, b)
+        ss_a = np.einsum("btv,btv->bv", a, a)
+
+        if out is None:
+            out = np.empty(cov.shape, dtype=self.dtype)
+        elif single:
+            out = out.reshape(cov.shape)
+        out.fill(np.nan)
+        valid = (ss_a != 0) & (ss_b != 0)
+        np.multiply(ss_a, ss_b, out=ss_a)
+        np.sqrt(ss_a, out=ss_a)
+        np.divide(cov, ss_a, out=out, where=valid, casting="same_kind")
+        return out[0] if single else out
+
+
+_ENGINES: dict[np.dtype, CorrEngine] = {}
+
+
+def get_engine(dtype: np.dtype | type = np.float32) -> CorrEngine:
+    """进程内按精度共享的 CorrEngine (缓冲区在同形状的重复调用间复用)."""
+    dtype = np.dtype(dtype)
+    engine = _ENGINES.get(dtype)
+    if engine is None:
+        engine = _ENGINES[dtype] = CorrEngine(dtype)
+    return engine
+
+
+def batched_corr(pred: np.ndarray, resp: np.ndarray, dtype: np.dtype | type = np.float32,
+                 out: np.ndarray | None = None) -> np.ndarray:
+    """get_engine(dtype)(pred, resp, out), 见 CorrEngine.__call__."""
+    return get_engine(dtype)(pred, resp, out=out)
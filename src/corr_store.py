@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+corr_store.py
+
+corr map 汇总存储. 所有结果的 corr map 追加写入同一个 float32 矩阵文件 (n_results, n_rois),
+index.csv 记录每一行对应的结果元数据 (kind/model/setting/layer/tag/source).
+读取端通过 np.memmap 一次切片即可取出任意子集, 不再需要遍历 results 目录逐个加载小文件.
+
+写入流程 (加文件锁): 先截断上次中断留下的未提交数据, 追加矩阵行并 fsync,
+最后在 index.csv 末尾一次写入新行并 fsync (不重写已有行). index 中完整出现的行才算提交,
+读取端忽略末尾未写完的半行, 因此总能看到一致的状态.
+
+store 中的 corr map 是群体平均; 逐被试的 (n_subjects, n_rois) 张量与可选的测试段预测
+保存在同目录的 corr_subjects_*.npy / pred_*.npz (见 save_encoding_result).
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import fcntl
+import io
+import json
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.config import RESULTS_ROOT
+from src.tracing import trace
+
+STORE_DIRNAME = "corr_store"
+INDEX_COLUMNS = ["row", "kind", "model", "setting", "layer", "tag", "source"]
+KEY_COLUMNS = ["kind", "model", "setting", "layer", "tag"]
+
+# 群体模式 / 闭式 alpha 选择的结果在 group-*/ alpha-*/ 子目录中, 以子目录名作为 tag 与常规结果区分
+_VARIANT = r"(?:(?P<variant>(?:group|alpha)-[^/]+)/)?"
+_CORR_LAYER = re.compile(r"(?:^|/)(?P<kind>text|audio|multimodal)/(?P<model>[^/]+)/(?P<setting>[^/]+)/"
+                         + _VARIANT + r"corr_layer(?P<layer>\d+)\.npy$")
+_CORR_FUSION = re.compile(r"(?:^|/)fusion/(?P<model>[^/]+)/"
+                          + _VARIANT + r"corr_(?P<tag>t(?P<layer>\d+)_a\d+_ctx\d+_tr\d+)\.npy$")
+RESULT_KINDS = ("text", "audio", "multimodal", "fusion")
+
+
+def relative_source(path: Path | str) -> str:
+    """
+    把结果文件路径统一成相对 results/ 的 posix 路径, 作为 store 中的 source 键
+    (兼容其他机器上的绝对路径, 如 /root/.../results/text/...).
+    """
+    p = Path(path).as_posix()
+    m = re.search(r"(?:^|/)results/(.+)$", p)
+    if m:
+        return m.group(1)
+    try:
+        return Path(path).resolve().relative_to(RESULTS_ROOT.resolve()).as_posix()
+    except ValueError:
+        return p
+
+
+def parse_result_path(path: Path | str) -> dict | None:
+    """
+    从结果路径解析元数据, 无法识别的路径返回 None.
+
+    e.g. text/gpt2/win200/corr_layer12.npy
+         -> kind=text, model=gpt2, setting=win200, layer=12, tag=""
+         text/gpt2/win200/alpha-block/corr_layer12.npy
+         -> kind=text, model=gpt2, setting=win200, layer=12, tag=alpha-block
+         fusion/gpt2__microsoft_wavlm-base-plus/corr_t6_a9_ctx200_tr3.npy
+         -> kind=fusion, model=gpt2__microsoft_wavlm-base-plus, setting=ctx200_tr3, layer=6, tag=t6_a9_ctx200_tr3
+    顶点级结果 (vertex/ 子目录) 的长度与 ROI 数不同, 不进入 store, 返回 None.
+    """
+    source = relative_source(path)
+    m = _CORR_LAYER.search(source)
+    if m:
+        return {"kind": m.group("kind"), "model": m.group("model"), "setting": m.group("setting"),
+                "layer": int(m.group("layer")), "tag": m.group("variant") or "", "source": source}
+    m = _CORR_FUSION.search(source)
+    if m:
+        tag = m.group("tag")
+        variant = m.group("variant")
+        return {"kind": "fusion", "model": m.group("model"), "setting": tag.split("_", 2)[2],
+                "layer": int(m.group("layer")), "tag": f"{variant}/{tag}" if variant else tag, "source": source}
+    return None
+
+
+class CorrStore:
+    """
+    内存映射的 corr map 矩阵 + 元数据索引.
+
+    目录结构:
+        meta.json  : {"n_rois": ..., "dtype": "float32"}
+        corr.f32   : 行优先的 float32 原始数据, shape (n_rows, n_rois)
+        index.csv  : 已提交行的元数据
+        .lock      : 写入锁
+    同一结果 (KEY_COLUMNS 相同) 重复写入时保留最后一次.
+    """
+
+    def __init__(self, root: Path | None = None):
+        self.root = Path(root) if root is not None else RESULTS_ROOT / STORE_DIRNAME
+        self.meta_path = self.root / "meta.json"
+        self.data_path = self.root / "corr.f32"
+        self.index_path = self.root / "index.csv"
+        self.lock_path = self.root / ".lock"
+
+    def exists(self) -> bool:
+        return self.index_path.exists() and self.meta_path.exists()
+
+    @property
+    def n_rois(self) -> int:
+        return int(json.loads(self.meta_path.read_text(encoding="utf-8"))["n_rois"])
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.lock_path.open("a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_index_raw(self) -> pd.DataFrame:
+        if not self.index_path.exists():
+            return pd.DataFrame(columns=INDEX_COLUMNS)
+        data = self.index_path.read_bytes()
+        # 只读取完整的行: 正在追加 (或中断) 的最后半行尚未提交
+        data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            return pd.DataFrame(columns=INDEX_COLUMNS)
+        return pd.read_csv(io.BytesIO(data), keep_default_na=False,
+                           dtype={"model": str, "setting": str, "tag": str, "source": str})
+
+    def _committed_rows(self) -> int:
+        """
+        已提交的行数. 只读取 index.csv 的末尾 (最后一个完整行的 row 列 + 1),
+        并截掉上次中断留下的半行; 需在写入锁内调用.
+        """
+        if not self.index_path.exists():
+            return 0
+        with self.index_path.open("rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            block = 1 << 16
+            while True:
+                start = max(size - block, 0)
+                f.seek(start)
+                tail = f.read()
+                if tail.count(b"\n") >= 2 or start == 0:
+                    break
+                block *= 2
+            end = tail.rfind(b"\n") + 1
+            if start + end < size:
+                f.truncate(start + end)
+        lines = tail[:end].splitlines()
+        if not lines or lines[-1].startswith(b"row,"):
+            return 0
+        return int(lines[-1].split(b",", 1)[0]) + 1
+
+    def index(self) -> pd.DataFrame:
+        """返回已提交结果的元数据 (每个结果只保留最新一行)."""
+        df = self._read_index_raw()
+        return df.drop_duplicates(KEY_COLUMNS, keep="last").reset_index(drop=True)
+
+    def matrix(self) -> np.ndarray:
+        """整个已提交矩阵的只读 memmap, shape (n_rows, n_rois)."""
+        n_rows = len(self._read_index_raw())
+        n_rois = self.n_rois
+        if n_rows == 0:
+            return np.empty((0, n_rois), dtype=np.float32)
+        return np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(n_rows, n_rois))
+
+    def append(self, corr_maps: np.ndarray | Iterable[np.ndarray], metas: list[dict]) -> None:
+        """
+        原子追加若干 corr map.
+
+        Parameters
+        ----------
+            corr_maps : shape (n, n_rois) 或等长一维数组序列
+            metas : 每行的元数据 dict (至少包含 kind/model/setting/layer, 可选 tag/source)
+        """
+        rows = np.asarray(list(corr_maps) if not isinstance(corr_maps, np.ndarray) else corr_maps,
+                          dtype=np.float32)
+        if rows.ndim == 1:
+            rows = rows[None, :]
+        if rows.shape[0] != len(metas):
+            raise ValueError("Number of corr maps and metadata rows must match.")
+        if rows.shape[0] == 0:
+            return
+
+        with self._locked():
+            if self.meta_path.exists():
+                n_rois = self.n_rois
+            else:
+                n_rois = int(rows.shape[1])
+                self.meta_path.write_text(json.dumps({"n_rois": n_rois, "dtype": "float32"}), encoding="utf-8")
+            if rows.shape[1] != n_rois:
+                raise ValueError(f"corr map length {rows.shape[1]} != store n_rois {n_rois}.")
+
+            n_rows = self._committed_rows()
+            with self.data_path.open("ab") as f:
+                # 丢弃上次中断写入后残留的未提交数据
+                f.truncate(n_rows * n_rois * 4)
+                f.write(np.ascontiguousarray(rows).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            new_rows = pd.DataFrame([
+                {
+                    "row": n_rows + i,
+                    "kind": meta["kind"],
+                    "model": meta["model"],
+                    "setting": meta["setting"],
+                    "layer": int(meta["layer"]),
+                    "tag": meta.get("tag", ""),
+                    "source": meta.get("source", ""),
+                }
+                for i, meta in enumerate(metas)
+            ], columns=INDEX_COLUMNS)
+            if not self.index_path.exists() or self.index_path.stat().st_size == 0:
+                # 第一次写入: 表头与新行一起原子落盘
+                tmp_path = self.index_path.with_suffix(f".csv.tmp{os.getpid()}")
+                new_rows.to_csv(tmp_path, index=False)
+                os.replace(tmp_path, self.index_path)
+                return
+            # 之后只在末尾追加新行 (一次 write + fsync), 不重写已有的 index
+            with self.index_path.open("ab") as f:
+                f.write(new_rows.to_csv(index=False, header=False).encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def select(self, **filters) -> tuple[pd.DataFrame, np.ndarray]:
+        """
+        按元数据筛选结果, 返回 (元数据, corr 矩阵). 矩阵通过一次 fancy index 从 memmap 读出.
+
+        e.g. store.select(kind="text", layer=[6, 9, 12])
+        """
+        df = self.index()
+        for col, value in filters.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                df = df[df[col].isin(list(value))]
+            else:
+                df = df[df[col] == value]
+        return self.take(df)
+
+    def take(self, df: pd.DataFrame) -> tuple[pd.DataFrame, np.ndarray]:
+        df = df.sort_values("row").reset_index(drop=True)
+        if df.empty:
+            return df, np.empty((0, self.n_rois), dtype=np.float32)
+        return df, np.asarray(self.matrix()[df["row"].to_numpy()])
+
+    def lookup_sources(self, paths: Iterable[Path | str]) -> dict[str, np.ndarray]:
+        """按结果文件路径查询 corr map, 返回 {相对 source: corr_map}, 不在 store 中的路径被忽略."""
+        wanted = {relative_source(p) for p in paths}
+        df = self.index()
+        df, mat = self.take(df[df["source"].isin(wanted)])
+        return {src: mat[i] for i, src in enumerate(df["source"])}
+
+
+def save_corr_result(out_path: Path, corr_map: np.ndarray, store: CorrStore | None = None) -> None:
+    """
+    保存单个 corr map 的 .npy, 同时追加到 corr store (路径无法解析时只保存 .npy).
+    .npy 先写临时文件再原子替换, 多机共享结果目录时读取端不会看到半写的文件.
+    """
+    out_path = Path(out_path)
+    with trace("save") as span:
+        span.array("corr_map", corr_map)
+        _save_npy_atomic(out_path, corr_map)
+        meta = parse_result_path(out_path)
+        if meta is None:
+            return
+        (store or CorrStore()).append(np.asarray(corr_map).reshape(1, -1), [meta])
+
+
+@dataclass
+class HeldOutPredictions:
+    """
+    测试段上的预测. rows 为测试行在原始 TR 序列中的下标 (已加上 excluded_start),
+    values shape (n_subjects, len(rows), n_targets), 群体模式下各被试共享预测时第一维为 1.
+    """
+
+    rows: np.ndarray
+    values: np.ndarray
+
+
+def subject_corr_path(corr_path: Path | str) -> Path:
+    """corr_layer12.npy -> corr_subjects_layer12.npy (融合结果: corr_t6_... -> corr_subjects_t6_...)."""
+    corr_path = Path(corr_path)
+    return corr_path.with_name(corr_path.name.replace("corr_", "corr_subjects_", 1))
+
+
+def prediction_path(corr_path: Path | str) -> Path:
+    """corr_layer12.npy -> pred_layer12.npz."""
+    corr_path = Path(corr_path)
+    return corr_path.with_name(corr_path.name.replace("corr_", "pred_", 1)).with_suffix(".npz")
+
+
+def alpha_path(corr_path: Path | str) -> Path:
+    """corr_layer12.npy -> alphas_layer12.npy (逐被试逐目标所选的 alpha)."""
+    corr_path = Path(corr_path)
+    return corr_path.with_name(corr_path.name.replace("corr_", "alphas_", 1))
+
+
+def group_mean_map(corr_maps: np.ndarray) -> np.ndarray:
+    """(n_subjects, n_targets) -> 群体平均 map, 忽略 nan (所有被试均为 nan 的列保持 nan)."""
+    corr_maps = np.asarray(corr_maps, dtype=np.float64)
+    finite = np.isfinite(corr_maps)
+    counts = finite.sum(0)
+    sums = np.where(finite, corr_maps, 0.0).sum(0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+
+
+def _save_npy_atomic(out_path: Path, arr: np.ndarray) -> None:
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f"{out_path.stem}.tmp{os.getpid()}.npy")
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, out_path)
+
+
+def save_encoding_result(out_path: Path, corr_maps: np.ndarray, store: CorrStore | None = None,
+                         predictions: HeldOutPredictions | None = None,
+                         alphas: np.ndarray | None = None) -> np.ndarray:
+    """
+    保存一次多被试拟合的全部结果:
+        corr_subjects_*.npy : (n_subjects, n_targets) float32, 行顺序与 config.SUBJECTS 相同
+        pred_*.npz          : (可选) 测试段预测, rows + float16 values
+        alphas_*.npy        : (可选) 闭式 alpha 选择时各被试各目标的 alpha, 形状同 corr_subjects
+        out_path            : 由张量得到的群体平均 map (同时追加到 corr store, 见 save_corr_result)
+    之后的逐被试/群体统计都只读这些文件, 不需要重新拟合. 返回群体平均 map.
+    """
+    out_path = Path(out_path)
+    corr_maps = np.asarray(corr_maps, dtype=np.float32)
+    with trace("save") as span:
+        span.array("corr_subjects", corr_maps)
+        _save_npy_atomic(subject_corr_path(out_path), corr_maps)
+        if predictions is not None:
+            span.array("predictions", predictions.values)
+            pred_path = prediction_path(out_path)
+            tmp_path = pred_path.with_name(f"{pred_path.stem}.tmp{os.getpid()}.npz")
+            np.savez(tmp_path, rows=np.asarray(predictions.rows, dtype=np.int32),
+                     values=np.asarray(predictions.values, dtype=np.float16))
+            os.replace(tmp_path, pred_path)
+        if alphas is not None:
+            _save_npy_atomic(alpha_path(out_path), np.asarray(alphas, dtype=np.float32))
+    group_map = group_mean_map(corr_maps)
+    save_corr_result(out_path, group_map, store=store)
+    return group_map
+
+
+def ingest_results(results_root: Path, store: CorrStore, batch: int = 512) -> int:
+    """
+    把已有 results 目录中的 corr*.npy 一次性导入 store (只需运行一次).
+    只扫描 text/ audio/ multimodal/ fusion/ 子目录: cache/ 与 search/ (有自己的 store) 不导入.
+    """
+    done = set(store.index()["source"]) if store.exists() else set()
+    maps, metas, n = [], [], 0
+    paths = (path for kind in RESULT_KINDS for path in sorted((results_root / kind).rglob("corr*.npy")))
+    for path in paths:
+        meta = parse_result_path(path)
+        if meta is None or meta["source"] in done:
+            continue
+        maps.append(np.load(path).reshape(-1))
+        metas.append(meta)
+        if len(metas) >= batch:
+            store.append(np.stack(maps), metas)
+            n += len(metas)
+            maps, metas = [], []
+    if metas:
+        store.append(np.stack(maps), metas)
+        n += len(metas)
+    return n
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Corr map store maintenance")
+    parser.add_argument("--store", type=str, default=None, help="store 目录 (默认 results/corr_store)")
+    parser.add_argument("--ingest", type=str, default=None,
+                        help="导入该目录下已有的 corr*.npy (如 results)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    store = CorrStore(Path(args.store) if args.store else None)
+    if args.ingest:
+        n = ingest_results(Path(args.ingest), store)
+        print(f"[corr_store] ingested {n} corr maps into {store.root}", flush=True)
+    if store.exists():
+        df = store.index()
+        print(f"[corr_store] {len(df)} results, n_rois={store.n_rois}", flush=True)
+        print(df.groupby("kind").size().to_string())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,7 +3,6 @@ from __future__ import annotations
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import librosa
 
 from src.config import DATA_ROOT, TR_SECONDS, AUDIO_SR
 
@@ -13,6 +12,23 @@ def load_fmri(path: Path | None = None) -> dict:
     return np.load(fmri_path, allow_pickle=True).item()
 
 
+def load_fmri_vertices(root: Path | None = None, subjects: list[int] | None = None) -> dict:
+    """
+    顶点级 fMRI: root/sub-<id>.npy, 每个文件 shape (T, n_vertices) (fsaverage6 L 在前, 与 MMP 标签顺序一致).
+    以 mmap 方式打开, 由分块编码按列块读取.
+    """
+    root = root or (DATA_ROOT / "vertices")
+    paths = sorted(root.glob("sub-*.npy"))
+    if not paths:
+        raise FileNotFoundError(f"Missing vertex-level fMRI files (sub-<id>.npy) in {root}")
+    fmris = {}
+    for path in paths:
+        sub = int(path.stem.split("-", 1)[1])
+        if subjects is None or sub in subjects:
+            fmris[sub] = np.load(path, mmap_mode="r")
+    return fmris
+
+
 def load_align_df(path: Path | None = None, tr_seconds: float = TR_SECONDS) -> pd.DataFrame:
     align_path = path or (DATA_ROOT / "21styear_align.csv")
     df = pd.read_csv(align_path, header=None, names=["cased", "uncased", "start_ts", "end_ts"])
@@ -24,6 +40,8 @@ def load_align_df(path: Path | None = None, tr_seconds: float = TR_SECONDS) -> p
 
 
 def load_audio(path: Path | None = None, sr: int = AUDIO_SR) -> tuple[np.ndarray, int]:
+    import librosa
+
     audio_path = path or (DATA_ROOT / "21styear_audio.wav")
     wav, sr = librosa.load(audio_path.as_posix(), sr=sr)
     return wav, sr
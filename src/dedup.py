@@ -0,0 +1,76 @@
+"""
+dedup.py
+
+特征提取前的输入去重. 不少前向输入完全相同:
+    chunk_audio / lazy_chunk_audio 左侧补齐的 chunk 都是第一个完整 chunk;
+    build_tr_text_windows 在没有词的 TR 给出空串或与前一个 TR 相同的窗口;
+    build_context_tokens 中分词为空的词沿用上一个词的上下文.
+各提取函数先按输入内容去重, 只对唯一输入前向, 再按下标把结果散回原顺序;
+每个输入的计算与不去重时相同 (只是 batch 的组成不同), 输出形状与顺序不变.
+
+    dedup = Dedup(tokens_key(t) for t in tokens)
+    feats = extract(...[tokens[i] for i in dedup.unique]...)   # {layer: (n_unique, D)}
+    feats = dedup.scatter(feats)                                # {layer: (n_items, D)}
+"""
+from __future__ import annotations
+
+import hashlib
+from typing import Hashable, Iterable
+
+import numpy as np
+
+
+def tokens_key(tokens: Iterable[str]) -> tuple[str, ...]:
+    """分词结果的 key (逐 token 比较, 与模型输入一一对应)."""
+    return tuple(tokens)
+
+
+def array_key(arr) -> bytes:
+    """数组内容 (dtype/shape/数据) 的 sha1 摘要; 接受 numpy 数组、只读视图或 CPU 张量."""
+    arr = np.ascontiguousarray(np.asarray(arr))
+    h = hashlib.sha1(f"{arr.dtype.str}|{arr.shape}".encode())
+    h.update(memoryview(arr).cast("B"))
+    return h.digest()
+
+
+class Dedup:
+    """
+    按 key 去重, 保留每个 key 第一次出现的位置.
+
+    unique : 唯一输入在原序列中的下标 (升序), shape (n_unique,)
+    inverse : 每个输入对应的唯一输入序号, shape (n_items,), 满足 items[i] == items[unique[inverse[i]]]
+    """
+
+    def __init__(self, keys: Iterable[Hashable]):
+        lookup: dict[Hashable, int] = {}
+        unique, inverse = [], []
+        for i, key in enumerate(keys):
+            pos = lookup.get(key)
+            if pos is None:
+                pos = lookup[key] = len(unique)
+                unique.append(i)
+            inverse.append(pos)
+        self.unique = np.asarray(unique, dtype=np.int64)
+        self.inverse = np.asarray(inverse, dtype=np.int64)
+
+    @property
+    def n_items(self) -> int:
+        return int(self.inverse.shape[0])
+
+    @property
+    def n_unique(self) -> int:
+        return int(self.unique.shape[0])
+
+    @property
+    def ratio(self) -> float:
+        """重复输入的比例 (省去的前向占比)."""
+        return 1.0 - self.n_unique / self.n_items if self.n_items else 0.0
+
+    def scatter(self, layer_features: dict[int, np.ndarray]) -> dict[int, np.ndarray]:
+        """{layer: (n_unique, D)} -> {layer: (n_items, D)}; 没有重复时原样返回."""
+        if self.n_unique == self.n_items:
+            return layer_features
+        return {layer: features[self.inverse] for layer, features in layer_features.items()}
+
+    def summary(self) -> str:
+        return f"{self.n_items} inputs -> {self.n_unique} unique ({self.ratio:.1%} duplicates skipped)"
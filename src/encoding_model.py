@@ -0,0 +1,174 @@
+"""
+encoding_model.py
+
+可保存/加载的编码模型: 拟合好的 TransformPipeline (标准化 -> PCA -> FIR) 加上每个被试的岭回归权重.
+run_* 脚本只保存 corr, 拟合的模型用完即丢; 这里在全部可用 TR 上拟合一次并落盘,
+serving / 实时预测直接加载, 对新刺激的特征给出预测响应:
+
+    model = fit_encoding_model(features, fmris, SUBJECTS, TransformParams(...), alphas)
+    model.save(out_dir)
+    model = EncodingModel.load(out_dir)
+    pred = model.predict(new_features)          # (n_subjects, T, n_targets)
+
+保存目录:
+    transform.npz : TransformPipeline.save
+    weights.npz   : coef (n_params, n_subjects, n_targets) float32, intercept / alphas (n_subjects, n_targets),
+                    subjects, meta (json: kind / model / layer / 窗口 / pooling 等, 由调用方给出)
+"""
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from src.lagged_design import LaggedDesign, fit_split, split_grams
+from src.modeling import build_fir
+from src.tracing import trace
+from src.transforms import DEFAULT_CACHE_DIR, TransformParams, TransformPipeline
+
+
+@dataclass
+class EncodingModel:
+    """
+    transform : 已拟合的 TransformPipeline
+    coef : shape (n_params, n_subjects, n_targets), n_params = fir_window * n_components
+    intercept : shape (n_subjects, n_targets)
+    subjects : 被试编号, 与 coef 第二维对应
+    alphas : 各被试各目标使用的 alpha, shape (n_subjects, n_targets)
+    meta : 特征来源的描述 (kind / model / layer / ctx_words / tr_win / pooling ...)
+    """
+
+    transform: TransformPipeline
+    coef: np.ndarray
+    intercept: np.ndarray
+    subjects: list[int]
+    alphas: np.ndarray
+    meta: dict = field(default_factory=dict)
+
+    @property
+    def n_targets(self) -> int:
+        return int(self.coef.shape[2])
+
+    @property
+    def n_components(self) -> int:
+        """降维后的特征维度 (每个 FIR 延迟的列数)."""
+        return int(self.coef.shape[0]) // self.fir_window
+
+    @property
+    def n_features(self) -> int:
+        """原始特征维度."""
+        if self.transform.mean_ is not None:
+            return int(self.transform.mean_.shape[0])
+        if self.transform.components_ is not None:
+            return int(self.transform.components_.shape[1])
+        return self.n_components
+
+    @property
+    def fir_window(self) -> int:
+        return self.transform.params.fir_window
+
+    @property
+    def fir_offset(self) -> int:
+        return self.transform.params.fir_offset
+
+    def subject_index(self, subjects: Iterable[int] | None = None) -> np.ndarray:
+        if subjects is None:
+            return np.arange(len(self.subjects))
+        lookup = {sub: i for i, sub in enumerate(self.subjects)}
+        missing = [sub for sub in subjects if sub not in lookup]
+        if missing:
+            raise KeyError(f"Subjects not in encoding model: {missing}")
+        return np.array([lookup[sub] for sub in subjects], dtype=np.int64)
+
+    def predict_design(self, X: np.ndarray, subjects: Iterable[int] | None = None) -> np.ndarray:
+        """FIR 设计矩阵 (T, n_params) -> (n_subjects, T, n_targets); 所有被试合并为一次矩阵乘."""
+        idx = self.subject_index(subjects)
+        coef = self.coef if subjects is None else self.coef[:, idx]
+        X = np.asarray(X, dtype=coef.dtype)
+        pred = (X @ coef.reshape(coef.shape[0], -1)).reshape(X.shape[0], len(idx), -1)
+        pred += self.intercept[idx].astype(coef.dtype)
+        return pred.transpose(1, 0, 2)
+
+    def predict_reduced(self, reduced: np.ndarray, subjects: Iterable[int] | None = None) -> np.ndarray:
+        """降维后的特征 (T, n_components) -> (n_subjects, T, n_targets); 刺激开始前的 FIR 延迟补零."""
+        X = build_fir(np.ascontiguousarray(reduced), window=self.fir_window, offset=self.fir_offset)
+        return self.predict_design(X, subjects)
+
+    def predict(self, features: np.ndarray, subjects: Iterable[int] | None = None) -> np.ndarray:
+        """TR 级原始特征 (T, D) -> (n_subjects, T, n_targets)."""
+        return self.predict_reduced(self.transform.reduce(features), subjects)
+
+    def save(self, out_dir: Path | str) -> Path:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.transform.save(out_dir / "transform.npz")
+        path = out_dir / "weights.npz"
+        tmp = path.with_name(f"{path.stem}.tmp{os.getpid()}.npz")
+        np.savez(tmp, coef=self.coef.astype(np.float32), intercept=self.intercept.astype(np.float32),
+                 subjects=np.asarray(self.subjects, dtype=np.int64), alphas=self.alphas.astype(np.float32),
+                 meta=np.array(json.dumps(self.meta)))
+        os.replace(tmp, path)
+        return out_dir
+
+    @classmethod
+    def load(cls, out_dir: Path | str) -> "EncodingModel":
+        out_dir = Path(out_dir)
+        transform = TransformPipeline.load(out_dir / "transform.npz")
+        with np.load(out_dir / "weights.npz") as data:
+            return cls(transform=transform, coef=data["coef"], intercept=data["intercept"],
+                       subjects=[int(s) for s in data["subjects"]], alphas=data["alphas"],
+                       meta=json.loads(str(data["meta"])))
+
+
+def fit_encoding_model(features: np.ndarray, fmris: dict, subjects: Iterable[int],
+                       params: TransformParams, alphas: Iterable[float], alpha_select: str = "nested",
+                       excluded_start: int = 10, excluded_end: int = 10,
+                       cache_dir: Path | None = DEFAULT_CACHE_DIR, meta: dict | None = None) -> EncodingModel:
+    """
+    在全部可用 TR (去掉首尾 excluded_start / excluded_end) 上拟合每个被试的岭回归.
+
+    Parameters
+    ----------
+        features : TR 级特征 (T, D), 与 run_* 脚本的输入相同
+        fmris : 被试 -> (T, n_targets)
+        subjects : 被试列表
+        params : 标准化 / PCA / FIR 参数
+        alphas : alpha 候选
+        alpha_select : nested (RidgeCV 内层 5 折, 所有目标共用一个 alpha) 或 block / gcv (逐目标闭式选择)
+        cache_dir : TransformPipeline 的磁盘缓存目录
+        meta : 随模型保存的描述信息
+    """
+    subjects = list(subjects)
+    alphas = list(alphas)
+    pipe = TransformPipeline(params, cache_dir=cache_dir)
+    reduced = pipe.fit_reduce(features)
+    design = LaggedDesign.from_fir(reduced, window=params.fir_window, offset=params.fir_offset)
+    design = design[excluded_start:-excluded_end]
+    train = np.arange(len(design))
+
+    if alpha_select == "nested":
+        grams = split_grams(design, train, 5 if len(alphas) > 1 else None)
+        eig_cache: dict = {}
+
+        def solve(y: np.ndarray):
+            return fit_split(design, y, grams, alphas, eig_cache=eig_cache)
+    else:
+        from src.alpha_select import ClosedFormCV
+
+        solve = ClosedFormCV(design, train, alphas, alpha_select).fit
+
+    coefs, intercepts, chosen = [], [], []
+    for sub in subjects:
+        with trace("fit", subject=sub, alpha_select=alpha_select) as span:
+            y = np.asarray(fmris[sub], dtype=np.float64)[excluded_start:-excluded_end]
+            span.array("y", y)
+            model = solve(y)
+        coefs.append(model.coef_.astype(np.float32))
+        intercepts.append(model.intercept_)
+        chosen.append(np.broadcast_to(model.alpha_, model.intercept_.shape))
+    return EncodingModel(transform=pipe, coef=np.stack(coefs, axis=1), intercept=np.stack(intercepts),
+                         subjects=subjects, alphas=np.stack(chosen), meta=dict(meta or {}))
@@ -0,0 +1,124 @@
+"""
+extract_checkpoint.py
+
+特征提取的断点续跑. 提取循环每 every 个 batch 把各层新增的特征写成一个分片 (.npy),
+再原子更新 progress.json 中已完成的 batch 数; 中断后用相同参数重跑时从该 batch 继续,
+最后按顺序拼接所有分片. 每个 batch 的计算与一次跑完完全相同, 因此输出逐元素一致.
+
+目录结构 (<dir>/):
+    progress.json           : key (模型/输入/batch_size 等), 已完成 batch 数, 分片列表
+    layer<L>_part<k>.npy    : 第 k 个分片
+key 或 batch 划分与已有进度不一致时丢弃旧分片, 从头开始.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+DEFAULT_CHECKPOINT_EVERY = 50
+
+
+def digest_strings(items: Iterable[Iterable[str]]) -> str:
+    """分词结果 (list[list[str]]) 的 sha1 摘要, 用作文本输入的 key."""
+    h = hashlib.sha1()
+    for item in items:
+        h.update("\x1f".join(item).encode())
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+
+def open_checkpoint(feature_dir: Path, key: dict, every: int) -> "ExtractionCheckpoint | None":
+    """各 run_* 脚本使用的断点目录: <feature_dir>/.checkpoint; every <= 0 时不启用."""
+    if every <= 0:
+        return None
+    return ExtractionCheckpoint(Path(feature_dir) / ".checkpoint", key, every)
+
+
+class ExtractionCheckpoint:
+    """
+    Parameters
+    ----------
+        root : 分片与进度文件目录
+        key : 描述本次提取的参数 (模型名、输入摘要等), 需可 JSON 序列化
+        every : 每多少个 batch 落盘一次
+    """
+
+    def __init__(self, root: Path, key: dict, every: int = DEFAULT_CHECKPOINT_EVERY):
+        self.root = Path(root)
+        self.key = key
+        self.every = max(int(every), 1)
+        self.start_batch = 0
+        self.n_batches = 0
+        self._shards: list[dict[str, str]] = []
+
+    @property
+    def progress_path(self) -> Path:
+        return self.root / "progress.json"
+
+    def begin(self, n_batches: int, batch_size: int) -> int:
+        """读取已有进度 (与当前 key/划分一致时), 返回应开始的 batch 序号."""
+        self.n_batches = int(n_batches)
+        key = {**self.key, "n_batches": self.n_batches, "batch_size": int(batch_size)}
+        self.key = key
+        progress = None
+        if self.progress_path.exists():
+            try:
+                progress = json.loads(self.progress_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                progress = None
+        if progress is not None and progress.get("key") == key and self._shards_exist(progress["shards"]):
+            self.start_batch = int(progress["done_batches"])
+            self._shards = progress["shards"]
+            print(f"[checkpoint] resume from batch {self.start_batch}/{self.n_batches}: {self.root}", flush=True)
+        else:
+            self.clear()
+            self.start_batch = 0
+            self._shards = []
+        return self.start_batch
+
+    def _shards_exist(self, shards: list[dict[str, str]]) -> bool:
+        return all((self.root / name).exists() for shard in shards for name in shard.values())
+
+    def step(self, batch_idx: int, hidden_states: dict[int, list[np.ndarray]]) -> None:
+        """batch_idx 处理完后调用; 到达落盘间隔或最后一个 batch 时写分片并清空 hidden_states."""
+        done = batch_idx + 1
+        if done % self.every and done != self.n_batches:
+            return
+        if not any(hidden_states.values()):
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        part = len(self._shards)
+        shard = {}
+        for layer, states in hidden_states.items():
+            name = f"layer{layer}_part{part:05d}.npy"
+            tmp = self.root / f"{name}.tmp{os.getpid()}.npy"
+            np.save(tmp, np.concatenate(states, axis=0))
+            os.replace(tmp, self.root / name)
+            shard[str(layer)] = name
+            states.clear()
+        self._shards.append(shard)
+        # 分片全部写完后再更新进度, 中断在两者之间时重跑只会重算这一段
+        progress = {"key": self.key, "done_batches": done, "shards": self._shards}
+        tmp = self.root / f"progress.json.tmp{os.getpid()}"
+        tmp.write_text(json.dumps(progress, indent=2), encoding="utf-8")
+        os.replace(tmp, self.progress_path)
+
+    def finalize(self, hidden_states: dict[int, list[np.ndarray]]) -> dict[int, np.ndarray]:
+        """落盘剩余部分并按顺序拼接全部分片, 返回 {layer: features}."""
+        if any(hidden_states.values()):
+            self.step(self.n_batches - 1, hidden_states)
+        parts: dict[int, list[np.ndarray]] = {}
+        for shard in self._shards:
+            for layer, name in shard.items():
+                parts.setdefault(int(layer), []).append(np.load(self.root / name))
+        return {layer: np.concatenate(arrays, axis=0) for layer, arrays in parts.items()}
+
+    def clear(self) -> None:
+        """删除分片与进度 (特征最终文件保存之后调用)."""
+        shutil.rmtree(self.root, ignore_errors=True)
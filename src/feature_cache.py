@@ -0,0 +1,109 @@
+"""
+feature_cache.py
+
+预处理结果 (如对齐到 TR 的单模态特征矩阵) 的进程内 LRU 缓存.
+
+内存中的数组总字节数不超过 max_bytes, 超出时按最近最少使用顺序淘汰;
+设置了 spill_dir 时, 被淘汰的数组先写成 .npy, 之后再次请求时以 mmap 方式读回, 不再重新计算.
+落盘文件名由 key 与源文件指纹 (路径/mtime/size) 共同决定, 源文件变化后旧文件自然失效.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Hashable
+
+import numpy as np
+
+
+def file_fingerprint(*paths: Path) -> str:
+    """源文件的 (路径, mtime, size) 指纹, 用于让磁盘缓存随源文件失效."""
+    parts = []
+    for path in paths:
+        st = Path(path).stat()
+        parts.append(f"{Path(path).as_posix()}:{st.st_mtime_ns}:{st.st_size}")
+    return "|".join(parts)
+
+
+class FeatureCache:
+    """
+    按 key 记忆化的数组缓存.
+
+    Parameters
+    ----------
+        max_bytes : 内存中数组的总字节上限
+        spill_dir : 淘汰数组的落盘目录, None 表示直接丢弃
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Path | None = None):
+        self.max_bytes = int(max_bytes)
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self._items: OrderedDict[Hashable, tuple[np.ndarray, str]] = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _spill_path(self, key: Hashable, fingerprint: str) -> Path:
+        digest = hashlib.sha1(f"{key!r}|{fingerprint}".encode()).hexdigest()[:20]
+        return self.spill_dir / f"{digest}.npy"
+
+    def _spill(self, key: Hashable, arr: np.ndarray, fingerprint: str) -> None:
+        if self.spill_dir is None:
+            return
+        path = self._spill_path(key, fingerprint)
+        if path.exists():
+            return
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.tmp{os.getpid()}.npy")
+        np.save(tmp, arr)
+        os.replace(tmp, path)
+
+    def _put(self, key: Hashable, arr: np.ndarray, fingerprint: str) -> None:
+        self._items[key] = (arr, fingerprint)
+        # memmap 读回的数组不占用常驻内存, 不计入预算
+        if not isinstance(arr, np.memmap):
+            self._nbytes += arr.nbytes
+        while self._nbytes > self.max_bytes and len(self._items) > 1:
+            old_key, (old_arr, old_fp) = self._items.popitem(last=False)
+            if not isinstance(old_arr, np.memmap):
+                self._nbytes -= old_arr.nbytes
+                self._spill(old_key, old_arr, old_fp)
+
+    def get(self, key: Hashable, compute: Callable[[], np.ndarray], fingerprint: str = "") -> np.ndarray:
+        """返回 key 对应的数组: 内存命中 -> 磁盘命中 -> 调用 compute() 计算."""
+        item = self._items.get(key)
+        if item is not None and item[1] == fingerprint:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+        if item is not None:
+            self.drop(key)
+
+        if self.spill_dir is not None:
+            path = self._spill_path(key, fingerprint)
+            if path.exists():
+                arr = np.load(path, mmap_mode="r")
+                self.disk_hits += 1
+                self._put(key, arr, fingerprint)
+                return arr
+
+        arr = np.asarray(compute())
+        self.misses += 1
+        self._put(key, arr, fingerprint)
+        return arr
+
+    def drop(self, key: Hashable) -> None:
+        item = self._items.pop(key, None)
+        if item is not None and not isinstance(item[0], np.memmap):
+            self._nbytes -= item[0].nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def stats(self) -> str:
+        return (f"hits={self.hits} disk_hits={self.disk_hits} misses={self.misses} "
+                f"entries={len(self._items)} mem={self._nbytes / 2**20:.1f}MB")
@@ -0,0 +1,108 @@
+"""
+fir_sweep.py
+
+FIR 窗口 / 偏移扫描. 窗口 w、偏移 o 的设计矩阵是延迟 o..o+w-1 的列子集,
+因此只需为最大延迟范围构建一次错位 Gram 块 (LaggedDesign), 每个 (w, o) 从中切出子块求解:
+- Gram 与被试无关, 每个划分只算一次; Xᵀy 每个被试只算一次
+- 单一 alpha 时, 同一偏移下窗口按延迟嵌套, 一次 Cholesky 分解 (各被试共用) 即可得到所有窗口的解
+- 多个 alpha (内层 K 折选择) 时, 各折的特征分解在被试间共用
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.lagged_design import (
+    CenteredSystem,
+    LaggedDesign,
+    cholesky_factor,
+    fit_split,
+    fold_average,
+    nested_solve,
+    outer_splits,
+    split_grams,
+)
+from src.modeling import summarize
+from src.corr_kernel import batched_corr
+
+
+def run_fir_sweep(features: np.ndarray, fmris: dict, subjects: Iterable[int],
+                  windows: Iterable[int], offsets: Iterable[int],
+                  excluded_start: int, excluded_end: int,
+                  alphas: Iterable[float], kfold: int) -> pd.DataFrame:
+    """
+    对所有 (window, offset) 组合评估编码模型, 结果与逐个用 build_fir + run_cv_multi_subjects 相同.
+
+    Parameters
+    ----------
+        features : 降维后的特征 (T, D) (即 TransformPipeline.fit_reduce 的输出)
+        windows, offsets : FIR 窗口与偏移列表
+
+    Returns
+    -------
+        table : 每行一个 (window, offset), 列为 window/offset/mean/std/min/max/median (跨被试)
+    """
+    windows = sorted(set(int(w) for w in windows))
+    offsets = sorted(set(int(o) for o in offsets))
+    alphas = list(alphas)
+    subjects = list(subjects)
+
+    full = LaggedDesign(features, range(offsets[0], offsets[-1] + windows[-1]))
+    full = full[excluded_start:-excluded_end]
+    D = full.n_features
+    n = len(full)
+    subs = {(w, o): full.select(lags=range(o, o + w)) for o in offsets for w in windows}
+    # 每个偏移下, 把延迟 o..o+max(w)-1 排在前面: 各窗口的设计矩阵正好是前 w * D 列
+    nested_cols = {o: full.column_index(full.select(lags=range(o, o + windows[-1]))) for o in offsets}
+
+    per_split: dict[tuple[int, int], list[list[np.ndarray]]] = {key: [[] for _ in subjects] for key in subs}
+    for train, test in outer_splits(n, kfold):
+        grams = split_grams(full, train, inner_folds=5 if kfold > 1 else None)
+        factors: dict[int, np.ndarray] = {}
+        eig_caches: dict[tuple[int, int], dict] = {key: {} for key in subs}
+        for si, sub in enumerate(subjects):
+            y = fmris[sub][excluded_start:-excluded_end]
+            y_train = y[train]
+            XtY = full.cross(y_train, train)
+            if kfold <= 1:
+                system = CenteredSystem.build(grams.G, grams.s, XtY, y_train.sum(0), train.shape[0])
+                for o in offsets:
+                    sub_system = system.sub(nested_cols[o])
+                    if o not in factors:
+                        factors[o] = cholesky_factor(sub_system.gram, alphas[0])
+                    models = nested_solve(sub_system, [w * D for w in windows], alphas[0], L=factors[o])
+                    # 同一被试各窗口的预测堆叠后一次算 corr (响应共享)
+                    preds = np.stack([model.predict(subs[(w, o)], test) for w, model in zip(windows, models)])
+                    for w, corr in zip(windows, batched_corr(preds, y[test])):
+                        per_split[(w, o)][si].append(corr)
+            else:
+                preds = np.stack([fit_split(full, y, grams, alphas, sub=design, XtY=XtY,
+                                            eig_cache=eig_caches[key]).predict(design, test)
+                                  for key, design in subs.items()])
+                for key, corr in zip(subs, batched_corr(preds, y[test])):
+                    per_split[key][si].append(corr)
+
+    rows = []
+    for (w, o), subject_corrs in per_split.items():
+        corr_means = []
+        for corrs in subject_corrs:
+            corr_means.append(float(np.mean(fold_average(corrs))))
+        stats = summarize(corr_means)
+        rows.append({"window": w, "offset": o, "mean": stats.mean, "std": stats.std,
+                     "min": stats.min, "max": stats.max, "median": stats.median})
+    return pd.DataFrame(rows).sort_values(["window", "offset"]).reset_index(drop=True)
+
+
+def format_sweep_table(table: pd.DataFrame) -> str:
+    """(window x offset) 的平均 corr 表."""
+    pivot = table.pivot(index="window", columns="offset", values="mean")
+    pivot.columns = [f"offset={c}" for c in pivot.columns]
+    return pivot.to_string(float_format=lambda v: f"{v:.4f}")
+
+
+def save_sweep_table(table: pd.DataFrame, out_path: Path) -> None:
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    table.to_csv(out_path, index=False)
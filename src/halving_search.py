@@ -0,0 +1,145 @@
+"""
+halving_search.py
+
+对已提取特征的 (kind, model, setting, layer) 候选做 successive halving:
+先在少量被试上评估全部候选, 按平均 corr 保留前 1/eta, 被试数乘以 eta 后继续,
+直到剩余候选在全部被试上完成评估. 每个候选已评估过的被试不会重算 (只补新增被试),
+总拟合次数约为 (候选数 + 被试数 * log_eta(候选数)) 量级, 而不是 候选数 * 被试数.
+
+候选来自各 run_* 脚本的输出目录 (results/<kind>/<model>/<setting>/):
+    text       : aligned_layer<L>.npy (run_text_models 总会保存)
+    audio      : aligned_layer<L>.npy, 否则 features/*_layer<L>_features.npy (已是 TR 级)
+    multimodal : 同 audio
+"""
+from __future__ import annotations
+
+import math
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.config import RESULTS_ROOT
+
+KINDS = ("text", "audio", "multimodal")
+
+_ALIGNED = re.compile(r"^aligned_layer(?P<layer>\d+)\.npy$")
+_FEATURES = re.compile(r"_layer(?P<layer>\d+)_features\.npy$")
+
+
+@dataclass
+class Candidate:
+    kind: str
+    model: str
+    setting: str
+    layer: int
+    path: Path
+    subjects: list[int] = field(default_factory=list)
+    corr_means: list[float] = field(default_factory=list)
+    corr_maps: list[np.ndarray] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}/{self.model}/{self.setting}/layer{self.layer}"
+
+    @property
+    def score(self) -> float:
+        return float(np.mean(self.corr_means)) if self.corr_means else float("-inf")
+
+
+def discover_candidates(results_root: Path = RESULTS_ROOT, kinds: Iterable[str] = KINDS,
+                        models: Iterable[str] | None = None, settings: Iterable[str] | None = None,
+                        layers: Iterable[int] | None = None) -> list[Candidate]:
+    """扫描 results/<kind>/<model>/<setting>/ 下的 TR 级特征; models/settings/layers 为 None 时不过滤."""
+    models = set(models) if models else None
+    settings = set(settings) if settings else None
+    layers = {int(layer) for layer in layers} if layers else None
+    candidates = []
+    for kind in kinds:
+        for setting_dir in sorted(Path(results_root).glob(f"{kind}/*/*")):
+            model, setting = setting_dir.parent.name, setting_dir.name
+            if not setting_dir.is_dir() or (models and model not in models) or (settings and setting not in settings):
+                continue
+            found: dict[int, Path] = {}
+            if kind != "text":
+                for path in sorted(setting_dir.glob("features/*_features.npy")):
+                    m = _FEATURES.search(path.name)
+                    if m:
+                        found[int(m.group("layer"))] = path
+            # 对齐后的特征优先 (文本只能用对齐后的)
+            for path in sorted(setting_dir.glob("aligned_layer*.npy")):
+                m = _ALIGNED.match(path.name)
+                if m:
+                    found[int(m.group("layer"))] = path
+            for layer, path in sorted(found.items()):
+                if layers is None or layer in layers:
+                    candidates.append(Candidate(kind, model, setting, layer, path))
+    return candidates
+
+
+def halving_schedule(n_candidates: int, n_subjects: int, min_subjects: int, eta: int) -> list[tuple[int, int]]:
+    """每轮的 (参与候选数, 被试数); 最后一轮被试数为 n_subjects."""
+    rounds = []
+    alive, n = n_candidates, min(max(min_subjects, 1), n_subjects)
+    while True:
+        rounds.append((alive, n))
+        if n >= n_subjects:
+            return rounds
+        alive = max(1, math.ceil(alive / eta))
+        n = min(n_subjects, n * eta)
+
+
+def successive_halving(candidates: list[Candidate], subjects: list[int],
+                       evaluate: Callable[[Candidate, list[int]], tuple[list[float], np.ndarray]],
+                       min_subjects: int = 3, eta: int = 2,
+                       on_round: Callable[[int, list[dict]], None] | None = None) -> tuple[list[Candidate], pd.DataFrame]:
+    """
+    Parameters
+    ----------
+        candidates : 候选列表
+        subjects : 被试顺序 (每轮取前 n 个)
+        evaluate : (候选, 新增被试) -> (各被试 corr 均值, (n_new, n_targets) corr maps)
+        min_subjects : 第一轮的被试数
+        eta : 每轮保留前 1/eta 的候选, 被试数乘以 eta
+        on_round : 每轮结束时以 (轮次, 本轮日志行) 回调 (用于即时写日志)
+
+    Returns
+    -------
+        survivors : 在全部被试上完成评估的候选, 按平均 corr 降序
+        log : 每轮每个候选一行: round/n_subjects/key/.../mean/rank/status (kept/pruned/final)
+    """
+    rows = []
+    alive = list(candidates)
+    schedule = halving_schedule(len(alive), len(subjects), min_subjects, eta)
+    for rnd, (_, n) in enumerate(schedule):
+        for cand in alive:
+            new = subjects[len(cand.subjects):n]
+            if new:
+                corr_means, corr_maps = evaluate(cand, new)
+                cand.subjects.extend(new)
+                cand.corr_means.extend(corr_means)
+                cand.corr_maps.extend(np.asarray(corr_maps, dtype=np.float32))
+        alive.sort(key=lambda c: c.score, reverse=True)
+        final = rnd == len(schedule) - 1
+        n_keep = len(alive) if final else schedule[rnd + 1][0]
+        round_rows = []
+        for rank, cand in enumerate(alive):
+            status = "final" if final else ("kept" if rank < n_keep else "pruned")
+            round_rows.append({
+                "round": rnd, "n_subjects": n, "key": cand.key, "kind": cand.kind, "model": cand.model,
+                "setting": cand.setting, "layer": cand.layer, "mean": cand.score,
+                "std": float(np.std(cand.corr_means)), "rank": rank + 1, "status": status,
+            })
+        rows.extend(round_rows)
+        if on_round is not None:
+            on_round(rnd, round_rows)
+        alive = alive[:n_keep]
+    return alive, pd.DataFrame(rows)
+
+
+def n_fits(log: pd.DataFrame) -> int:
+    """实际的 (候选, 被试) 拟合次数: 每个候选最后一次出现时的被试数."""
+    return int(log.groupby("key")["n_subjects"].max().sum()) if len(log) else 0
@@ -0,0 +1,376 @@
+"""
+lagged_design.py
+
+FIR 设计矩阵的隐式表示与基于 Gram 矩阵的岭回归.
+
+build_fir 得到的 (T, window * D) 矩阵第 t 行第 j 块就是 base[t - offset - j] (越界补 0),
+因此 XᵀX 的每个 (i, j) 块都是 base 的一段错位自协方差, Xᵀy 与预测也只需对错位后的 base 做乘法.
+LaggedDesign 只保存 base (T, D) 与延迟列表, 不会生成 window 倍大小的副本;
+fit_encoding_single / fit_encoding_cv 收到 LaggedDesign 时改用这里的 Gram 求解器.
+
+同一延迟差的块沿对角线只差首尾若干行, 计算时每条对角线只做一次完整乘法, 其余块用行增减更新.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+
+
+class LaggedDesign:
+    """
+    隐式 FIR 设计矩阵.
+
+    Parameters
+    ----------
+        base : 原始特征, shape (T, D)
+        lags : 升序延迟列表, 第 j 块对应 base[t - lags[j]]; build_fir(window, offset) 即 range(offset, offset + window)
+        n_features : 只使用 base 的前 n_features 列 (默认全部)
+        start, stop : 行范围 (相对 base), 用于切片时不复制数据
+    """
+
+    def __init__(self, base: np.ndarray, lags: Iterable[int], n_features: int | None = None,
+                 start: int = 0, stop: int | None = None, _padded: np.ndarray | None = None):
+        base = np.asarray(base)
+        if base.ndim != 2:
+            raise ValueError("features should be a 2D array with shape (T, D).")
+        self.base = base
+        self.lags = [int(v) for v in lags]
+        if not self.lags or self.lags != sorted(set(self.lags)) or self.lags[0] < 0:
+            raise ValueError(f"lags must be non-empty, ascending, unique and >= 0: {self.lags}")
+        self.n_features = int(n_features) if n_features is not None else base.shape[1]
+        self.start = int(start)
+        self.stop = int(stop) if stop is not None else base.shape[0]
+        # 顶部补 max(lags) 行 0, 使所有延迟行索引非负 (与 build_fir 的零填充一致)
+        if _padded is None or _padded.shape[0] - base.shape[0] < self.lags[-1]:
+            _padded = np.concatenate([np.zeros((self.lags[-1], base.shape[1]), dtype=base.dtype), base])
+        self._padded = _padded
+        self._pad = _padded.shape[0] - base.shape[0]
+
+    @classmethod
+    def from_fir(cls, features: np.ndarray, window: int, offset: int) -> "LaggedDesign":
+        return cls(features, range(offset, offset + window))
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.stop - self.start, len(self.lags) * self.n_features
+
+    @property
+    def ndim(self) -> int:
+        return 2
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> "LaggedDesign":
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("LaggedDesign only supports contiguous row slices.")
+        start, stop, _ = key.indices(len(self))
+        return LaggedDesign(self.base, self.lags, self.n_features, self.start + start,
+                            self.start + max(start, stop), _padded=self._padded)
+
+    def select(self, lags: Iterable[int] | None = None, n_features: int | None = None) -> "LaggedDesign":
+        """取延迟子集 / 前 n_features 列, 对应设计矩阵的列子集 (共享 base)."""
+        lags = self.lags if lags is None else list(lags)
+        n_features = self.n_features if n_features is None else n_features
+        if n_features > self.base.shape[1]:
+            raise ValueError(f"n_features={n_features} exceeds base width {self.base.shape[1]}.")
+        return LaggedDesign(self.base, lags, n_features, self.start, self.stop, _padded=self._padded)
+
+    def column_index(self, sub: "LaggedDesign") -> np.ndarray:
+        """sub (由 select 得到) 的各列在本设计矩阵中的列号, 用于从本设计的 Gram 中切出子块."""
+        pos = {lag: i for i, lag in enumerate(self.lags)}
+        if sub.n_features > self.n_features or any(lag not in pos for lag in sub.lags):
+            raise ValueError("sub design is not a column subset of this design.")
+        return np.concatenate([pos[lag] * self.n_features + np.arange(sub.n_features) for lag in sub.lags])
+
+    def _rows(self, lag: int, a: int, b: int) -> np.ndarray:
+        """行 [a, b) (相对本设计) 在延迟 lag 下对应的 base 行 (带零填充)."""
+        u = self._pad + self.start - lag
+        return self._padded[u + a:u + b, :self.n_features]
+
+    def to_dense(self, rows: np.ndarray | None = None) -> np.ndarray:
+        """显式设计矩阵, 与 build_fir 的结果一致."""
+        ranges = to_ranges(rows, len(self))
+        return np.concatenate([
+            np.concatenate([self._rows(lag, a, b) for lag in self.lags], axis=1) for a, b in ranges
+        ], axis=0)
+
+    def gram(self, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        返回 (XᵀX, X 的列和), 行集合 rows 为相对行号 (默认全部).
+
+        rows 按连续区间分段计算; 每段中延迟差相同的块沿对角线递推.
+        """
+        D, w = self.n_features, len(self.lags)
+        dtype = np.result_type(self.base.dtype, np.float64)
+        G = np.zeros((w * D, w * D), dtype=dtype)
+        s = np.zeros(w * D, dtype=dtype)
+
+        by_diff: dict[int, list[tuple[int, int]]] = defaultdict(list)
+        for i in range(w):
+            for j in range(i, w):
+                by_diff[self.lags[j] - self.lags[i]].append((i, j))
+
+        for a, b in to_ranges(rows, len(self)):
+            n = b - a
+            for i, lag in enumerate(self.lags):
+                s[i * D:(i + 1) * D] += self._rows(lag, a, b).sum(0)
+            for pairs in by_diff.values():
+                prev_blk, prev_lag = None, None
+                for i, j in pairs:
+                    li, lj = self.lags[i], self.lags[j]
+                    if prev_blk is None or li - prev_lag >= n:
+                        blk = self._rows(li, a, b).T @ self._rows(lj, a, b)
+                    else:
+                        # 延迟整体加 k: 行窗口上移 k 行, 加上新进入的首部行, 减去移出的尾部行
+                        k = li - prev_lag
+                        d = lj - li
+                        blk = (prev_blk
+                               + self._rows(li, a, a + k).T @ self._rows(li + d, a, a + k)
+                               - self._rows(prev_lag, b - k, b).T @ self._rows(prev_lag + d, b - k, b))
+                    G[i * D:(i + 1) * D, j * D:(j + 1) * D] += blk
+                    if i != j:
+                        G[j * D:(j + 1) * D, i * D:(i + 1) * D] += blk.T
+                    prev_blk, prev_lag = blk, li
+        return G, s
+
+    def cross(self, y: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Xᵀy, y 的行与 rows 一一对应 (默认全部行)."""
+        D = self.n_features
+        out = np.zeros((len(self.lags) * D, y.shape[1]), dtype=np.result_type(self.base.dtype, y.dtype, np.float64))
+        offset = 0
+        for a, b in to_ranges(rows, len(self)):
+            yb = y[offset:offset + b - a]
+            for i, lag in enumerate(self.lags):
+                out[i * D:(i + 1) * D] += self._rows(lag, a, b).T @ yb
+            offset += b - a
+        return out
+
+    def matmul(self, W: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """X @ W (按延迟块累加), 返回 rows 对应的行."""
+        D = self.n_features
+        parts = []
+        for a, b in to_ranges(rows, len(self)):
+            acc = np.zeros((b - a, W.shape[1]), dtype=np.result_type(self.base.dtype, W.dtype))
+            for i, lag in enumerate(self.lags):
+                acc += self._rows(lag, a, b) @ W[i * D:(i + 1) * D]
+            parts.append(acc)
+        return np.concatenate(parts, axis=0)
+
+
+def to_ranges(rows: np.ndarray | None, n: int) -> list[tuple[int, int]]:
+    """把行号数组拆成连续区间 [(a, b), ...] (保持原顺序), None 表示 [0, n)."""
+    if rows is None:
+        return [(0, n)]
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [rows.size]])
+    return [(int(rows[s]), int(rows[e - 1]) + 1) for s, e in zip(starts, ends)]
+
+
+@dataclass
+class GramRidge:
+    """
+    由 Gram 矩阵求得的岭回归模型 (带截距, 与 sklearn Ridge(fit_intercept=True) 等价).
+
+    coef_ : shape (n_features, n_targets), 注意与 sklearn 的 (n_targets, n_features) 相反
+    """
+
+    coef_: np.ndarray
+    intercept_: np.ndarray
+    alpha_: float
+
+    def predict(self, X: LaggedDesign | np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        if isinstance(X, LaggedDesign):
+            return X.matmul(self.coef_, rows) + self.intercept_
+        X = np.asarray(X) if rows is None else np.asarray(X)[rows]
+        return X @ self.coef_ + self.intercept_
+
+
+@dataclass
+class CenteredSystem:
+    """中心化后的正规方程 (XcᵀXc, Xcᵀyc) 及恢复截距所需的均值."""
+
+    gram: np.ndarray
+    cross: np.ndarray
+    x_mean: np.ndarray
+    y_mean: np.ndarray
+
+    @classmethod
+    def build(cls, G: np.ndarray, s: np.ndarray, XtY: np.ndarray, y_sum: np.ndarray, n: int) -> "CenteredSystem":
+        x_mean = s / n
+        y_mean = y_sum / n
+        return cls(gram=G - n * np.outer(x_mean, x_mean), cross=XtY - n * np.outer(x_mean, y_mean),
+                   x_mean=x_mean, y_mean=y_mean)
+
+    def sub(self, cols: np.ndarray) -> "CenteredSystem":
+        """列子集 (如较小的 FIR 窗口 / PCA 维度) 对应的方程组: 中心化 Gram 的子块即子设计的中心化 Gram."""
+        return CenteredSystem(gram=self.gram[np.ix_(cols, cols)], cross=self.cross[cols],
+                              x_mean=self.x_mean[cols], y_mean=self.y_mean)
+
+    def eigh(self) -> tuple[np.ndarray, np.ndarray]:
+        evals, evecs = np.linalg.eigh(self.gram)
+        return np.clip(evals, 0.0, None), evecs
+
+    def solve(self, alphas: Iterable[float], eig: tuple[np.ndarray, np.ndarray] | None = None) -> list[GramRidge]:
+        """一次特征分解求出所有 alpha 的解 (单个 alpha 时直接做 Cholesky 求解)."""
+        alphas = list(alphas)
+        if eig is None and len(alphas) == 1:
+            from scipy.linalg import solve
+
+            p = self.gram.shape[0]
+            coef = solve(self.gram + alphas[0] * np.eye(p), self.cross, assume_a="pos")
+            return [GramRidge(coef_=coef, intercept_=self.y_mean - self.x_mean @ coef, alpha_=float(alphas[0]))]
+        evals, evecs = eig if eig is not None else self.eigh()
+        proj = evecs.T @ self.cross
+        models = []
+        for alpha in alphas:
+            coef = evecs @ (proj / (evals + alpha)[:, None])
+            models.append(GramRidge(coef_=coef, intercept_=self.y_mean - self.x_mean @ coef, alpha_=float(alpha)))
+        return models
+
+
+def r2_score_columns(y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+    """逐列 R², 与 sklearn.metrics.r2_score(multioutput='raw_values') 一致 (常数列: 完全预测为 1, 否则为 0)."""
+    ss_res = ((y_true - y_pred) ** 2).sum(0)
+    ss_tot = ((y_true - y_true.mean(0)) ** 2).sum(0)
+    out = np.zeros(y_true.shape[1])
+    nonconst = ss_tot != 0
+    out[nonconst] = 1.0 - ss_res[nonconst] / ss_tot[nonconst]
+    out[~nonconst & (ss_res == 0)] = 1.0
+    return out
+
+
+@dataclass
+class SplitGrams:
+    """
+    一个训练集的 Gram 统计量 (只与设计矩阵有关, 不依赖目标, 可在被试之间复用).
+
+    inner : 内层 K 折每折的 (验证行在 train 中的位置, 验证行 Gram, 验证行列和); 为空时不做内层选择
+    """
+
+    train: np.ndarray
+    G: np.ndarray
+    s: np.ndarray
+    inner: list[tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+
+def split_grams(X: LaggedDesign, train: np.ndarray, inner_folds: int | None = None) -> SplitGrams:
+    train = np.asarray(train)
+    G, s = X.gram(train)
+    inner = []
+    if inner_folds:
+        from sklearn.model_selection import KFold
+
+        for _, inner_val in KFold(n_splits=inner_folds, shuffle=False).split(train):
+            G_val, s_val = X.gram(train[inner_val])
+            inner.append((inner_val, G_val, s_val))
+    return SplitGrams(train=train, G=G, s=s, inner=inner)
+
+
+def fit_split(X: LaggedDesign, y: np.ndarray, grams: SplitGrams, alphas: Iterable[float],
+              sub: LaggedDesign | None = None, XtY: np.ndarray | None = None,
+              eig_cache: dict | None = None) -> GramRidge:
+    """
+    在 grams.train 上求解岭回归. 没有内层折时使用 alphas[0]; 否则按 RidgeCV(cv=K) 的规则选择 alpha:
+    不打乱的 K 折, 各折 R² (各目标平均) 的均值最大者, 再用全部训练行重新求解.
+    内层每折的 Gram = 全部训练行的 Gram - 该折的 Gram.
+
+    sub 为 X.select(...) 得到的列子集时, 直接从 X 的 Gram 中切出子块求解 (如较小的 FIR 窗口).
+    XtY 为 X.cross(y[train], train) 的预计算结果 (可选).
+    eig_cache 用于在多个被试之间复用内层各折的特征分解 (同一 grams 与 sub 才能共用一个 dict).
+    """
+    alphas = list(alphas)
+    train = grams.train
+    y_train = y[train]
+    if XtY is None:
+        XtY = X.cross(y_train, train)
+    y_sum = y_train.sum(0)
+    n = train.shape[0]
+    cols = X.column_index(sub) if sub is not None else None
+    target = sub if sub is not None else X
+
+    def _system(G, s, cross, ys, m) -> CenteredSystem:
+        system = CenteredSystem.build(G, s, cross, ys, m)
+        return system.sub(cols) if cols is not None else system
+
+    if not grams.inner:
+        return _system(grams.G, grams.s, XtY, y_sum, n).solve(alphas[:1])[0]
+
+    scores = np.zeros(len(alphas))
+    for fold, (inner_val, G_val, s_val) in enumerate(grams.inner):
+        val_rows = train[inner_val]
+        y_val = y_train[inner_val]
+        system = _system(grams.G - G_val, grams.s - s_val, XtY - X.cross(y_val, val_rows),
+                         y_sum - y_val.sum(0), n - inner_val.shape[0])
+        eig = None
+        if eig_cache is not None:
+            if fold not in eig_cache:
+                eig_cache[fold] = system.eigh()
+            eig = eig_cache[fold]
+        for k, model in enumerate(system.solve(alphas, eig=eig)):
+            scores[k] += r2_score_columns(y_val, model.predict(target, val_rows)).mean()
+
+    best = alphas[int(np.argmax(scores))]
+    return _system(grams.G, grams.s, XtY, y_sum, n).solve([best])[0]
+
+
+def cholesky_factor(gram: np.ndarray, alpha: float) -> np.ndarray:
+    """(gram + alpha I) 的下三角 Cholesky 因子; 中心化 Gram 与目标无关, 因子可在被试间复用."""
+    from scipy.linalg import cholesky
+
+    return cholesky(gram + alpha * np.eye(gram.shape[0]), lower=True)
+
+
+def nested_solve(system: CenteredSystem, sizes: Iterable[int], alpha: float,
+                 L: np.ndarray | None = None) -> list[GramRidge]:
+    """
+    对列前缀嵌套的一组子问题 (前 k 列, k in sizes) 求解同一个 alpha 的岭回归.
+
+    (G + alpha I) 的 Cholesky 因子的左上 k x k 块就是前 k 列子问题的 Cholesky 因子,
+    因此只需一次分解 (或传入已有的因子 L), 每个 k 再做两次三角求解.
+    """
+    from scipy.linalg import solve_triangular
+
+    if L is None:
+        L = cholesky_factor(system.gram, alpha)
+    models = []
+    for k in sizes:
+        Lk = L[:k, :k]
+        coef = solve_triangular(Lk.T, solve_triangular(Lk, system.cross[:k], lower=True), lower=False)
+        models.append(GramRidge(coef_=coef, intercept_=system.y_mean - system.x_mean[:k] @ coef,
+                                alpha_=float(alpha)))
+    return models
+
+
+def outer_splits(n: int, kfold: int, test_ratio: float = 0.2) -> list[tuple[np.ndarray, np.ndarray]]:
+    """与 fit_encoding_single (kfold <= 1, 前 80% 训练) / fit_encoding_cv (不打乱的 KFold) 相同的外层划分."""
+    if kfold <= 1:
+        split = int(n * (1 - test_ratio))
+        if split <= 0 or split >= n:
+            raise ValueError("Invalid test_ratio for current sample size.")
+        return [(np.arange(split), np.arange(split, n))]
+    from sklearn.model_selection import KFold
+
+    return list(KFold(n_splits=kfold, shuffle=False).split(np.arange(n)))
+
+
+def fold_average(corrs: list[np.ndarray]) -> np.ndarray:
+    """多折 corr map 的 Fisher z 平均 (与 fit_encoding_cv 一致), 单折时原样返回."""
+    return corrs[0] if len(corrs) == 1 else np.tanh(np.mean(np.arctanh(corrs), 0))
+
+
+def ridge_single(X: LaggedDesign, y: np.ndarray, train: np.ndarray, alpha: float) -> GramRidge:
+    return fit_split(X, y, split_grams(X, train), [alpha])
+
+
+def ridge_cv(X: LaggedDesign, y: np.ndarray, train: np.ndarray, alphas: Iterable[float],
+             inner_folds: int = 5) -> GramRidge:
+    """与 RidgeCV(alphas, cv=inner_folds) 相同的 alpha 选择规则, 见 fit_split."""
+    return fit_split(X, y, split_grams(X, train, inner_folds), alphas)
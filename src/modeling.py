@@ -1,14 +1,30 @@
 from __future__ import annotations
 
+import argparse
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable
 
 import numpy as np
-from sklearn.model_selection import KFold
 
+from src.alpha_select import ClosedFormCV
+from src.corr_kernel import batched_corr
+from src.corr_store import HeldOutPredictions
+from src.lagged_design import (
+    CenteredSystem,
+    GramRidge,
+    LaggedDesign,
+    SplitGrams,
+    fit_split,
+    fold_average,
+    outer_splits,
+    split_grams,
+)
+from src.tracing import trace
 from src.utils import concat_feature, fit_encoding_cv, fit_encoding_single
 
+GROUP_MODES = ("average", "stacked")
+
 
 @dataclass
 class SummaryStats:
@@ -26,34 +42,252 @@ def build_fir(features: np.ndarray, window: int, offset: int) -> np.ndarray:
 
 def run_cv_multi_subjects(X: np.ndarray, fmris: dict, subjects: Iterable[int],
                           excluded_start: int, excluded_end: int,
-                          alphas: Iterable[float], kfold: int) -> tuple[list[float], np.ndarray]:
+                          alphas: Iterable[float], kfold: int,
+                          group_mode: str | None = None,
+                          keep_predictions: bool = False,
+                          alpha_select: str = "nested",
+                          alpha_maps: list[np.ndarray] | None = None) -> tuple[list[float], np.ndarray]:
+    """
+    每个被试独立拟合编码模型; group_mode 为 average/stacked 时改为只拟合一次, 见 run_cv_group.
+    alpha_select 为 block/gcv 时逐目标闭式选择 alpha (见 alpha_select.ClosedFormCV), 单次划分时也做选择;
+    此时若给出 alpha_maps, 按被试顺序追加每个被试各目标所选的 alpha (多折时为几何平均).
+
+    Returns
+    -------
+        corr_means : 每个被试 corr map 的均值
+        corr_maps : shape (n_subjects, n_targets) float32, 行顺序与 subjects 相同
+                    (群体平均 map 见 corr_store.group_mean_map)
+        predictions : 仅 keep_predictions 时返回, 测试段预测 (HeldOutPredictions, float16)
+    """
+    if alpha_select != "nested":
+        if group_mode is not None:
+            raise ValueError("Closed-form alpha selection does not support group_mode.")
+        return _run_cv_closed_form(X, fmris, subjects, excluded_start, excluded_end, alphas, kfold,
+                                   alpha_select, keep_predictions, alpha_maps)
+    if group_mode is not None:
+        return run_cv_group(X, fmris, subjects, excluded_start, excluded_end, alphas, kfold, group_mode,
+                            keep_predictions=keep_predictions)
+    if isinstance(X, LaggedDesign):
+        return _run_cv_lagged(X, fmris, subjects, excluded_start, excluded_end, alphas, kfold, keep_predictions)
     if kfold <= 1:
         outer_cv = None
     else:
+        from sklearn.model_selection import KFold
+
         outer_cv = KFold(n_splits=kfold, shuffle=False)
+    subjects = list(subjects)
     corr_means: list[float] = []
-    last_corr_map = None
-    for sub in subjects:
-        if outer_cv is None:
-            model, corr_map = fit_encoding_single(
-                X=X,
-                y=fmris[sub],
-                alpha=list(alphas)[0],
-                excluded_start=excluded_start,
-                excluded_end=excluded_end,
-            )
-        else:
-            model, corr_map = fit_encoding_cv(
-                X=X,
-                y=fmris[sub],
-                cv_splitter=outer_cv,
-                alphas=alphas,
-                excluded_start=excluded_start,
-                excluded_end=excluded_end,
-            )
+    corr_maps = None
+    preds = None
+    for si, sub in enumerate(subjects):
+        with trace("fit", subject=sub) as span:
+            span.array("y", fmris[sub])
+            if outer_cv is None:
+                _, corr_map, *y_pred = fit_encoding_single(
+                    X=X,
+                    y=fmris[sub],
+                    alpha=list(alphas)[0],
+                    excluded_start=excluded_start,
+                    excluded_end=excluded_end,
+                    return_pred=keep_predictions,
+                )
+            else:
+                _, corr_map, *y_pred = fit_encoding_cv(
+                    X=X,
+                    y=fmris[sub],
+                    cv_splitter=outer_cv,
+                    alphas=alphas,
+                    excluded_start=excluded_start,
+                    excluded_end=excluded_end,
+                    return_pred=keep_predictions,
+                )
         corr_means.append(float(np.mean(corr_map)))
-        last_corr_map = corr_map
-    return corr_means, last_corr_map
+        if corr_maps is None:
+            corr_maps = np.empty((len(subjects), corr_map.shape[0]), dtype=np.float32)
+        corr_maps[si] = corr_map
+        if keep_predictions:
+            if preds is None:
+                preds = np.empty((len(subjects),) + y_pred[0].shape, dtype=np.float16)
+            preds[si] = y_pred[0]
+    if keep_predictions:
+        return corr_means, corr_maps, HeldOutPredictions(
+            rows=_test_rows(len(X), excluded_start, excluded_end, kfold), values=preds)
+    return corr_means, corr_maps
+
+
+def _run_cv_lagged(X: LaggedDesign, fmris: dict, subjects: Iterable[int],
+                   excluded_start: int, excluded_end: int, alphas: Iterable[float], kfold: int,
+                   keep_predictions: bool) -> tuple[list[float], np.ndarray]:
+    """
+    隐式 FIR 设计的逐被试拟合, 结果与 fit_encoding_single / fit_encoding_cv 相同.
+    每个外层划分只计算一次 Gram (含内层各折) 与内层特征分解, 所有被试共用 (它们只与设计矩阵有关).
+    """
+    subjects = list(subjects)
+    alphas = list(alphas)
+    design = X[excluded_start:-excluded_end]
+    fold_corrs: list[list[np.ndarray]] = [[] for _ in subjects]
+    preds: list[list[np.ndarray]] = [[] for _ in subjects]
+    for fold, (train, test) in enumerate(outer_splits(len(design), kfold)):
+        with trace("gram", fold=fold):
+            grams = split_grams(design, train, inner_folds=5 if kfold > 1 else None)
+        eig_cache: dict = {}
+        for si, sub in enumerate(subjects):
+            with trace("fit", subject=sub, fold=fold) as span:
+                y = np.asarray(fmris[sub])[excluded_start:-excluded_end]
+                span.array("y", y)
+                model = fit_split(design, y, grams, alphas, eig_cache=eig_cache)
+                pred = model.predict(design, test)
+                fold_corrs[si].append(batched_corr(pred, y[test], dtype=np.float64))
+                if keep_predictions:
+                    preds[si].append(pred.astype(np.float16))
+        del grams, eig_cache
+
+    corr_maps = np.stack([fold_average(corrs) for corrs in fold_corrs])
+    corr_means = [float(np.mean(corr_map)) for corr_map in corr_maps]
+    if keep_predictions:
+        return corr_means, corr_maps.astype(np.float32), HeldOutPredictions(
+            rows=_test_rows(len(X), excluded_start, excluded_end, kfold),
+            values=np.stack([np.concatenate(p) for p in preds]))
+    return corr_means, corr_maps.astype(np.float32)
+
+
+def _run_cv_closed_form(X: np.ndarray, fmris: dict, subjects: Iterable[int],
+                        excluded_start: int, excluded_end: int, alphas: Iterable[float], kfold: int,
+                        method: str, keep_predictions: bool,
+                        alpha_maps: list[np.ndarray] | None) -> tuple[list[float], np.ndarray]:
+    """每个外层划分只分解一次设计矩阵, 所有被试共用 (分解与块因子只与设计矩阵有关)."""
+    subjects = list(subjects)
+    design = X if isinstance(X, LaggedDesign) else LaggedDesign(np.asarray(X), [0])
+    design = design[excluded_start:-excluded_end]
+    splits = outer_splits(len(design), kfold)
+    fold_corrs: list[list[np.ndarray]] = [[] for _ in subjects]
+    log_alphas: list[list[np.ndarray]] = [[] for _ in subjects]
+    preds: list[list[np.ndarray]] = [[] for _ in subjects]
+    for fold, (train, test) in enumerate(splits):
+        with trace("alpha_select", method=method, fold=fold):
+            selector = ClosedFormCV(design, train, alphas, method)
+        for si, sub in enumerate(subjects):
+            with trace("fit", subject=sub, fold=fold) as span:
+                y = np.asarray(fmris[sub], dtype=np.float64)[excluded_start:-excluded_end]
+                span.array("y", y)
+                model = selector.fit(y[train])
+                pred = model.predict(design, test)
+                fold_corrs[si].append(batched_corr(pred, y[test], dtype=np.float64))
+                log_alphas[si].append(np.log10(model.alpha_))
+                if keep_predictions:
+                    preds[si].append(pred.astype(np.float16))
+        del selector
+
+    corr_maps = np.stack([fold_average(corrs) for corrs in fold_corrs])
+    corr_means = [float(np.mean(corr_map)) for corr_map in corr_maps]
+    if alpha_maps is not None:
+        alpha_maps.extend(10 ** np.mean(logs, axis=0) for logs in log_alphas)
+    if keep_predictions:
+        return corr_means, corr_maps.astype(np.float32), HeldOutPredictions(
+            rows=_test_rows(len(X), excluded_start, excluded_end, kfold),
+            values=np.stack([np.concatenate(p) for p in preds]))
+    return corr_means, corr_maps.astype(np.float32)
+
+
+def _test_rows(n_total: int, excluded_start: int, excluded_end: int, kfold: int) -> np.ndarray:
+    """各外层划分测试行 (按折顺序拼接) 在原始 TR 序列中的下标."""
+    splits = outer_splits(n_total - excluded_start - excluded_end, kfold)
+    return np.concatenate([test for _, test in splits]) + excluded_start
+
+
+def add_group_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--group-mode", choices=GROUP_MODES, default=None,
+                        help="群体模式: 只拟合一个模型 (average: 被试平均响应; stacked: 被试沿时间拼接), "
+                             "再对每个被试的测试段打分; 结果写入 <输出目录>/group-<mode>/, 用于快速筛选模型与层")
+
+
+def group_alpha_scale(mode: str, n_subjects: int) -> int:
+    """
+    各被试的设计矩阵相同, 沿时间拼接 S 个被试后 X'X 与 X'Y 分别为单个被试的 S 倍与 S * X'ȳ,
+    因此 stacked 等价于在平均响应 ȳ 上以 alpha / S 拟合; average 即 alpha 本身.
+    """
+    if mode not in GROUP_MODES:
+        raise ValueError(f"Unknown group mode: {mode}")
+    return n_subjects if mode == "stacked" else 1
+
+
+def _stacked_r2(y_val: np.ndarray, pred: np.ndarray) -> float:
+    """拼接后验证行上的 R² (各目标平均), y_val shape (S, m, V), 与 r2_score_columns 的常数列规则相同."""
+    ss_res = ((y_val - pred) ** 2).sum((0, 1))
+    ss_tot = ((y_val - y_val.mean((0, 1))) ** 2).sum((0, 1))
+    out = np.zeros(y_val.shape[2])
+    nonconst = ss_tot != 0
+    out[nonconst] = 1.0 - ss_res[nonconst] / ss_tot[nonconst]
+    out[~nonconst & (ss_res == 0)] = 1.0
+    return float(out.mean())
+
+
+def _fit_group(design: LaggedDesign, ys: np.ndarray, y_bar: np.ndarray, grams: SplitGrams,
+               alphas: list[float], mode: str) -> GramRidge:
+    scale = group_alpha_scale(mode, ys.shape[0])
+    if not grams.inner or mode == "average":
+        # average 的内层选择与单个被试相同 (RidgeCV 规则), 只是目标换成 ȳ
+        return fit_split(design, y_bar, grams, [a / scale for a in alphas])
+
+    # stacked: 内层折按时间划分 (同一刺激时刻的所有被试同在训练或验证), 验证 R² 在全部被试上计算
+    train = grams.train
+    y_train = y_bar[train]
+    XtY = design.cross(y_train, train)
+    y_sum = y_train.sum(0)
+    scores = np.zeros(len(alphas))
+    for inner_val, G_val, s_val in grams.inner:
+        val_rows = train[inner_val]
+        system = CenteredSystem.build(grams.G - G_val, grams.s - s_val, XtY - design.cross(y_bar[val_rows], val_rows),
+                                      y_sum - y_bar[val_rows].sum(0), train.shape[0] - inner_val.shape[0])
+        for k, model in enumerate(system.solve([a / scale for a in alphas], eig=system.eigh())):
+            scores[k] += _stacked_r2(ys[:, val_rows], model.predict(design, val_rows))
+    best = alphas[int(np.argmax(scores))]
+    return fit_split(design, y_bar, grams, [best / scale])
+
+
+def run_cv_group(X: np.ndarray, fmris: dict, subjects: Iterable[int],
+                 excluded_start: int, excluded_end: int,
+                 alphas: Iterable[float], kfold: int, mode: str = "average",
+                 keep_predictions: bool = False) -> tuple[list[float], np.ndarray]:
+    """
+    群体编码模型: 每个外层划分只拟合一个模型, 再分别与每个被试的测试段计算 corr.
+
+    Parameters
+    ----------
+        X : 设计矩阵 (稠密数组或 LaggedDesign)
+        mode : average (被试平均响应) 或 stacked (被试沿时间拼接, 等价形式见 group_alpha_scale)
+        其余参数与 run_cv_multi_subjects 相同, 外层划分与 alpha 规则也相同
+
+    Returns
+    -------
+        与 run_cv_multi_subjects 相同; 预测在被试间共享, predictions.values 的第一维为 1
+    """
+    subjects = list(subjects)
+    alphas = list(alphas)
+    design = X if isinstance(X, LaggedDesign) else LaggedDesign(np.asarray(X), [0])
+    design = design[excluded_start:-excluded_end]
+    ys = np.stack([np.asarray(fmris[sub], dtype=np.float64)[excluded_start:-excluded_end] for sub in subjects])
+    y_bar = ys.mean(0)
+
+    fold_corrs = []
+    preds = []
+    with trace("fit", group_mode=mode, n_subjects=len(subjects)) as span:
+        span.array("y", ys)
+        for train, test in outer_splits(len(design), kfold):
+            grams = split_grams(design, train, inner_folds=5 if kfold > 1 else None)
+            model = _fit_group(design, ys, y_bar, grams, alphas, mode)
+            pred = model.predict(design, test)
+            # 预测在被试间共享, 作为批量 corr 的共享一侧
+            fold_corrs.append(batched_corr(ys[:, test], pred, dtype=np.float64))
+            if keep_predictions:
+                preds.append(pred.astype(np.float16))
+    corr_maps = np.stack([fold_average([corrs[si] for corrs in fold_corrs]) for si in range(len(subjects))])
+    corr_means = [float(np.mean(corr_map)) for corr_map in corr_maps]
+    corr_maps = corr_maps.astype(np.float32)
+    if keep_predictions:
+        return corr_means, corr_maps, HeldOutPredictions(
+            rows=_test_rows(len(X), excluded_start, excluded_end, kfold), values=np.concatenate(preds)[None])
+    return corr_means, corr_maps
 
 
 def summarize(corr_means: Iterable[float]) -> SummaryStats:
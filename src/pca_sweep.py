@@ -0,0 +1,119 @@
+"""
+pca_sweep.py
+
+PCA 维度扫描. PCA 的主成分是嵌套的: k 维降维结果就是最大维度降维结果的前 k 列,
+因此只做一次分解 (TransformPipeline, 带磁盘缓存), 每个 k 的 FIR 设计矩阵都是同一个 LaggedDesign 的列子集.
+- 单一 alpha 时, 把列按 "特征优先" 排列, k 维设计正好是前 k * window 列:
+  一次 Cholesky 分解 (各被试共用) 即可通过左上子块得到所有 k 的解
+- 多个 alpha (内层 K 折选择) 时, 从同一份 Gram 中切出子块求解, 各折的特征分解在被试间共用
+"""
+from __future__ import annotations
+
+from dataclasses import replace
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.lagged_design import (
+    CenteredSystem,
+    GramRidge,
+    LaggedDesign,
+    cholesky_factor,
+    fit_split,
+    fold_average,
+    nested_solve,
+    outer_splits,
+    split_grams,
+)
+from src.modeling import summarize
+from src.transforms import TransformParams, TransformPipeline
+from src.corr_kernel import batched_corr
+
+
+def run_pca_sweep(features: np.ndarray, fmris: dict, subjects: Iterable[int], pca_dims: Iterable[int],
+                  params: TransformParams, excluded_start: int, excluded_end: int,
+                  alphas: Iterable[float], kfold: int) -> pd.DataFrame:
+    """
+    对每个 PCA 维度评估编码模型 (标准化 / FIR 参数取自 params, 其 pca_dim 被忽略).
+
+    不小于原始特征维度的 pca_dim 与常规流程一致, 视为不做 PCA.
+
+    Returns
+    -------
+        table : 每行一个 pca_dim, 列为 pca_dim/mean/std/min/max/median (跨被试)
+    """
+    dims = sorted(set(int(d) for d in pca_dims))
+    alphas = list(alphas)
+    subjects = list(subjects)
+    n_in = features.shape[1]
+    pca_dims_used = [d for d in dims if d < n_in]
+    lags = range(params.fir_offset, params.fir_offset + params.fir_window)
+    w = params.fir_window
+
+    per_dim: dict[int, list[list[np.ndarray]]] = {d: [[] for _ in subjects] for d in dims}
+    designs: list[tuple[LaggedDesign, dict[int, LaggedDesign]]] = []
+    if pca_dims_used:
+        # 一次分解得到最大维度, 其余维度取前 k 列
+        reduced = TransformPipeline(replace(params, pca_dim=pca_dims_used[-1])).fit_reduce(features)
+        full = LaggedDesign(reduced, lags)[excluded_start:-excluded_end]
+        designs.append((full, {d: full.select(n_features=d) for d in pca_dims_used}))
+    if len(pca_dims_used) < len(dims):
+        reduced = TransformPipeline(replace(params, pca_dim=None)).fit_reduce(features)
+        full = LaggedDesign(reduced, lags)[excluded_start:-excluded_end]
+        designs.append((full, {d: full for d in dims if d >= n_in}))
+
+    for full, subs in designs:
+        D = full.n_features
+        # 特征优先的列顺序: 前 k * w 列即前 k 个成分的所有延迟
+        order = np.concatenate([np.arange(w) * D + f for f in range(D)])
+        position = np.empty_like(order)
+        position[order] = np.arange(order.size)
+        perms = {d: position[full.column_index(sub)] for d, sub in subs.items()}
+
+        for train, test in outer_splits(len(full), kfold):
+            grams = split_grams(full, train, inner_folds=5 if kfold > 1 else None)
+            factor = None
+            eig_caches: dict[int, dict] = {d: {} for d in subs}
+            for si, sub_id in enumerate(subjects):
+                y = fmris[sub_id][excluded_start:-excluded_end]
+                y_train = y[train]
+                XtY = full.cross(y_train, train)
+                if kfold <= 1:
+                    system = CenteredSystem.build(grams.G, grams.s, XtY, y_train.sum(0), train.shape[0]).sub(order)
+                    if factor is None:
+                        factor = cholesky_factor(system.gram, alphas[0])
+                    sizes = [subs[d].n_features * w for d in subs]
+                    preds = []
+                    for (d, design), model in zip(subs.items(), nested_solve(system, sizes, alphas[0], L=factor)):
+                        # nested_solve 的系数按特征优先排列, 换回设计矩阵的延迟优先顺序
+                        model = GramRidge(coef_=model.coef_[perms[d]], intercept_=model.intercept_,
+                                          alpha_=model.alpha_)
+                        preds.append(model.predict(design, test))
+                else:
+                    preds = [fit_split(full, y, grams, alphas, sub=design, XtY=XtY,
+                                       eig_cache=eig_caches[d]).predict(design, test)
+                             for d, design in subs.items()]
+                # 各维度的预测堆叠后一次算 corr (响应共享)
+                for d, corr in zip(subs, batched_corr(np.stack(preds), y[test])):
+                    per_dim[d][si].append(corr)
+
+    rows = []
+    for d in dims:
+        stats = summarize([float(np.mean(fold_average(corrs))) for corrs in per_dim[d]])
+        rows.append({"pca_dim": d, "mean": stats.mean, "std": stats.std,
+                     "min": stats.min, "max": stats.max, "median": stats.median})
+    return pd.DataFrame(rows)
+
+
+def pca_grid(tables: dict[int, pd.DataFrame]) -> pd.DataFrame:
+    """{layer: run_pca_sweep 的结果} -> 带 layer 列的长表."""
+    grid = pd.concat([t.assign(layer=layer) for layer, t in tables.items()], ignore_index=True)
+    return grid[["layer"] + [c for c in grid.columns if c != "layer"]]
+
+
+def format_pca_grid(tables: dict[int, pd.DataFrame]) -> str:
+    """(layer x pca_dim) 的平均 corr 表."""
+    pivot = pca_grid(tables).pivot(index="layer", columns="pca_dim", values="mean")
+    pivot.columns = [f"pca={c}" for c in pivot.columns]
+    return pivot.to_string(float_format=lambda v: f"{v:.4f}")
@@ -15,13 +15,21 @@ from src.config import (
     DEFAULT_PCA_DIM,
     DEFAULT_FIR_WINDOW,
     DEFAULT_FIR_OFFSET,
-    DEFAULT_ALPHAS,
     DEFAULT_KFOLD,
     SUBJECTS,
 )
-from src.data import load_fmri, load_audio
-from src.audio_pipeline import chunk_audio, extract_audio_layers, save_layer_features
-from src.modeling import build_fir, run_cv_multi_subjects, summarize, append_log
+from src.data import load_fmri, load_fmri_vertices, load_audio
+from src.audio_pipeline import extract_audio_layers, lazy_chunk_audio, save_layer_features
+from src.alpha_select import add_alpha_args, alpha_summary, resolve_alphas
+from src.modeling import add_group_args, run_cv_multi_subjects, summarize, append_log
+from src.fir_sweep import format_sweep_table, run_fir_sweep, save_sweep_table
+from src.pca_sweep import format_pca_grid, pca_grid, run_pca_sweep
+from src.transforms import TransformParams, TransformPipeline, array_digest
+from src.corr_store import group_mean_map, save_encoding_result
+from src.extract_checkpoint import DEFAULT_CHECKPOINT_EVERY, open_checkpoint
+from src.vertex_encoding import DEFAULT_BLOCK_SIZE, run_cv_multi_subjects_chunked
+from src.tracing import add_trace_args, init_from_args, set_tags, trace
+from src.work_queue import add_queue_args, claim_each, grid_name, open_queue
 
 
 def safe_name(model_name: str) -> str:
@@ -86,31 +94,83 @@ def parse_args() -> argparse.Namespace:
                         help="时间维 pooling 方式")
     parser.add_argument("--batch-size", type=int, default=16, help="特征提取 batch size")
     parser.add_argument("--autocast", action="store_true", help="使用 autocast")
+    parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                        help="特征提取每多少个 batch 落盘一次 (中断后重跑同一命令从断点继续), 0 表示不落盘")
     parser.add_argument("--pca-dim", type=int, default=DEFAULT_PCA_DIM, help="PCA 维度")
     parser.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW, help="FIR 窗口")
     parser.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET, help="FIR 偏移")
+    parser.add_argument("--implicit-fir", action="store_true",
+                        help="隐式 FIR 设计 (由错位 Gram 块求解, 不生成 window 倍大小的设计矩阵)")
+    parser.add_argument("--fir-windows", nargs="+", type=int, default=None,
+                        help="FIR 窗口扫描列表 (与 --fir-offsets 任一给出时进入扫描模式, 输出 window x offset 表)")
+    parser.add_argument("--fir-offsets", nargs="+", type=int, default=None, help="FIR 偏移扫描列表")
+    parser.add_argument("--pca-dims", nargs="+", type=int, default=None,
+                        help="PCA 维度扫描列表 (一次分解, 输出 layer x pca_dim 表)")
+    parser.add_argument("--targets", choices=["roi", "vertex"], default="roi",
+                        help="编码目标: roi (默认) 或 vertex (顶点级, 分块求解, 结果写入 <model_dir>/vertex/)")
+    parser.add_argument("--vertex-dir", type=str, default=None,
+                        help="顶点级 fMRI 目录 (默认 data/raw/vertices, 每个被试一个 sub-<id>.npy)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="顶点级编码每块的目标列数")
     parser.add_argument("--log-file", type=str, default="log.txt", help="日志文件名")
+    parser.add_argument("--save-predictions", action="store_true",
+                        help="同时保存测试段预测 (float16, pred_layer*.npz)")
+    parser.add_argument("--extract-only", action="store_true",
+                        help="只提取并保存特征 (features/), 不拟合; 之后用 run_halving_search 在这些特征上搜索")
+    add_group_args(parser)
+    add_alpha_args(parser)
+    add_queue_args(parser)
+    add_trace_args(parser)
     parser.add_argument("--trust-remote-code", action="store_true", help="使用 trust_remote_code")
     parser.add_argument("--save-aligned", action="store_true", help="保存对齐后的TR特征")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.extract_only and (args.pca_dims or args.fir_windows or args.fir_offsets or args.group_mode
+                              or args.alpha_select != "nested" or args.save_predictions):
+        parser.error("--extract-only 不拟合, 不能与扫描模式、--group-mode、--alpha-select 或 --save-predictions 同时使用")
+    if args.pca_dims and (args.fir_windows or args.fir_offsets):
+        parser.error("--pca-dims 不能与 --fir-windows/--fir-offsets 同时使用")
+    if args.targets == "vertex" and (args.pca_dims or args.fir_windows or args.fir_offsets):
+        parser.error("扫描模式只支持 --targets roi")
+    if args.group_mode and (args.pca_dims or args.fir_windows or args.fir_offsets or args.targets == "vertex"):
+        parser.error("--group-mode 只用于常规 ROI 编码, 不能与扫描模式或 --targets vertex 同时使用")
+    if args.save_predictions and args.targets == "vertex":
+        parser.error("--save-predictions 只支持 --targets roi")
+    if args.alpha_select != "nested" and (args.group_mode or args.pca_dims or args.fir_windows or args.fir_offsets or args.targets == "vertex"):
+        parser.error("--alpha-select block/gcv 只用于常规逐被试 ROI 编码, 不能与 --group-mode、扫描模式或 --targets vertex 同时使用")
+    return args
 
 
 def main() -> int:
     args = parse_args()
-    fmris = load_fmri()
+    alphas = resolve_alphas(args)
+    init_from_args("audio", args)
+    if args.targets == "vertex":
+        fmris = load_fmri_vertices(Path(args.vertex_dir) if args.vertex_dir else None)
+    else:
+        fmris = load_fmri()
     wav, sr = load_audio(sr=AUDIO_SR)
+    wav_digest = array_digest(wav) if args.checkpoint_every > 0 else ""
     n_trs = fmris[75].shape[0]
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    transform_params = TransformParams(pca_dim=args.pca_dim, fir_window=args.fir_window,
+                                       fir_offset=args.fir_offset)
+    queue = open_queue(args.work_dir, grid_name("audio", args), ttl=args.lease_ttl)
 
     for tr_win in args.tr_win:
         print(f"[audio] tr_win start: {tr_win}", flush=True)
-        audio_chunks = chunk_audio(wav, sr, n_trs=n_trs, tr_seconds=TR_SECONDS, tr_win=tr_win)
+        with trace("chunk") as span:
+            audio_chunks = lazy_chunk_audio(wav, sr, n_trs=n_trs, tr_seconds=TR_SECONDS, tr_win=tr_win)
+            span.array("audio_chunks", audio_chunks)
 
-        for model_name in args.models:
+        for model_name in claim_each(queue, args.models, key=lambda m: f"{safe_name(m)}/{tr_win}TR"):
             print(f"[audio] model start: {model_name}", flush=True)
+            set_tags(model=model_name, layer=None, tr_win=tr_win)
             model_dir = RESULTS_ROOT / "audio" / safe_name(model_name) / f"{tr_win}TR"
             feature_dir = model_dir / "features"
-            log_path = model_dir / args.log_file
+            # 群体模式 / 闭式 alpha 选择的结果单独存放, 不覆盖常规结果 (corr store 中以子目录名为 tag)
+            fit_dir = model_dir / f"group-{args.group_mode}" if args.group_mode else model_dir
+            if args.alpha_select != "nested":
+                fit_dir = model_dir / f"alpha-{args.alpha_select}"
+            log_path = fit_dir / args.log_file
 
             try:
                 processor = AutoProcessor.from_pretrained(model_name, trust_remote_code=args.trust_remote_code)
@@ -120,47 +180,110 @@ def main() -> int:
             audio_model = audio_model.to(device)
             layers = resolve_layers(audio_model, args.layer_strategy, args.layers, args.n_layers)
 
-            layer_features = extract_audio_layers(
-                audio_chunks=audio_chunks,
-                processor=processor,
-                model=audio_model,
-                layers=layers,
-                device=device,
-                batch_size=args.batch_size,
-                autocast=args.autocast,
-                pooling=args.pooling,
-                sampling_rate=sr,
-            )
+            checkpoint = open_checkpoint(feature_dir, {
+                "model": model_name, "layers": list(layers), "pooling": args.pooling,
+                "autocast": args.autocast, "tr_win": tr_win, "sr": sr, "wav": wav_digest,
+            }, args.checkpoint_every)
+            with trace("extract") as span:
+                layer_features = extract_audio_layers(
+                    audio_chunks=audio_chunks,
+                    processor=processor,
+                    model=audio_model,
+                    layers=layers,
+                    device=device,
+                    batch_size=args.batch_size,
+                    autocast=args.autocast,
+                    pooling=args.pooling,
+                    sampling_rate=sr,
+                    checkpoint=checkpoint,
+                )
+                span.set(n_layers=len(layer_features))
             save_layer_features(layer_features, feature_dir,
                                 prefix=f"audio_{safe_name(model_name)}_win{tr_win}TR")
+            if checkpoint is not None:
+                checkpoint.clear()
 
+            pca_tables = {}
             for layer, features in layer_features.items():
                 print(f"[audio] model={model_name} layer={layer} start", flush=True)
+                set_tags(layer=layer)
                 if args.save_aligned:
                     np.save(model_dir / f"aligned_layer{layer}.npy", features)
-                features_std = (features - features.mean(0)) / (features.std(0) + 1e-8)
-                pca_features = features_std
-                if args.pca_dim and args.pca_dim < features.shape[1]:
-                    from sklearn.decomposition import PCA
-                    pca = PCA(n_components=args.pca_dim)
-                    pca_features = pca.fit_transform(features_std)
+                if args.extract_only:
+                    print(f"[audio] model={model_name} layer={layer} features saved", flush=True)
+                    continue
+                if args.pca_dims:
+                    table = run_pca_sweep(
+                        features, fmris, SUBJECTS, args.pca_dims, transform_params,
+                        excluded_start=10, excluded_end=10,
+                        alphas=alphas, kfold=DEFAULT_KFOLD,
+                    )
+                    save_sweep_table(table, model_dir / f"pca_sweep_layer{layer}.csv")
+                    pca_tables[layer] = table
+                    print(f"[audio] model={model_name} layer={layer} pca sweep done", flush=True)
+                    continue
+
+                if args.fir_windows or args.fir_offsets:
+                    reduced = TransformPipeline(transform_params).fit_reduce(features)
+                    table = run_fir_sweep(
+                        reduced, fmris, SUBJECTS,
+                        windows=args.fir_windows or [args.fir_window],
+                        offsets=args.fir_offsets or [args.fir_offset],
+                        excluded_start=10, excluded_end=10,
+                        alphas=alphas, kfold=DEFAULT_KFOLD,
+                    )
+                    save_sweep_table(table, model_dir / f"fir_sweep_layer{layer}.csv")
+                    print(f"[audio] model={model_name} layer={layer} fir sweep (mean corr):\n{format_sweep_table(table)}", flush=True)
+                    continue
+
+                fir = TransformPipeline(transform_params).fit_transform(features, implicit=args.implicit_fir)
 
-                fir = build_fir(pca_features, window=args.fir_window, offset=args.fir_offset)
+                if args.targets == "vertex":
+                    vertex_dir = model_dir / "vertex"
+                    corr_means, corr_maps = run_cv_multi_subjects_chunked(
+                        X=fir,
+                        fmris=fmris,
+                        subjects=SUBJECTS,
+                        excluded_start=10,
+                        excluded_end=10,
+                        alphas=alphas,
+                        kfold=DEFAULT_KFOLD,
+                        out_path=vertex_dir / f"corr_subjects_layer{layer}.npy",
+                        block_size=args.block_size,
+                    )
+                    append_log(vertex_dir / args.log_file, layer, summarize(corr_means))
+                    # 与 ROI 结果一致, corr_layer 为群体平均 map; 全部被试见 corr_subjects_layer
+                    np.save(vertex_dir / f"corr_layer{layer}.npy", group_mean_map(corr_maps))
+                    print(f"[audio] model={model_name} layer={layer} vertex done", flush=True)
+                    continue
 
-                corr_means, corr_map = run_cv_multi_subjects(
+                alpha_maps: list[np.ndarray] = []
+                corr_means, corr_maps, *held_out = run_cv_multi_subjects(
                     X=fir,
                     fmris=fmris,
                     subjects=SUBJECTS,
                     excluded_start=10,
                     excluded_end=10,
-                    alphas=DEFAULT_ALPHAS,
+                    alphas=alphas,
                     kfold=DEFAULT_KFOLD,
+                    group_mode=args.group_mode,
+                    keep_predictions=args.save_predictions,
+                    alpha_select=args.alpha_select,
+                    alpha_maps=alpha_maps,
                 )
                 stats = summarize(corr_means)
                 append_log(log_path, layer, stats)
 
-                np.save(model_dir / f"corr_layer{layer}.npy", corr_map)
+                save_encoding_result(fit_dir / f"corr_layer{layer}.npy", corr_maps,
+                                     predictions=held_out[0] if held_out else None,
+                                     alphas=np.stack(alpha_maps) if alpha_maps else None)
+                if alpha_maps:
+                    print(f"[audio] model={model_name} layer={layer} alphas ({args.alpha_select}): "
+                          f"{alpha_summary(np.stack(alpha_maps))}", flush=True)
                 print(f"[audio] model={model_name} layer={layer} done", flush=True)
+            if pca_tables:
+                save_sweep_table(pca_grid(pca_tables), model_dir / "pca_sweep.csv")
+                print(f"[audio] model={model_name} pca sweep (mean corr):\n{format_pca_grid(pca_tables)}", flush=True)
             print(f"[audio] model done: {model_name}", flush=True)
         print(f"[audio] tr_win done: {tr_win}", flush=True)
 
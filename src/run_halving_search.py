@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+在已提取的 text/audio/multimodal 特征上对 (模型, 层, 窗口) 做 successive halving 搜索.
+先用 run_text_models / run_audio_models / run_multimodal_models 加 --extract-only 只提取特征
+(不加时这些脚本会在提取后拟合全部被试全部层, 搜索就没有意义了), 再运行:
+
+    python -m src.run_text_models --models gpt2 bert-base-uncased --extract-only
+    python -m src.run_audio_models --tr-win 1 2 3 6 --extract-only
+    python -m src.run_halving_search --kinds text audio --min-subjects 3 --eta 2
+
+每轮的保留/淘汰写入 <out-dir>/halving_log.csv, 最终候选的逐被试 corr 张量写入 <out-dir>/final/.
+"""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from src.config import (
+    DEFAULT_ALPHAS,
+    DEFAULT_FIR_OFFSET,
+    DEFAULT_FIR_WINDOW,
+    DEFAULT_KFOLD,
+    DEFAULT_PCA_DIM,
+    RESULTS_ROOT,
+    SUBJECTS,
+)
+from src.corr_store import CorrStore, save_encoding_result
+from src.data import load_fmri
+from src.halving_search import KINDS, Candidate, discover_candidates, n_fits, successive_halving
+from src.modeling import run_cv_multi_subjects
+from src.tracing import add_trace_args, init_from_args, set_tags, trace
+from src.transforms import TransformParams, TransformPipeline
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Successive-halving search over models / layers / windows")
+    parser.add_argument("--kinds", nargs="+", choices=list(KINDS), default=list(KINDS), help="候选类别")
+    parser.add_argument("--models", nargs="+", default=None, help="只搜索这些模型 (结果目录名, 如 gpt2)")
+    parser.add_argument("--settings", nargs="+", default=None, help="只搜索这些窗口 (如 win200 3TR)")
+    parser.add_argument("--layers", nargs="+", type=int, default=None, help="只搜索这些层")
+    parser.add_argument("--min-subjects", type=int, default=3, help="第一轮的被试数")
+    parser.add_argument("--eta", type=int, default=2, help="每轮保留前 1/eta 的候选, 被试数乘以 eta")
+    parser.add_argument("--seed", type=int, default=None, help="打乱被试顺序的随机种子 (默认按 config.SUBJECTS 顺序)")
+    parser.add_argument("--pca-dim", type=int, default=DEFAULT_PCA_DIM, help="PCA 维度")
+    parser.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW, help="FIR 窗口")
+    parser.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET, help="FIR 偏移")
+    parser.add_argument("--implicit-fir", action="store_true",
+                        help="隐式 FIR 设计 (由错位 Gram 块求解, 不生成 window 倍大小的设计矩阵)")
+    parser.add_argument("--out-dir", type=str, default=str(RESULTS_ROOT / "search" / "halving"), help="输出目录")
+    add_trace_args(parser)
+    args = parser.parse_args()
+    if args.eta < 2:
+        parser.error("--eta 至少为 2")
+    return args
+
+
+def main() -> int:
+    args = parse_args()
+    init_from_args("search", args)
+    candidates = discover_candidates(RESULTS_ROOT, args.kinds, args.models, args.settings, args.layers)
+    if not candidates:
+        raise FileNotFoundError("未找到候选特征, 请先用 run_text_models / run_audio_models / run_multimodal_models "
+                                "加 --extract-only 提取特征")
+    fmris = load_fmri()
+    subjects = list(SUBJECTS)
+    if args.seed is not None:
+        subjects = [subjects[i] for i in np.random.default_rng(args.seed).permutation(len(subjects))]
+    transform_params = TransformParams(pca_dim=args.pca_dim, fir_window=args.fir_window,
+                                       fir_offset=args.fir_offset)
+
+    def evaluate(cand: Candidate, new_subjects: list[int]) -> tuple[list[float], np.ndarray]:
+        set_tags(cell=cand.key)
+        with trace("load") as span:
+            features = np.load(cand.path)
+            span.array("features", features)
+        # 标准化/PCA 拟合有磁盘缓存 (results/cache/transforms), 候选在后续轮次重新构建设计矩阵的开销很小
+        fir = TransformPipeline(transform_params).fit_transform(features, implicit=args.implicit_fir)
+        corr_means, corr_maps = run_cv_multi_subjects(
+            X=fir,
+            fmris=fmris,
+            subjects=new_subjects,
+            excluded_start=10,
+            excluded_end=10,
+            alphas=DEFAULT_ALPHAS,
+            kfold=DEFAULT_KFOLD,
+        )
+        return corr_means, corr_maps
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    log_path = out_dir / "halving_log.csv"
+    log_path.unlink(missing_ok=True)
+
+    def on_round(rnd: int, rows: list[dict]) -> None:
+        import pandas as pd
+
+        pd.DataFrame(rows).to_csv(log_path, mode="a", header=not log_path.exists(), index=False)
+        n_pruned = sum(r["status"] == "pruned" for r in rows)
+        best = rows[0]
+        print(f"[search] round {rnd}: n_subjects={rows[0]['n_subjects']} candidates={len(rows)} "
+              f"pruned={n_pruned} best={best['key']} ({best['mean']:.4f})", flush=True)
+
+    print(f"[search] {len(candidates)} candidates, {len(subjects)} subjects, "
+          f"min_subjects={args.min_subjects}, eta={args.eta}", flush=True)
+    survivors, log = successive_halving(candidates, subjects, evaluate,
+                                        min_subjects=args.min_subjects, eta=args.eta, on_round=on_round)
+
+    # 最终候选: 逐被试张量按 config.SUBJECTS 的行顺序保存到搜索目录自己的 store, 不影响常规结果
+    store = CorrStore(out_dir / "corr_store")
+    for cand in survivors:
+        order = [cand.subjects.index(sub) for sub in SUBJECTS]
+        save_encoding_result(out_dir / "final" / cand.kind / cand.model / cand.setting / f"corr_layer{cand.layer}.npy",
+                             np.stack(cand.corr_maps)[order], store=store)
+        print(f"[search] final: {cand.key} mean={cand.score:.4f} ± {np.std(cand.corr_means):.4f}", flush=True)
+
+    full = len(candidates) * len(subjects)
+    print(f"[search] subject fits: {n_fits(log)} (full grid: {full}); log: {log_path}", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
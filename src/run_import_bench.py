@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+记录各入口脚本的 import 耗时, 以及 import 后被加载的重量级依赖.
+
+每个模块在独立的子进程中用 `python -X importtime` 导入, 结果写入 JSON, 便于跨提交对比.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from src.config import PROJECT_ROOT
+
+ENTRY_POINTS = [
+    "src.run_roi_analysis",
+    "src.run_plot_corr_maps",
+    "src.run_summary",
+    "src.corr_store",
+    "src.run_nonlinear_model",
+    "src.run_multimodal_fusion",
+    "src.run_text_models",
+    "src.run_audio_models",
+    "src.run_multimodal_models",
+]
+HEAVY_MODULES = ["torch", "transformers", "sklearn", "librosa", "tqdm", "nibabel", "matplotlib", "pandas"]
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|\s+(?P<name>.+)$")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Import-time benchmark for entry points")
+    parser.add_argument("--modules", nargs="+", default=ENTRY_POINTS, help="要测量的模块")
+    parser.add_argument("--repeat", type=int, default=3, help="每个模块重复次数 (取最小值)")
+    parser.add_argument("--out", type=str, default="results/import_bench.json", help="输出 JSON")
+    return parser.parse_args()
+
+
+def measure(module: str) -> dict:
+    code = (
+        "import json, sys\n"
+        f"import {module}\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=PROJECT_ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"}
+
+    # importtime 输出在 stderr, 取目标模块的累计耗时 (微秒)
+    cumulative_us = None
+    for line in proc.stderr.splitlines():
+        m = _IMPORTTIME_LINE.search(line)
+        if m and m.group("name").strip() == module:
+            cumulative_us = int(m.group("cumulative"))
+    return {
+        "import_s": (cumulative_us or 0) / 1e6,
+        "process_s": wall,
+        "heavy_loaded": json.loads(proc.stdout.strip().splitlines()[-1]),
+    }
+
+
+def main() -> int:
+    args = parse_args()
+    results = {}
+    for module in args.modules:
+        runs = [measure(module) for _ in range(max(1, args.repeat))]
+        ok = [r for r in runs if "error" not in r]
+        if not ok:
+            results[module] = runs[0]
+            print(f"[import] {module}: {runs[0]['error']}", flush=True)
+            continue
+        best = min(ok, key=lambda r: r["import_s"])
+        results[module] = best
+        print(f"[import] {module}: {best['import_s']:.3f}s heavy={','.join(best['heavy_loaded']) or '-'}",
+              flush=True)
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "modules": results,
+    }
+    out_path.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"已保存 import 耗时: {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
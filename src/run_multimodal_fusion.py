@@ -4,25 +4,30 @@ from __future__ import annotations
 import argparse
 from pathlib import Path
 import csv
+import itertools
 import re
 
 import numpy as np
-import torch
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
 
 from src.config import (
     RESULTS_ROOT,
     DEFAULT_PCA_DIM,
     DEFAULT_FIR_WINDOW,
     DEFAULT_FIR_OFFSET,
-    DEFAULT_ALPHAS,
     DEFAULT_KFOLD,
     SUBJECTS,
 )
 from src.data import load_fmri, load_align_df
 from src.text_pipeline import align_word_features_to_tr
-from src.modeling import build_fir, run_cv_multi_subjects, summarize, append_log
+from src.alpha_select import add_alpha_args, alpha_summary, resolve_alphas
+from src.modeling import add_group_args, run_cv_multi_subjects, summarize, append_log
+from src.corr_store import CorrStore, save_encoding_result
+from src.feature_cache import FeatureCache, file_fingerprint
+from src.fir_sweep import format_sweep_table, run_fir_sweep, save_sweep_table
+from src.pca_sweep import run_pca_sweep
+from src.transforms import TransformParams, TransformPipeline
+from src.tracing import add_trace_args, init_from_args, set_tags, trace
+from src.work_queue import add_queue_args, claim_each, grid_name, open_queue
 
 def safe_name(model_name: str) -> str:
     return model_name.replace("/", "_")
@@ -95,11 +100,58 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--pca-dim", type=int, default=DEFAULT_PCA_DIM, help="PCA 维度")
     parser.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW, help="FIR 窗口")
     parser.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET, help="FIR 偏移")
-    return parser.parse_args()
+    parser.add_argument("--implicit-fir", action="store_true",
+                        help="隐式 FIR 设计 (由错位 Gram 块求解, 不生成 window 倍大小的设计矩阵)")
+    parser.add_argument("--fir-windows", nargs="+", type=int, default=None,
+                        help="FIR 窗口扫描列表 (与 --fir-offsets 任一给出时进入扫描模式, 输出 window x offset 表)")
+    parser.add_argument("--fir-offsets", nargs="+", type=int, default=None, help="FIR 偏移扫描列表")
+    parser.add_argument("--pca-dims", nargs="+", type=int, default=None,
+                        help="PCA 维度扫描列表 (一次分解, 输出 layer x pca_dim 表)")
+    parser.add_argument("--cache-mem-gb", type=float, default=4.0,
+                        help="单模态预处理缓存的内存上限 (GB)")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="预处理缓存落盘目录 (默认 results/cache/fusion)")
+    parser.add_argument("--save-predictions", action="store_true",
+                        help="同时保存测试段预测 (float16, pred_*.npz)")
+    add_group_args(parser)
+    add_alpha_args(parser)
+    add_queue_args(parser)
+    add_trace_args(parser)
+    args = parser.parse_args()
+    if args.pca_dims and (args.fir_windows or args.fir_offsets):
+        parser.error("--pca-dims 不能与 --fir-windows/--fir-offsets 同时使用")
+    if args.group_mode and (args.pca_dims or args.fir_windows or args.fir_offsets):
+        parser.error("--group-mode 不能与扫描模式同时使用")
+    if args.alpha_select != "nested" and (args.group_mode or args.pca_dims or args.fir_windows or args.fir_offsets):
+        parser.error("--alpha-select block/gcv 只用于常规逐被试编码, 不能与 --group-mode 或扫描模式同时使用")
+    return args
+
+
+def fusion_paths(ctx_words: int, tr_win: int, text_model: str, audio_model: str,
+                 text_layer: int, audio_layer: int) -> tuple[Path, Path, Path, str]:
+    """一个融合组合的 (文本特征, 音频特征, 输出目录, 层标记)."""
+    text_dir = RESULTS_ROOT / "text" / safe_name(text_model) / f"win{ctx_words}" / "features"
+    audio_dir = RESULTS_ROOT / "audio" / safe_name(audio_model) / f"{tr_win}TR" / "features"
+    text_file = text_dir / f"text_{safe_name(text_model)}_win{ctx_words}_layer{text_layer}_features.npy"
+    audio_file = audio_dir / f"audio_{safe_name(audio_model)}_win{tr_win}TR_layer{audio_layer}_features.npy"
+    out_dir = RESULTS_ROOT / "fusion" / f"{safe_name(text_model)}__{safe_name(audio_model)}"
+    layer_tag = f"t{text_layer}_a{audio_layer}_ctx{ctx_words}_tr{tr_win}"
+    return text_file, audio_file, out_dir, layer_tag
+
+
+def fusion_job(combo: tuple) -> str:
+    _, _, out_dir, layer_tag = fusion_paths(*combo)
+    return f"{out_dir.name}/{layer_tag}"
+
+
+def load_text_tr(text_file: Path, df, n_trs: int) -> np.ndarray:
+    return align_word_features_to_tr(df, np.load(text_file), n_trs, pooling="mean")
 
 
 def main() -> int:
     args = parse_args()
+    alphas = resolve_alphas(args)
+    init_from_args("fusion", args)
     text_models = args.text_models
     audio_models = args.audio_models
     text_layers = args.text_layers
@@ -119,72 +171,119 @@ def main() -> int:
         * len(text_layers)
         * len(audio_layers)
     )
-    existing = list((RESULTS_ROOT / "fusion").rglob("corr_t*_a*_ctx*_tr*.npy"))
-    print(f"[fusion] planned={total_planned} existing={len(existing)}", flush=True)
-
-    for ctx_words in ctx_list:
-        for tr_win in tr_win_list:
-            for text_model in text_models:
-                for audio_model in audio_models:
-                    for text_layer in text_layers:
-                        for audio_layer in audio_layers:
-                            combo_tag = f"ctx={ctx_words} tr={tr_win} text={text_model}@{text_layer} audio={audio_model}@{audio_layer}"
-                            print(f"[fusion] {combo_tag} start", flush=True)
-
-                            text_dir = RESULTS_ROOT / "text" / safe_name(text_model) / f"win{ctx_words}" / "features"
-                            audio_dir = RESULTS_ROOT / "audio" / safe_name(audio_model) / f"{tr_win}TR" / "features"
-
-                            text_file = text_dir / f"text_{safe_name(text_model)}_win{ctx_words}_layer{text_layer}_features.npy"
-                            audio_file = audio_dir / f"audio_{safe_name(audio_model)}_win{tr_win}TR_layer{audio_layer}_features.npy"
-
-                            out_dir = RESULTS_ROOT / "fusion" / f"{safe_name(text_model)}__{safe_name(audio_model)}"
-                            layer_tag = f"t{text_layer}_a{audio_layer}_ctx{ctx_words}_tr{tr_win}"
-                            out_corr = out_dir / f"corr_{layer_tag}.npy"
-                            if out_corr.exists():
-                                print(f"[fusion] skip done: {out_corr}", flush=True)
-                                continue
-
-                            if not text_file.exists() or not audio_file.exists():
-                                print(f"[fusion] skip missing: {text_file} or {audio_file}", flush=True)
-                                continue
-
-                            text_features = np.load(text_file)
-                            audio_features = np.load(audio_file)
-
-                            text_tr = align_word_features_to_tr(df, text_features, n_trs, pooling="mean")
-
-                            scaler_text = StandardScaler()
-                            scaler_audio = StandardScaler()
-                            text_std = scaler_text.fit_transform(text_tr)
-                            audio_std = scaler_audio.fit_transform(audio_features)
-
-                            fused = np.concatenate([text_std, audio_std], axis=1)
-                            if args.pca_dim and args.pca_dim < fused.shape[1]:
-                                pca = PCA(n_components=args.pca_dim)
-                                fused = pca.fit_transform(fused)
-
-                            fir = build_fir(fused, window=args.fir_window, offset=args.fir_offset)
-                            corr_means, corr_map = run_cv_multi_subjects(
-                                X=fir,
-                                fmris=fmris,
-                                subjects=SUBJECTS,
-                                excluded_start=10,
-                                excluded_end=10,
-                                alphas=DEFAULT_ALPHAS,
-                                kfold=DEFAULT_KFOLD,
-                            )
-
-                            out_dir.mkdir(parents=True, exist_ok=True)
-                            log_path = out_dir / "log.txt"
-                            stats = summarize(corr_means)
-                            with log_path.open("a", encoding="utf-8") as f:
-                                f.write(f"text_model={text_model}, audio_model={audio_model}, text_layer={text_layer}, audio_layer={audio_layer}, ctx_words={ctx_words}, tr_win={tr_win}\n")
-                                f.write(f"层标记: {layer_tag}\n")
-                                f.write(f"平均值: {stats.mean:.4f} ± {stats.std:.4f}\n")
-                                f.write(f"范围: [{stats.min:.4f}, {stats.max:.4f}]\n")
-                                f.write(f"中位数: {stats.median:.4f}\n\n")
-                            np.save(out_corr, corr_map)
-                            print(f"[fusion] {combo_tag} done", flush=True)
+    store = CorrStore()
+    if store.exists():
+        index = store.index()
+        # 只统计常规结果 (group-*/ alpha-*/ 的 tag 带子目录前缀)
+        n_existing = int(((index["kind"] == "fusion") & ~index["tag"].str.contains("/")).sum())
+    else:
+        n_existing = len(list((RESULTS_ROOT / "fusion").rglob("corr_t*_a*_ctx*_tr*.npy")))
+    print(f"[fusion] planned={total_planned} existing={n_existing}", flush=True)
+    fir_sweep = bool(args.fir_windows or args.fir_offsets)
+    sweep = fir_sweep or bool(args.pca_dims)
+
+    # 每个 (模态, 模型, 层, 窗口) 的 TR 对齐矩阵只计算一次, 内层循环只做拼接与拟合
+    cache_dir = Path(args.cache_dir) if args.cache_dir else RESULTS_ROOT / "cache" / "fusion"
+    cache = FeatureCache(max_bytes=int(args.cache_mem_gb * 2**30), spill_dir=cache_dir)
+    # 按列标准化拼接后的特征等价于两个模态分别标准化, 与其他脚本一样由流水线完成 标准化 -> PCA -> FIR
+    transform_params = TransformParams(pca_dim=args.pca_dim,
+                                       fir_window=args.fir_window, fir_offset=args.fir_offset)
+
+    combos = list(itertools.product(ctx_list, tr_win_list, text_models, audio_models, text_layers, audio_layers))
+    queue = open_queue(args.work_dir, grid_name("fusion", args), ttl=args.lease_ttl)
+    if queue is not None:
+        # 多机模式: 输入特征尚未生成的组合不进入队列, 否则会被当作已完成
+        ready = [c for c in combos if all(p.exists() for p in fusion_paths(*c)[:2])]
+        if len(ready) < len(combos):
+            print(f"[fusion] {len(combos) - len(ready)} combos waiting for features, not queued", flush=True)
+        combos = ready
+
+    for combo in claim_each(queue, combos, key=fusion_job):
+        ctx_words, tr_win, text_model, audio_model, text_layer, audio_layer = combo
+        combo_tag = f"ctx={ctx_words} tr={tr_win} text={text_model}@{text_layer} audio={audio_model}@{audio_layer}"
+        print(f"[fusion] {combo_tag} start", flush=True)
+        set_tags(text_model=text_model, text_layer=text_layer, audio_model=audio_model,
+                 audio_layer=audio_layer, ctx_words=ctx_words, tr_win=tr_win)
+
+        text_file, audio_file, out_dir, layer_tag = fusion_paths(*combo)
+        # 群体模式 / 闭式 alpha 选择的结果单独存放, 不覆盖常规结果 (corr store 中以子目录名为 tag)
+        fit_dir = out_dir / f"group-{args.group_mode}" if args.group_mode else out_dir
+        if args.alpha_select != "nested":
+            fit_dir = out_dir / f"alpha-{args.alpha_select}"
+        out_corr = fit_dir / f"corr_{layer_tag}.npy"
+        if out_corr.exists() and not sweep:
+            print(f"[fusion] skip done: {out_corr}", flush=True)
+            continue
+
+        if not text_file.exists() or not audio_file.exists():
+            print(f"[fusion] skip missing: {text_file} or {audio_file}", flush=True)
+            continue
+
+        with trace("load") as span:
+            text_tr = cache.get(
+                ("text-tr", text_model, text_layer, ctx_words, n_trs),
+                lambda: load_text_tr(text_file, df, n_trs),
+                fingerprint=file_fingerprint(text_file),
+            )
+            audio_tr = cache.get(
+                ("audio-tr", audio_model, audio_layer, tr_win),
+                lambda: np.load(audio_file),
+                fingerprint=file_fingerprint(audio_file),
+            )
+            fused = np.concatenate([text_tr, audio_tr], axis=1)
+            span.array("fused", fused)
+        if args.pca_dims:
+            table = run_pca_sweep(
+                fused, fmris, SUBJECTS, args.pca_dims, transform_params,
+                excluded_start=10, excluded_end=10,
+                alphas=alphas, kfold=DEFAULT_KFOLD,
+            )
+            save_sweep_table(table, out_dir / f"pca_sweep_{layer_tag}.csv")
+            print(f"[fusion] {combo_tag} pca sweep (mean corr):\n{table.to_string(index=False)}", flush=True)
+            continue
+        if fir_sweep:
+            reduced = TransformPipeline(transform_params).fit_reduce(fused)
+            table = run_fir_sweep(
+                reduced, fmris, SUBJECTS,
+                windows=args.fir_windows or [args.fir_window],
+                offsets=args.fir_offsets or [args.fir_offset],
+                excluded_start=10, excluded_end=10,
+                alphas=alphas, kfold=DEFAULT_KFOLD,
+            )
+            save_sweep_table(table, out_dir / f"fir_sweep_{layer_tag}.csv")
+            print(f"[fusion] {combo_tag} fir sweep (mean corr):\n{format_sweep_table(table)}", flush=True)
+            continue
+
+        fir = TransformPipeline(transform_params).fit_transform(fused, implicit=args.implicit_fir)
+        alpha_maps: list[np.ndarray] = []
+        corr_means, corr_maps, *held_out = run_cv_multi_subjects(
+            X=fir,
+            fmris=fmris,
+            subjects=SUBJECTS,
+            excluded_start=10,
+            excluded_end=10,
+            alphas=alphas,
+            kfold=DEFAULT_KFOLD,
+            group_mode=args.group_mode,
+            keep_predictions=args.save_predictions,
+            alpha_select=args.alpha_select,
+            alpha_maps=alpha_maps,
+        )
+
+        fit_dir.mkdir(parents=True, exist_ok=True)
+        log_path = fit_dir / "log.txt"
+        stats = summarize(corr_means)
+        with log_path.open("a", encoding="utf-8") as f:
+            f.write(f"text_model={text_model}, audio_model={audio_model}, text_layer={text_layer}, audio_layer={audio_layer}, ctx_words={ctx_words}, tr_win={tr_win}\n")
+            f.write(f"层标记: {layer_tag}\n")
+            f.write(f"平均值: {stats.mean:.4f} ± {stats.std:.4f}\n")
+            f.write(f"范围: [{stats.min:.4f}, {stats.max:.4f}]\n")
+            f.write(f"中位数: {stats.median:.4f}\n\n")
+        save_encoding_result(out_corr, corr_maps, store=store, predictions=held_out[0] if held_out else None,
+                             alphas=np.stack(alpha_maps) if alpha_maps else None)
+        if alpha_maps:
+            print(f"[fusion] {combo_tag} alphas ({args.alpha_select}): {alpha_summary(np.stack(alpha_maps))}", flush=True)
+        print(f"[fusion] {combo_tag} done ({cache.stats()})", flush=True)
 
     return 0
 
@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import argparse
 from collections import defaultdict
+from pathlib import Path
 
 import numpy as np
 import torch
@@ -17,13 +18,23 @@ from src.config import (
     DEFAULT_PCA_DIM,
     DEFAULT_FIR_WINDOW,
     DEFAULT_FIR_OFFSET,
-    DEFAULT_ALPHAS,
     DEFAULT_KFOLD,
     SUBJECTS,
 )
-from src.data import load_fmri, load_audio, load_align_df
-from src.audio_pipeline import chunk_audio, save_layer_features
-from src.modeling import build_fir, run_cv_multi_subjects, summarize, append_log
+from src.data import load_fmri, load_fmri_vertices, load_audio, load_align_df
+from src.dedup import Dedup, array_key
+from src.audio_pipeline import AudioChunks, lazy_chunk_audio, save_layer_features
+from src.alpha_select import add_alpha_args, alpha_summary, resolve_alphas
+from src.modeling import add_group_args, run_cv_multi_subjects, summarize, append_log
+from src.fir_sweep import format_sweep_table, run_fir_sweep, save_sweep_table
+from src.pca_sweep import format_pca_grid, pca_grid, run_pca_sweep
+from src.transforms import TransformParams, TransformPipeline, array_digest
+from src.corr_store import group_mean_map, save_encoding_result
+from src.extract_checkpoint import DEFAULT_CHECKPOINT_EVERY, ExtractionCheckpoint, digest_strings, open_checkpoint
+from src.vertex_encoding import DEFAULT_BLOCK_SIZE, run_cv_multi_subjects_chunked
+from src.tower_cache import DEFAULT_TOWER_CACHE_DIR, TowerCache, chunks_digest, text_digest
+from src.tracing import add_trace_args, init_from_args, set_tags, trace
+from src.work_queue import add_queue_args, claim_each, grid_name, open_queue
 
 
 def safe_name(model_name: str) -> str:
@@ -74,6 +85,13 @@ def build_tr_text_windows(tr_texts: list[str], tr_win: int) -> list[str]:
     return windows
 
 
+def window_setting(tr_win: int, text_tr_win: int) -> str:
+    """结果目录名: 文本与音频窗口相同时为 <tr_win>TR, 否则为 <tr_win>TR-text<text_tr_win>TR."""
+    if text_tr_win == tr_win:
+        return f"{tr_win}TR"
+    return f"{tr_win}TR-text{text_tr_win}TR"
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Multimodal models pipeline (audio + text)")
     parser.add_argument(
@@ -93,6 +111,14 @@ def parse_args() -> argparse.Namespace:
         default=[1, 2, 3, 6],
         help="TR窗口列表",
     )
+    parser.add_argument(
+        "--text-tr-win",
+        nargs="+",
+        type=int,
+        default=None,
+        help="文本窗口列表 (TR 数), 与 --tr-win 逐一组合; 默认与音频窗口相同. "
+             "CLAP 只换文本窗口时音频塔直接读缓存",
+    )
     parser.add_argument(
         "--layers",
         nargs="+",
@@ -106,17 +132,134 @@ def parse_args() -> argparse.Namespace:
                         help="时间维 pooling 方式")
     parser.add_argument("--batch-size", type=int, default=16, help="特征提取 batch size")
     parser.add_argument("--autocast", action="store_true", help="使用 autocast")
+    parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                        help="特征提取每多少个 batch 落盘一次 (中断后重跑同一命令从断点继续), 0 表示不落盘")
     parser.add_argument("--pca-dim", type=int, default=DEFAULT_PCA_DIM, help="PCA 维度")
     parser.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW, help="FIR 窗口")
     parser.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET, help="FIR 偏移")
+    parser.add_argument("--implicit-fir", action="store_true",
+                        help="隐式 FIR 设计 (由错位 Gram 块求解, 不生成 window 倍大小的设计矩阵)")
+    parser.add_argument("--fir-windows", nargs="+", type=int, default=None,
+                        help="FIR 窗口扫描列表 (与 --fir-offsets 任一给出时进入扫描模式, 输出 window x offset 表)")
+    parser.add_argument("--fir-offsets", nargs="+", type=int, default=None, help="FIR 偏移扫描列表")
+    parser.add_argument("--pca-dims", nargs="+", type=int, default=None,
+                        help="PCA 维度扫描列表 (一次分解, 输出 layer x pca_dim 表)")
+    parser.add_argument("--targets", choices=["roi", "vertex"], default="roi",
+                        help="编码目标: roi (默认) 或 vertex (顶点级, 分块求解, 结果写入 <model_dir>/vertex/)")
+    parser.add_argument("--vertex-dir", type=str, default=None,
+                        help="顶点级 fMRI 目录 (默认 data/raw/vertices, 每个被试一个 sub-<id>.npy)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="顶点级编码每块的目标列数")
     parser.add_argument("--log-file", type=str, default="log.txt", help="日志文件名")
+    parser.add_argument("--save-predictions", action="store_true",
+                        help="同时保存测试段预测 (float16, pred_layer*.npz)")
+    parser.add_argument("--extract-only", action="store_true",
+                        help="只提取并保存特征 (features/), 不拟合; 之后用 run_halving_search 在这些特征上搜索")
+    add_group_args(parser)
+    add_alpha_args(parser)
+    add_queue_args(parser)
+    add_trace_args(parser)
+    parser.add_argument("--tower-cache-dir", type=str, default=str(DEFAULT_TOWER_CACHE_DIR),
+                        help="双塔模型 (CLAP) 逐塔特征缓存目录, 只有输入变化的塔重新前向")
+    parser.add_argument("--no-tower-cache", action="store_true", help="CLAP 不使用逐塔缓存 (两塔每次联合前向)")
     parser.add_argument("--trust-remote-code", action="store_true", help="使用 trust_remote_code")
     parser.add_argument("--save-aligned", action="store_true", help="保存对齐后的TR特征")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.extract_only and (args.pca_dims or args.fir_windows or args.fir_offsets or args.group_mode
+                              or args.alpha_select != "nested" or args.save_predictions):
+        parser.error("--extract-only 不拟合, 不能与扫描模式、--group-mode、--alpha-select 或 --save-predictions 同时使用")
+    if args.pca_dims and (args.fir_windows or args.fir_offsets):
+        parser.error("--pca-dims 不能与 --fir-windows/--fir-offsets 同时使用")
+    if args.targets == "vertex" and (args.pca_dims or args.fir_windows or args.fir_offsets):
+        parser.error("扫描模式只支持 --targets roi")
+    if args.group_mode and (args.pca_dims or args.fir_windows or args.fir_offsets or args.targets == "vertex"):
+        parser.error("--group-mode 只用于常规 ROI 编码, 不能与扫描模式或 --targets vertex 同时使用")
+    if args.save_predictions and args.targets == "vertex":
+        parser.error("--save-predictions 只支持 --targets roi")
+    if args.alpha_select != "nested" and (args.group_mode or args.pca_dims or args.fir_windows or args.fir_offsets or args.targets == "vertex"):
+        parser.error("--alpha-select block/gcv 只用于常规逐被试 ROI 编码, 不能与 --group-mode、扫描模式或 --targets vertex 同时使用")
+    return args
+
+
+def tower_layers(model: torch.nn.Module, layers: list[int]) -> list[int]:
+    """双塔模型实际提取的层: 两个塔都有的层 (hidden_states 下标), 都不在范围内时取两塔共有的最后一层."""
+    cfg = model.config
+    n_text = int(cfg.text_config.num_hidden_layers) + 1
+    n_audio = len(cfg.audio_config.depths) + 1
+    max_common = min(n_text, n_audio) - 1
+    return [l for l in layers if 0 <= l <= max_common] or [max_common]
+
+
+def _pool_states(state: torch.Tensor, mask: torch.Tensor | None) -> torch.Tensor:
+    """沿第 1 维做 (带 mask 的) 平均, 多余的维度继续平均, 得到 [batch, hidden]."""
+    if mask is not None and mask.shape[1] == state.shape[1]:
+        mask = mask.unsqueeze(-1)
+        pooled = (state * mask).sum(dim=1) / mask.sum(dim=1)
+    else:
+        pooled = state.mean(dim=1)
+    while pooled.dim() > 2:
+        pooled = pooled.mean(dim=1)
+    return pooled
 
 
 @torch.inference_mode()
-def extract_multimodal_layers(audio_chunks: torch.Tensor,
+def extract_tower_layers(tower: str,
+                         items: list[str] | torch.Tensor | AudioChunks,
+                         processor,
+                         model: torch.nn.Module,
+                         layers: list[int],
+                         device: torch.device,
+                         batch_size: int,
+                         autocast: bool,
+                         sampling_rate: int,
+                         checkpoint: ExtractionCheckpoint | None = None) -> dict[int, np.ndarray]:
+    """
+    双塔模型 (CLAP) 单个塔的逐层 pooled 特征, 与联合前向时该塔的结果相同.
+
+    Parameters
+    ----------
+        tower : text (items 为 TR 文本窗口) 或 audio (items 为音频 chunk)
+        layers : hidden_states 下标, 须在该塔范围内 (见 tower_layers)
+        checkpoint : 断点续跑, 为 None 时全部结果保留在内存中
+    """
+    # 空的 / 重复的文本窗口与补齐的音频 chunk 只前向一次
+    dedup = Dedup(items[i] if tower == "text" else array_key(items[i]) for i in range(len(items)))
+    print(f"[dedup] {tower} tower: {dedup.summary()}", flush=True)
+    n_batches = (dedup.n_unique + batch_size - 1) // batch_size
+    start = checkpoint.begin(n_batches, batch_size) if checkpoint is not None else 0
+    hidden_states = defaultdict(list)
+
+    for idx in range(start, n_batches):
+        if (idx + 1) % 10 == 0 or idx == start:
+            print(f"[multimodal] {tower} tower batch {idx + 1}/{n_batches}", flush=True)
+        batch_idx = dedup.unique[idx * batch_size:(idx + 1) * batch_size]
+        if tower == "text":
+            inputs = processor.tokenizer([items[i] for i in batch_idx], padding=True, truncation=True,
+                                         return_tensors="pt")
+            forward = model.text_model
+        else:
+            audio_arrays = [np.asarray(items[i], dtype=np.float32) for i in batch_idx]
+            feature_extractor = getattr(processor, "feature_extractor", processor)
+            inputs = feature_extractor(audio_arrays, sampling_rate=sampling_rate, return_tensors="pt",
+                                       padding=True, truncation=True)
+            forward = model.audio_model
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with torch.autocast(device_type='cuda' if 'cuda' in str(device) else 'cpu',
+                            dtype=torch.bfloat16, enabled=autocast):
+            states = forward(**inputs, output_hidden_states=True).hidden_states
+
+        # 音频塔的 hidden state 为 [batch, channel, freq, time], 不使用 mask
+        mask = inputs.get("attention_mask") if tower == "text" else None
+        for layer_idx in layers:
+            hidden_states[layer_idx].append(_pool_states(states[layer_idx], mask).cpu().float().numpy())
+        if checkpoint is not None:
+            checkpoint.step(idx, hidden_states)
+
+    if checkpoint is not None:
+        return dedup.scatter(checkpoint.finalize(hidden_states))
+    return dedup.scatter({layer_idx: np.concatenate(states, axis=0) for layer_idx, states in hidden_states.items()})
+
+
+def extract_dual_tower_layers(audio_chunks: torch.Tensor | AudioChunks,
                               text_windows: list[str],
                               processor,
                               model: torch.nn.Module,
@@ -124,14 +267,48 @@ def extract_multimodal_layers(audio_chunks: torch.Tensor,
                               device: torch.device,
                               batch_size: int,
                               autocast: bool,
-                              sampling_rate: int) -> dict[int, np.ndarray]:
+                              sampling_rate: int,
+                              tower_cache: TowerCache) -> dict[int, np.ndarray]:
+    """双塔模型的多模态特征: 两个塔分别经 tower_cache 取得 (只重算输入变化的塔), 再逐层拼接 [audio, text]."""
+    layers = tower_layers(model, layers)
+
+    def compute(tower: str, items):
+        return lambda missing, checkpoint: extract_tower_layers(
+            tower, items, processor, model, missing, device, batch_size, autocast, sampling_rate, checkpoint)
+
+    text_feats = tower_cache.get("text", text_digest(text_windows), layers, compute("text", text_windows))
+    audio_feats = tower_cache.get("audio", chunks_digest(audio_chunks, sampling_rate), layers,
+                                  compute("audio", audio_chunks))
+    return {layer: np.concatenate([audio_feats[layer], text_feats[layer]], axis=1) for layer in layers}
+
+
+@torch.inference_mode()
+def extract_multimodal_layers(audio_chunks: torch.Tensor | AudioChunks,
+                              text_windows: list[str],
+                              processor,
+                              model: torch.nn.Module,
+                              layers: list[int],
+                              device: torch.device,
+                              batch_size: int,
+                              autocast: bool,
+                              sampling_rate: int,
+                              checkpoint: ExtractionCheckpoint | None = None,
+                              tower_cache: TowerCache | None = None) -> dict[int, np.ndarray]:
     if isinstance(layers, int):
         layers = [layers]
+    if tower_cache is not None and getattr(model.config, "model_type", "") == "clap":
+        return extract_dual_tower_layers(audio_chunks, text_windows, processor, model, layers, device,
+                                         batch_size, autocast, sampling_rate, tower_cache)
 
-    indices = list(range(len(text_windows)))
+    # (音频 chunk, 文本窗口) 两者都相同的 TR 只前向一次
+    dedup = Dedup((array_key(audio_chunks[i]), text_windows[i]) for i in range(len(text_windows)))
+    print(f"[dedup] multimodal: {dedup.summary()}", flush=True)
+    n_batches = (dedup.n_unique + batch_size - 1) // batch_size
+    start = checkpoint.begin(n_batches, batch_size) if checkpoint is not None else 0
+    indices = dedup.unique[start * batch_size:].tolist()
 
     def collate_fn(batch_idx: list[int]):
-        audio_arrays = [audio_chunks[i].numpy().astype(np.float32) for i in batch_idx]
+        audio_arrays = [np.asarray(audio_chunks[i], dtype=np.float32) for i in batch_idx]
         texts = [text_windows[i] for i in batch_idx]
         return audio_arrays, texts
 
@@ -141,9 +318,9 @@ def extract_multimodal_layers(audio_chunks: torch.Tensor,
     is_whisper = getattr(model.config, "model_type", "") == "whisper"
     has_dual = hasattr(model, "get_text_features") and hasattr(model, "get_audio_features")
 
-    for idx, (audio_arrays, texts) in enumerate(dataloader):
-        if (idx + 1) % 10 == 0 or idx == 0:
-            print(f"[multimodal] batch {idx + 1}/{len(dataloader)}", flush=True)
+    for idx, (audio_arrays, texts) in enumerate(dataloader, start=start):
+        if (idx + 1) % 10 == 0 or idx == start:
+            print(f"[multimodal] batch {idx + 1}/{n_batches}", flush=True)
         if is_whisper:
             audio_inputs = processor(
                 audio_arrays,
@@ -222,6 +399,8 @@ def extract_multimodal_layers(audio_chunks: torch.Tensor,
                     raise ValueError("Model does not expose hidden states; only layer 0 is supported.")
                 fused = torch.cat([text_feat, audio_feat], dim=-1)
                 hidden_states[0].append(fused.cpu().float().numpy())
+                if checkpoint is not None:
+                    checkpoint.step(idx, hidden_states)
                 continue
 
             text_mask = batch.get("attention_mask", None)
@@ -266,29 +445,50 @@ def extract_multimodal_layers(audio_chunks: torch.Tensor,
                 hidden_states[layer_idx].append(fused.cpu().float().numpy())
         else:
             raise ValueError("Model does not support multimodal (audio+text) features.")
+        if checkpoint is not None:
+            checkpoint.step(idx, hidden_states)
 
-    return {layer_idx: np.concatenate(states, axis=0) for layer_idx, states in hidden_states.items()}
+    if checkpoint is not None:
+        return dedup.scatter(checkpoint.finalize(hidden_states))
+    return dedup.scatter({layer_idx: np.concatenate(states, axis=0) for layer_idx, states in hidden_states.items()})
 
 
 def main() -> int:
     args = parse_args()
-    fmris = load_fmri()
+    alphas = resolve_alphas(args)
+    init_from_args("multimodal", args)
+    if args.targets == "vertex":
+        fmris = load_fmri_vertices(Path(args.vertex_dir) if args.vertex_dir else None)
+    else:
+        fmris = load_fmri()
     wav, sr = load_audio(sr=AUDIO_SR)
+    wav_digest = array_digest(wav) if args.checkpoint_every > 0 else ""
     df = load_align_df()
     n_trs = fmris[75].shape[0]
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    transform_params = TransformParams(pca_dim=args.pca_dim, fir_window=args.fir_window,
+                                       fir_offset=args.fir_offset)
+    queue = open_queue(args.work_dir, grid_name("multimodal", args), ttl=args.lease_ttl)
 
     tr_texts = build_tr_texts(df, n_trs)
 
-    for tr_win in args.tr_win:
-        print(f"[multimodal] tr_win start: {tr_win}", flush=True)
-        text_windows = build_tr_text_windows(tr_texts, tr_win)
+    # 音频窗口 (chunk) 与文本窗口分别给出, 双塔模型可以固定一个塔的输入只扫描另一个
+    windows = [(tr_win, text_tr_win) for tr_win in args.tr_win for text_tr_win in (args.text_tr_win or [tr_win])]
+    for tr_win, text_tr_win in windows:
+        setting = window_setting(tr_win, text_tr_win)
+        print(f"[multimodal] tr_win start: {tr_win} (text {text_tr_win})", flush=True)
+        text_windows = build_tr_text_windows(tr_texts, text_tr_win)
 
-        for model_name in args.models:
+        for model_name in claim_each(queue, args.models, key=lambda m: f"{safe_name(m)}/{setting}"):
             print(f"[multimodal] model start: {model_name}", flush=True)
-            model_dir = RESULTS_ROOT / "multimodal" / safe_name(model_name) / f"{tr_win}TR"
+            set_tags(model=model_name, layer=None, tr_win=tr_win, text_tr_win=text_tr_win)
+            model_dir = RESULTS_ROOT / "multimodal" / safe_name(model_name) / setting
             feature_dir = model_dir / "features"
-            log_path = model_dir / args.log_file
+            # 群体模式 / 闭式 alpha 选择的结果单独存放, 不覆盖常规结果 (corr store 中以子目录名为 tag)
+            fit_dir = model_dir / f"group-{args.group_mode}" if args.group_mode else model_dir
+            if args.alpha_select != "nested":
+                fit_dir = model_dir / f"alpha-{args.alpha_select}"
+            log_path = fit_dir / args.log_file
 
             try:
                 processor = AutoProcessor.from_pretrained(model_name, trust_remote_code=args.trust_remote_code)
@@ -304,50 +504,121 @@ def main() -> int:
             if model_type == "clap":
                 sr_use = 48000
                 wav_use = librosa.resample(wav, orig_sr=sr, target_sr=sr_use)
-            audio_chunks_use = chunk_audio(wav_use, sr_use, n_trs=n_trs, tr_seconds=TR_SECONDS, tr_win=tr_win)
-
-            layer_features = extract_multimodal_layers(
-                audio_chunks=audio_chunks_use,
-                text_windows=text_windows,
-                processor=processor,
-                model=model,
-                layers=layers,
-                device=device,
-                batch_size=args.batch_size,
-                autocast=args.autocast,
-                sampling_rate=sr_use,
-            )
+            audio_chunks_use = lazy_chunk_audio(wav_use, sr_use, n_trs=n_trs, tr_seconds=TR_SECONDS, tr_win=tr_win)
+
+            # CLAP 的两个塔各自缓存 (断点也按塔保存), 其他模型按 batch 断点续跑
+            tower_cache = None
+            if model_type == "clap" and not args.no_tower_cache:
+                tower_cache = TowerCache(args.tower_cache_dir, model_name, autocast=args.autocast,
+                                         every=args.checkpoint_every)
+                checkpoint = None
+            else:
+                checkpoint = open_checkpoint(feature_dir, {
+                    "model": model_name, "layers": list(layers), "autocast": args.autocast,
+                    "tr_win": tr_win, "sr": sr_use, "wav": wav_digest, "texts": digest_strings([text_windows]),
+                }, args.checkpoint_every)
+            with trace("extract") as span:
+                layer_features = extract_multimodal_layers(
+                    audio_chunks=audio_chunks_use,
+                    text_windows=text_windows,
+                    processor=processor,
+                    model=model,
+                    layers=layers,
+                    device=device,
+                    batch_size=args.batch_size,
+                    autocast=args.autocast,
+                    sampling_rate=sr_use,
+                    checkpoint=checkpoint,
+                    tower_cache=tower_cache,
+                )
+                span.set(n_layers=len(layer_features))
             save_layer_features(layer_features, feature_dir,
-                                prefix=f"multimodal_{safe_name(model_name)}_win{tr_win}TR")
+                                prefix=f"multimodal_{safe_name(model_name)}_win{setting}")
+            if checkpoint is not None:
+                checkpoint.clear()
 
+            pca_tables = {}
             for layer, features in layer_features.items():
                 print(f"[multimodal] model={model_name} layer={layer} start", flush=True)
+                set_tags(layer=layer)
                 if args.save_aligned:
                     np.save(model_dir / f"aligned_layer{layer}.npy", features)
-                features_std = (features - features.mean(0)) / (features.std(0) + 1e-8)
-                pca_features = features_std
-                if args.pca_dim and args.pca_dim < features.shape[1]:
-                    from sklearn.decomposition import PCA
-                    pca = PCA(n_components=args.pca_dim)
-                    pca_features = pca.fit_transform(features_std)
-
-                fir = build_fir(pca_features, window=args.fir_window, offset=args.fir_offset)
-
-                corr_means, corr_map = run_cv_multi_subjects(
+                if args.extract_only:
+                    print(f"[multimodal] model={model_name} layer={layer} features saved", flush=True)
+                    continue
+                if args.pca_dims:
+                    table = run_pca_sweep(
+                        features, fmris, SUBJECTS, args.pca_dims, transform_params,
+                        excluded_start=10, excluded_end=10,
+                        alphas=alphas, kfold=DEFAULT_KFOLD,
+                    )
+                    save_sweep_table(table, model_dir / f"pca_sweep_layer{layer}.csv")
+                    pca_tables[layer] = table
+                    print(f"[multimodal] model={model_name} layer={layer} pca sweep done", flush=True)
+                    continue
+
+                if args.fir_windows or args.fir_offsets:
+                    reduced = TransformPipeline(transform_params).fit_reduce(features)
+                    table = run_fir_sweep(
+                        reduced, fmris, SUBJECTS,
+                        windows=args.fir_windows or [args.fir_window],
+                        offsets=args.fir_offsets or [args.fir_offset],
+                        excluded_start=10, excluded_end=10,
+                        alphas=alphas, kfold=DEFAULT_KFOLD,
+                    )
+                    save_sweep_table(table, model_dir / f"fir_sweep_layer{layer}.csv")
+                    print(f"[multimodal] model={model_name} layer={layer} fir sweep (mean corr):\n{format_sweep_table(table)}", flush=True)
+                    continue
+
+                fir = TransformPipeline(transform_params).fit_transform(features, implicit=args.implicit_fir)
+
+                if args.targets == "vertex":
+                    vertex_dir = model_dir / "vertex"
+                    corr_means, corr_maps = run_cv_multi_subjects_chunked(
+                        X=fir,
+                        fmris=fmris,
+                        subjects=SUBJECTS,
+                        excluded_start=10,
+                        excluded_end=10,
+                        alphas=alphas,
+                        kfold=DEFAULT_KFOLD,
+                        out_path=vertex_dir / f"corr_subjects_layer{layer}.npy",
+                        block_size=args.block_size,
+                    )
+                    append_log(vertex_dir / args.log_file, layer, summarize(corr_means))
+                    # 与 ROI 结果一致, corr_layer 为群体平均 map; 全部被试见 corr_subjects_layer
+                    np.save(vertex_dir / f"corr_layer{layer}.npy", group_mean_map(corr_maps))
+                    print(f"[multimodal] model={model_name} layer={layer} vertex done", flush=True)
+                    continue
+
+                alpha_maps: list[np.ndarray] = []
+                corr_means, corr_maps, *held_out = run_cv_multi_subjects(
                     X=fir,
                     fmris=fmris,
                     subjects=SUBJECTS,
                     excluded_start=10,
                     excluded_end=10,
-                    alphas=DEFAULT_ALPHAS,
+                    alphas=alphas,
                     kfold=DEFAULT_KFOLD,
+                    group_mode=args.group_mode,
+                    keep_predictions=args.save_predictions,
+                    alpha_select=args.alpha_select,
+                    alpha_maps=alpha_maps,
                 )
                 stats = summarize(corr_means)
                 append_log(log_path, layer, stats)
-                np.save(model_dir / f"corr_layer{layer}.npy", corr_map)
+                save_encoding_result(fit_dir / f"corr_layer{layer}.npy", corr_maps,
+                                     predictions=held_out[0] if held_out else None,
+                                     alphas=np.stack(alpha_maps) if alpha_maps else None)
+                if alpha_maps:
+                    print(f"[multimodal] model={model_name} layer={layer} alphas ({args.alpha_select}): "
+                          f"{alpha_summary(np.stack(alpha_maps))}", flush=True)
                 print(f"[multimodal] model={model_name} layer={layer} done", flush=True)
+            if pca_tables:
+                save_sweep_table(pca_grid(pca_tables), model_dir / "pca_sweep.csv")
+                print(f"[multimodal] model={model_name} pca sweep (mean corr):\n{format_pca_grid(pca_tables)}", flush=True)
             print(f"[multimodal] model done: {model_name}", flush=True)
-        print(f"[multimodal] tr_win done: {tr_win}", flush=True)
+        print(f"[multimodal] tr_win done: {tr_win} (text {text_tr_win})", flush=True)
 
     return 0
 
@@ -10,8 +10,11 @@ from sklearn.kernel_ridge import KernelRidge
 from sklearn.model_selection import KFold
 
 from src.config import DEFAULT_FIR_WINDOW, DEFAULT_FIR_OFFSET, DEFAULT_KFOLD, SUBJECTS
+from src.corr_kernel import batched_corr
 from src.data import load_fmri
-from src.modeling import build_fir
+from src.modeling import add_group_args, group_alpha_scale
+from src.transforms import TransformParams, TransformPipeline
+from src.tracing import add_trace_args, init_from_args, set_tags, trace
 from src.utils import corr_with_np
 
 
@@ -25,11 +28,14 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW)
     parser.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET)
     parser.add_argument("--out", type=str, default="results/nonlinear/log.txt")
+    add_group_args(parser)
+    add_trace_args(parser)
     return parser.parse_args()
 
 
 def main() -> int:
     args = parse_args()
+    init_from_args("nonlinear", args)
     fmris = load_fmri()
     if args.aligned_features:
         feature_paths = [Path(p) for p in args.aligned_features]
@@ -47,48 +53,87 @@ def main() -> int:
 
     out_path = Path(args.out)
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    # 核岭回归直接使用对齐后的原始特征: 不做标准化与 PCA, 只构建 FIR
+    transform_params = TransformParams(standardize=False, pca_dim=None,
+                                       fir_window=args.fir_window, fir_offset=args.fir_offset)
 
     for feat_path in feature_paths:
         print(f"[nonlinear] features: {feat_path}", flush=True)
+        set_tags(features=feat_path.as_posix())
         features = np.load(feat_path)
-        X = build_fir(features, window=args.fir_window, offset=args.fir_offset)
+        X = TransformPipeline(transform_params).fit_transform(features)
         X = X[excluded_start:-excluded_end]
 
+        if args.group_mode:
+            corr_means = fit_group(X, fmris, excluded_start, excluded_end, kfold, args)
+            write_log(out_path, feat_path, args, corr_means)
+            continue
+
         corr_means = []
         for sub in SUBJECTS:
             print(f"[nonlinear] subject start: {sub}", flush=True)
-            y = fmris[sub][excluded_start:-excluded_end]
-            if kfold is None:
-                n = X.shape[0]
-                split = int(n * 0.8)
-                if split <= 0 or split >= n:
-                    raise ValueError("样本量不足以划分训练/测试集。")
-                model = KernelRidge(alpha=args.alpha, kernel=args.kernel, gamma=args.gamma)
-                model.fit(X[:split], y[:split])
-                y_pred = model.predict(X[split:])
-                corr = corr_with_np(y_pred, y[split:])
-                corr_means.append(float(np.nanmean(corr)))
-            else:
-                fold_corrs = []
-                for train_idx, test_idx in kfold.split(X):
+            with trace("fit", subject=sub):
+                y = fmris[sub][excluded_start:-excluded_end]
+                if kfold is None:
+                    n = X.shape[0]
+                    split = int(n * 0.8)
+                    if split <= 0 or split >= n:
+                        raise ValueError("样本量不足以划分训练/测试集。")
                     model = KernelRidge(alpha=args.alpha, kernel=args.kernel, gamma=args.gamma)
-                    model.fit(X[train_idx], y[train_idx])
-                    y_pred = model.predict(X[test_idx])
-                    corr = corr_with_np(y_pred, y[test_idx])
-                    fold_corrs.append(np.nanmean(corr))
-                corr_means.append(float(np.mean(fold_corrs)))
+                    model.fit(X[:split], y[:split])
+                    y_pred = model.predict(X[split:])
+                    corr = corr_with_np(y_pred, y[split:])
+                    corr_means.append(float(np.nanmean(corr)))
+                else:
+                    fold_corrs = []
+                    for train_idx, test_idx in kfold.split(X):
+                        model = KernelRidge(alpha=args.alpha, kernel=args.kernel, gamma=args.gamma)
+                        model.fit(X[train_idx], y[train_idx])
+                        y_pred = model.predict(X[test_idx])
+                        corr = corr_with_np(y_pred, y[test_idx])
+                        fold_corrs.append(np.nanmean(corr))
+                    corr_means.append(float(np.mean(fold_corrs)))
             print(f"[nonlinear] subject done: {sub}", flush=True)
 
-        arr = np.array(corr_means)
-        with out_path.open("a", encoding="utf-8") as f:
-            f.write(f"aligned={feat_path}\n")
-            f.write(f"kernel={args.kernel}, alpha={args.alpha}, gamma={args.gamma}\n")
-            f.write(f"平均值: {arr.mean():.4f} ± {arr.std():.4f}\n")
-            f.write(f"范围: [{arr.min():.4f}, {arr.max():.4f}]\n")
-            f.write(f"中位数: {np.median(arr):.4f}\n\n")
+        write_log(out_path, feat_path, args, corr_means)
 
     return 0
 
 
+def fit_group(X: np.ndarray, fmris: dict, excluded_start: int, excluded_end: int,
+              kfold: KFold | None, args: argparse.Namespace) -> list[float]:
+    """
+    群体模式: 每个划分只拟合一个核岭回归, 再对每个被试的测试段打分.
+    stacked 与线性情形相同, 等价于在平均响应上以 alpha / S 拟合 (见 modeling.group_alpha_scale).
+    """
+    ys = np.stack([fmris[sub][excluded_start:-excluded_end] for sub in SUBJECTS])
+    y_bar = ys.mean(0)
+    alpha = args.alpha / group_alpha_scale(args.group_mode, len(SUBJECTS))
+    if kfold is None:
+        split = int(X.shape[0] * 0.8)
+        splits = [(np.arange(split), np.arange(split, X.shape[0]))]
+    else:
+        splits = list(kfold.split(X))
+    fold_means = []
+    with trace("fit", group_mode=args.group_mode, n_subjects=len(SUBJECTS)):
+        for train_idx, test_idx in splits:
+            model = KernelRidge(alpha=alpha, kernel=args.kernel, gamma=args.gamma)
+            model.fit(X[train_idx], y_bar[train_idx])
+            corrs = batched_corr(ys[:, test_idx], model.predict(X[test_idx]), dtype=np.float64)
+            fold_means.append(np.nanmean(corrs, axis=1))
+    return [float(v) for v in np.mean(fold_means, axis=0)]
+
+
+def write_log(out_path: Path, feat_path: Path, args: argparse.Namespace, corr_means: list[float]) -> None:
+    arr = np.array(corr_means)
+    with out_path.open("a", encoding="utf-8") as f:
+        f.write(f"aligned={feat_path}\n")
+        group = f", group_mode={args.group_mode}" if args.group_mode else ""
+        f.write(f"kernel={args.kernel}, alpha={args.alpha}, gamma={args.gamma}{group}\n")
+        f.write(f"平均值: {arr.mean():.4f} ± {arr.std():.4f}\n")
+        f.write(f"范围: [{arr.min():.4f}, {arr.max():.4f}]\n")
+        f.write(f"中位数: {np.median(arr):.4f}\n\n")
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -9,7 +9,8 @@ from pathlib import Path
 import numpy as np
 
 from src.config import ATLAS_ROOT
-from src.viz import save_corr_map
+from src.corr_store import CorrStore, relative_source
+from src.viz import save_corr_maps, save_montage
 
 
 def parse_args() -> argparse.Namespace:
@@ -18,6 +19,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--input-dir", type=str, default=None, help="包含 corr_map 的目录")
     parser.add_argument("--pattern", type=str, default="corr*.npy", help="目录匹配模式")
     parser.add_argument("--out-dir", type=str, default=None, help="输出目录")
+    parser.add_argument("--workers", type=int, default=None, help="并行渲染进程数 (默认 CPU 核数, 1 为串行)")
     return parser.parse_args()
 
 
@@ -31,30 +33,6 @@ def _safe_out_stem(path: Path) -> str:
     return path.stem
 
 
-def _make_montage(image_paths: list[Path], titles: list[str], out_file: Path) -> None:
-    import matplotlib
-
-    matplotlib.use("Agg")
-    import matplotlib.pyplot as plt
-    import matplotlib.image as mpimg
-
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-    n = len(image_paths)
-    if n == 0:
-        return
-    fig, axes = plt.subplots(n, 1, figsize=(12, 4.2 * n), dpi=180)
-    if n == 1:
-        axes = [axes]
-    for ax, img_path, title in zip(axes, image_paths, titles):
-        img = mpimg.imread(img_path.as_posix())
-        ax.imshow(img)
-        ax.set_title(title, fontsize=12)
-        ax.axis("off")
-    fig.tight_layout()
-    fig.savefig(out_file.as_posix(), facecolor="white", bbox_inches="tight")
-    plt.close(fig)
-
-
 def _localize_summary_log_path(log_path: str) -> Path | None:
     """
     summary.csv may contain absolute paths from another machine (e.g. /root/.../results/...).
@@ -86,7 +64,7 @@ def _read_encoding_summary(path: Path) -> list[dict]:
 
 def _parse_group_and_setting(log_rel: str) -> tuple[str | None, str | None, str | None]:
     """
-    Returns (group, model, setting) where setting is like "win200" or "6TR".
+    Returns (group, model, setting) where setting is like "win200", "6TR" or "3TR-text6TR".
     """
     if "/text/" in log_rel:
         m = re.search(r"/text/([^/]+)/win(\d+)/", log_rel)
@@ -97,17 +75,27 @@ def _parse_group_and_setting(log_rel: str) -> tuple[str | None, str | None, str
         if m:
             return "audio", m.group(1), f"{m.group(2)}TR"
     if "/multimodal/" in log_rel:
-        m = re.search(r"/multimodal/([^/]+)/(\d+)TR/", log_rel)
+        m = re.search(r"/multimodal/([^/]+)/(\d+TR(?:-text\d+TR)?)/", log_rel)
         if m:
-            return "multimodal", m.group(1), f"{m.group(2)}TR"
+            return "multimodal", m.group(1), m.group(2)
     return None, None, None
 
 
+def _stored_sources() -> set[str]:
+    store = CorrStore()
+    return set(store.index()["source"]) if store.exists() else set()
+
+
+def _corr_available(path: Path, stored: set[str]) -> bool:
+    return relative_source(path) in stored or path.exists()
+
+
 def _pick_representative_corr_maps(limit_per_group: int = 9) -> list[tuple[Path, str]]:
     """
     Pick a "rich enough" set of representative corr maps based on results/summary.csv.
     Returns list of (corr_path, title).
     """
+    stored = _stored_sources()
     rows = _read_encoding_summary(Path("results/summary.csv"))
     if not rows:
         return []
@@ -129,7 +117,7 @@ def _pick_representative_corr_maps(limit_per_group: int = 9) -> list[tuple[Path,
         if mean_val != mean_val:
             continue
         corr_path = local_log.parent / f"corr_layer{layer}.npy"
-        if not corr_path.exists():
+        if not _corr_available(corr_path, stored):
             continue
         parsed.append((group, model, setting, layer, mean_val, corr_path))
 
@@ -195,7 +183,7 @@ def _pick_representative_corr_maps(limit_per_group: int = 9) -> list[tuple[Path,
             elif line.startswith("中位数:"):
                 if mean_val is not None and tag:
                     corr_path = lp.parent / f"corr_{tag}.npy"
-                    if corr_path.exists():
+                    if _corr_available(corr_path, stored):
                         title = f"fusion:{lp.parent.name} {tag} mean={mean_val:.4f}"
                         fusion_best.append((mean_val, title, corr_path))
                 meta = ""
@@ -210,6 +198,15 @@ def _pick_representative_corr_maps(limit_per_group: int = 9) -> list[tuple[Path,
     return picks
 
 
+MONTAGES = [
+    ("text_", "text_class_montage.png"),
+    ("audio_", "audio_class_montage.png"),
+    ("multimodal_", "multimodal_class_montage.png"),
+    ("fusion_", "fusion_montage.png"),
+]
+MONTAGE_MAX = 9
+
+
 def main() -> int:
     args = parse_args()
     paths: list[Path] = []
@@ -217,76 +214,62 @@ def main() -> int:
         paths.append(Path(args.input))
     if args.input_dir:
         paths.extend(Path(args.input_dir).glob(args.pattern))
+
+    # When running with defaults (no input/input-dir), put outputs in the report folder,
+    # so the report can include them without copying.
+    use_defaults = args.input is None and args.input_dir is None
+    title_by_path: dict[str, str] = {}
     if not paths:
         # 默认：根据 results/summary.csv 动态选取足够多的代表性 corr map（避免参数）
         reps = _pick_representative_corr_maps(limit_per_group=9)
-        if reps:
-            paths.extend([p for p, _ in reps])
+        paths.extend([p for p, _ in reps])
+        title_by_path = {p.as_posix(): t for p, t in reps}
         if not paths:
             raise ValueError("必须提供 --input 或 --input-dir，且未能从 results/summary.csv 选取代表性结果。")
 
-    saved_pngs: list[Path] = []
-    title_by_path: dict[str, str] = {}
-    png_title: dict[str, str] = {}
-    if args.input is None and args.input_dir is None:
-        reps = _pick_representative_corr_maps(limit_per_group=9)
-        title_by_path = {p.as_posix(): t for p, t in reps}
+    # 先从 corr store 一次性取出所有需要的 map, 不在 store 中的再逐个读 .npy
+    store = CorrStore()
+    stored_maps = store.lookup_sources(paths) if store.exists() else {}
 
+    corr_maps: list[np.ndarray] = []
+    out_paths: list[Path] = []
     for path in paths:
-        corr_map = np.load(path)
-        # When running with defaults (no input/input-dir), put outputs in the report folder,
-        # so the report can include them without copying.
-        if args.input is None and args.input_dir is None:
+        corr_map = stored_maps.get(relative_source(path))
+        if corr_map is None:
+            corr_map = np.load(path)
+        if use_defaults:
             out_dir = Path(args.out_dir) if args.out_dir else Path("report/figures/brainmaps")
         else:
             out_dir = Path(args.out_dir) if args.out_dir else path.parent
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / f"{_safe_out_stem(path)}.png"
-        save_corr_map(corr_map, atlas_root=ATLAS_ROOT, out_file=out_path)
-        saved_pngs.append(out_path)
-        png_title[out_path.as_posix()] = title_by_path.get(path.as_posix(), out_path.stem)
+        corr_maps.append(corr_map)
+        out_paths.append(out_dir / f"{_safe_out_stem(path)}.png")
+
+    # Montages (defaults only) use the first MONTAGE_MAX images of each class, kept in memory.
+    montage_members: dict[str, list[int]] = {}
+    if use_defaults:
+        for prefix, _ in MONTAGES:
+            idx = [i for i, p in enumerate(out_paths) if p.name.startswith(prefix)]
+            montage_members[prefix] = idx[:MONTAGE_MAX]
+    keep = [False] * len(out_paths)
+    for idx in montage_members.values():
+        for i in idx:
+            keep[i] = True
+
+    images = save_corr_maps(corr_maps, atlas_root=ATLAS_ROOT, out_files=out_paths,
+                            workers=args.workers, keep_images=keep)
+    for out_path in out_paths:
         print(f"saved: {out_path}")
 
-    # When using defaults, also output a montage for the class comparison.
-    if args.input is None and args.input_dir is None:
+    if use_defaults:
         out_dir = Path(args.out_dir) if args.out_dir else Path("report/figures/brainmaps")
-        # Build montages from the newly generated images (grouped by out stem prefix).
-        def pick_group(prefix: str, max_n: int) -> list[Path]:
-            ps = [p for p in saved_pngs if p.name.startswith(prefix)]
-            return ps[:max_n]
-
         # Ensure "class" montages show multiple models/settings if available.
-        text_imgs = pick_group("text_", 9)
-        if text_imgs:
-            _make_montage(
-                text_imgs,
-                [png_title.get(p.as_posix(), p.stem) for p in text_imgs],
-                out_dir / "text_class_montage.png",
-            )
-
-        audio_imgs = pick_group("audio_", 9)
-        if audio_imgs:
-            _make_montage(
-                audio_imgs,
-                [png_title.get(p.as_posix(), p.stem) for p in audio_imgs],
-                out_dir / "audio_class_montage.png",
-            )
-
-        multimodal_imgs = pick_group("multimodal_", 9)
-        if multimodal_imgs:
-            _make_montage(
-                multimodal_imgs,
-                [png_title.get(p.as_posix(), p.stem) for p in multimodal_imgs],
-                out_dir / "multimodal_class_montage.png",
-            )
-
-        fusion_imgs = pick_group("fusion_", 9)
-        if fusion_imgs:
-            _make_montage(
-                fusion_imgs,
-                [png_title.get(p.as_posix(), p.stem) for p in fusion_imgs],
-                out_dir / "fusion_montage.png",
-            )
+        for prefix, name in MONTAGES:
+            idx = montage_members[prefix]
+            if not idx:
+                continue
+            titles = [title_by_path.get(paths[i].as_posix(), out_paths[i].stem) for i in idx]
+            save_montage([images[i] for i in idx], titles, out_dir / name)
+            print(f"saved: {out_dir / name}")
 
     return 0
 
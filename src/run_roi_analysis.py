@@ -10,26 +10,80 @@ import pandas as pd
 # 确保优先使用当前仓库的 src，而不是全局安装的同名包
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
-from src.config import ATLAS_ROOT
+from src.config import ATLAS_ROOT, SUBJECTS
+from src.atlas_cache import build_roi_index, load_atlas_bundle
+from src.corr_store import CorrStore, relative_source, subject_corr_path
 from src.utils import extract_hemi_data_from_files
 
+SCAN_KINDS = ("text", "audio", "multimodal")
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="ROI-level preference analysis")
     parser.add_argument("--corr-map", type=str, default=None, help="corr_map .npy 文件")
-    parser.add_argument("--input-dir", type=str, default=None, help="包含 corr_layer*.npy 的目录")
+    parser.add_argument("--input-dir", type=str, default=None, help="包含 corr_layer*.npy 的目录 (ROI 级或顶点级)")
     parser.add_argument("--out", type=str, default="results/roi.csv", help="输出 CSV")
-    return parser.parse_args()
+    parser.add_argument("--store", type=str, default=None,
+                        help="corr store 目录 (默认 results/corr_store, 不存在时回退到扫描 results/{text,audio,multimodal}/)")
+    parser.add_argument("--kind", nargs="*", default=None,
+                        help="只分析指定类别 (text/audio/multimodal), 不给值时为全部")
+    parser.add_argument("--per-subject", action="store_true",
+                        help="逐被试统计: 读取 corr_layer*.npy 旁的 corr_subjects_layer*.npy, 输出带 subject 列")
+    parser.add_argument("--scan-unindexed", action="store_true",
+                        help="同时扫描 results/{text,audio,multimodal}/ 下不在 store 中的 corr_layer*.npy "
+                             "(顶点级结果, 以及未导入 store 的旧结果)")
+    args = parser.parse_args()
+    if not args.kind:
+        args.kind = None
+    return args
+
+
+def scan_results(results_root: Path, kinds: list[str] | None, indexed: set[str] | None = None) -> list[Path]:
+    """
+    扫描 results/<kind>/ 下的 corr_layer*.npy (只限 text/audio/multimodal, 不进入 cache/ 与 search/),
+    跳过 indexed 中已在 corr store 的结果.
+    """
+    paths = []
+    for kind in kinds or SCAN_KINDS:
+        for path in sorted((results_root / kind).rglob("corr_layer*.npy")):
+            if indexed is None or relative_source(path) not in indexed:
+                paths.append(path)
+    return paths
 
 
 def load_rois(atlas_root: Path) -> np.ndarray:
+    try:
+        # 优先使用图谱缓存 (mmap), 避免每次运行都重新解析 GIFTI
+        return np.asarray(load_atlas_bundle(atlas_root).rois).astype(int)
+    except FileNotFoundError:
+        pass
     tpl_files = list(atlas_root.glob("*MMP*gii"))
     if not tpl_files:
         raise FileNotFoundError("Missing atlas GIFTI files in data/atlas")
     return extract_hemi_data_from_files(tpl_files, is_label=True, return_list=False).astype(int)
 
 
+def vertex_to_roi(corr_maps: np.ndarray, rois: np.ndarray) -> np.ndarray:
+    """
+    顶点级 corr map (..., n_vertices) -> ROI 级 (..., n_rois): 每个 ROI 内忽略 nan 取平均.
+    ROI r 对应输出的第 r - 1 列, 与 ROI 级 corr map 的排列一致.
+    """
+    roi_ptr, roi_vertices = build_roi_index(rois)
+    values = np.asarray(corr_maps, dtype=np.float64)[..., roi_vertices]
+    finite = np.isfinite(values)
+    # 按标签排序后每个 ROI 是一段连续区间, reduceat 一次求出所有 ROI 的和与有效顶点数
+    starts = roi_ptr[1:-1]
+    sums = np.add.reduceat(np.where(finite, values, 0.0), starts, axis=-1)
+    counts = np.add.reduceat(finite, starts, axis=-1)
+    empty = np.diff(roi_ptr)[1:] == 0
+    counts[..., empty] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
 def roi_summary(corr_map: np.ndarray, rois: np.ndarray) -> pd.DataFrame:
+    if corr_map.shape[-1] == rois.shape[0]:
+        corr_map = vertex_to_roi(corr_map, rois)
     rows = []
     for roi_ind in np.unique(rois[rois != 0]):
         roi_val = corr_map[roi_ind - 1]
@@ -37,6 +91,29 @@ def roi_summary(corr_map: np.ndarray, rois: np.ndarray) -> pd.DataFrame:
     return pd.DataFrame(rows)
 
 
+def roi_summary_matrix(corr_maps: np.ndarray, sources: list[str], rois: np.ndarray) -> pd.DataFrame:
+    """roi_summary 的批量版本: corr_maps shape (n_results, n_rois), 一次索引得到所有结果的 ROI 值.
+    corr_maps 也可以是顶点级 (n_results, n_vertices), 此时先按 ROI 平均."""
+    if corr_maps.shape[-1] == rois.shape[0]:
+        corr_maps = vertex_to_roi(corr_maps, rois)
+    roi_inds = np.unique(rois[rois != 0]).astype(int)
+    values = corr_maps[:, roi_inds - 1]
+    return pd.DataFrame({
+        "roi": np.tile(roi_inds, len(sources)),
+        "corr": values.reshape(-1).astype(float),
+        "source": np.repeat(np.asarray(sources, dtype=object), len(roi_inds)),
+    })
+
+
+def roi_subject_summary(corr_subjects: np.ndarray, source: str, rois: np.ndarray) -> pd.DataFrame:
+    """(n_subjects, n_rois 或 n_vertices) 的逐被试张量 -> 每个 (被试, ROI) 一行, 行顺序与 config.SUBJECTS 相同."""
+    n_subjects = corr_subjects.shape[0]
+    subjects = SUBJECTS if n_subjects == len(SUBJECTS) else list(range(n_subjects))
+    df = roi_summary_matrix(corr_subjects, [source] * n_subjects, rois)
+    df.insert(0, "subject", np.repeat(subjects, len(df) // n_subjects))
+    return df
+
+
 def main() -> int:
     args = parse_args()
     rois = load_rois(ATLAS_ROOT)
@@ -48,8 +125,45 @@ def main() -> int:
         sources.append(Path(args.corr_map))
     if args.input_dir:
         sources.extend(Path(args.input_dir).glob("corr_layer*.npy"))
-    if not sources:
-        sources.extend(Path("results").rglob("corr_layer*.npy"))
+
+    store = CorrStore(Path(args.store) if args.store else None)
+    if args.per_subject:
+        if not sources and store.exists():
+            index = store.index()
+            extra = scan_results(Path("results"), args.kind, set(index["source"])) if args.scan_unindexed else []
+            index = index[index["kind"] != "fusion"]
+            if args.kind:
+                index = index[index["kind"].isin(args.kind)]
+            sources.extend(Path("results") / src for src in index["source"])
+            if extra:
+                print(f"[roi] {len(extra)} corr_layer*.npy not in store, reading from files", flush=True)
+            sources.extend(extra)
+        elif not sources:
+            sources.extend(scan_results(Path("results"), args.kind))
+        for path in sources:
+            tensor_path = subject_corr_path(path)
+            if not tensor_path.exists():
+                print(f"[roi] skip (no per-subject tensor): {path}", flush=True)
+                continue
+            print(f"[roi] processing: {tensor_path}", flush=True)
+            outputs.append(roi_subject_summary(np.load(tensor_path), path.as_posix(), rois))
+        sources = []
+    elif not sources and store.exists():
+        # 默认从 corr store 一次性读取, 避免遍历 results 目录逐个加载
+        index, corr_maps = store.select(kind=args.kind)
+        # 与目录扫描保持一致: 只统计 corr_layer*.npy (不含 fusion)
+        keep = (index["kind"] != "fusion").to_numpy()
+        index, corr_maps = index[keep], corr_maps[keep]
+        print(f"[roi] loaded {len(index)} corr maps from store: {store.root}", flush=True)
+        if len(index):
+            sources_rel = [(Path("results") / src).as_posix() for src in index["source"]]
+            outputs.append(roi_summary_matrix(corr_maps, sources_rel, rois))
+        # 不在 store 中的结果 (顶点级、未导入的旧结果) 只在 --scan-unindexed 时从文件读取
+        if args.scan_unindexed:
+            sources.extend(scan_results(Path("results"), args.kind, set(store.index()["source"])))
+            print(f"[roi] {len(sources)} corr_layer*.npy not in store, reading from files", flush=True)
+    elif not sources:
+        sources.extend(scan_results(Path("results"), args.kind))
 
     for path in sources:
         if not path.exists():
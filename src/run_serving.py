@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+本机编码模型服务. 先在已提取的 TR 级特征上拟合并保存模型 (需要先运行 run_text_models / run_audio_models):
+
+    python -m src.run_serving fit --kind text --model gpt2 --layer 9 --ctx-words 200
+    python -m src.run_serving fit --kind audio --model facebook/wav2vec2-base-960h --layer 7 --tr-win 3
+
+再启动服务 (特征提取模型与权重常驻内存, 只监听 127.0.0.1):
+
+    python -m src.run_serving serve --bundle results/serving/text/gpt2/win200/layer9 --port 8765
+    curl -s localhost:8765/predict -d '{"words": [["So", 0.4], ["this", 0.7]], "average": true}'
+    curl -s localhost:8765/stats
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.alpha_select import add_alpha_args, alpha_summary, resolve_alphas
+from src.config import (
+    AUDIO_SR,
+    DEFAULT_FIR_OFFSET,
+    DEFAULT_FIR_WINDOW,
+    DEFAULT_PCA_DIM,
+    RESULTS_ROOT,
+    SUBJECTS,
+    TR_SECONDS,
+)
+from src.tracing import add_trace_args, init_from_args, set_tags
+
+DEFAULT_POOLING = {"text": "last", "audio": "mean"}
+
+
+def bundle_dir(kind: str, model_name: str, setting: str, layer: int) -> Path:
+    return RESULTS_ROOT / "serving" / kind / model_name.replace("/", "_") / setting / f"layer{layer}"
+
+
+def feature_setting(args: argparse.Namespace) -> str:
+    return f"win{args.ctx_words}" if args.kind == "text" else f"{args.tr_win}TR"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local encoding-model serving")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fit = sub.add_parser("fit", help="在已提取的特征上拟合并保存编码模型")
+    fit.add_argument("--kind", choices=["text", "audio"], required=True, help="特征类别")
+    fit.add_argument("--model", required=True, help="模型名 (HuggingFace 名称, 与 run_* 脚本的 --models 相同)")
+    fit.add_argument("--layer", type=int, required=True, help="层")
+    fit.add_argument("--ctx-words", type=int, default=200, help="文本上下文窗口 (kind=text)")
+    fit.add_argument("--tr-win", type=int, default=3, help="音频 TR 窗口 (kind=audio)")
+    fit.add_argument("--pooling", choices=["mean", "last"], default=None,
+                     help="特征提取时的 pooling (默认与 run_* 脚本相同: text=last, audio=mean)")
+    fit.add_argument("--pca-dim", type=int, default=DEFAULT_PCA_DIM, help="PCA 维度")
+    fit.add_argument("--fir-window", type=int, default=DEFAULT_FIR_WINDOW, help="FIR 窗口")
+    fit.add_argument("--fir-offset", type=int, default=DEFAULT_FIR_OFFSET, help="FIR 偏移")
+    fit.add_argument("--subjects", nargs="+", type=int, default=None, help="被试 (默认 config.SUBJECTS)")
+    fit.add_argument("--out-dir", type=str, default=None,
+                     help="模型目录 (默认 results/serving/<kind>/<model>/<setting>/layer<L>)")
+    add_alpha_args(fit)
+    add_trace_args(fit)
+
+    serve = sub.add_parser("serve", help="加载模型并启动本机 HTTP 服务")
+    serve.add_argument("--bundle", required=True, help="fit 保存的模型目录")
+    serve.add_argument("--host", default="127.0.0.1", help="监听地址 (默认只接受本机请求)")
+    serve.add_argument("--port", type=int, default=8765, help="端口")
+    serve.add_argument("--max-batch", type=int, default=8, help="一次合并的最多请求数")
+    serve.add_argument("--max-wait-ms", type=float, default=10.0, help="合并请求的最长等待时间 (毫秒)")
+    serve.add_argument("--batch-size", type=int, default=None, help="特征提取 batch size (默认同 run_* 脚本)")
+    serve.add_argument("--autocast", action="store_true", help="使用 autocast")
+    serve.add_argument("--device", default=None, help="设备 (默认有 GPU 时用 cuda)")
+    serve.add_argument("--trust-remote-code", action="store_true", help="使用 trust_remote_code")
+    return parser.parse_args()
+
+
+def run_fit(args: argparse.Namespace) -> int:
+    from src.data import load_fmri
+    from src.encoding_model import fit_encoding_model
+    from src.halving_search import discover_candidates
+    from src.transforms import TransformParams
+
+    init_from_args("serving", args)
+    setting = feature_setting(args)
+    safe = args.model.replace("/", "_")
+    found = discover_candidates(RESULTS_ROOT, [args.kind], [safe], [setting], [args.layer])
+    if not found:
+        raise FileNotFoundError(f"未找到 {args.kind}/{safe}/{setting} layer{args.layer} 的特征, "
+                                f"请先运行 run_{args.kind}_models")
+    features = np.load(found[0].path)
+    fmris = load_fmri()
+    subjects = args.subjects or list(SUBJECTS)
+    set_tags(model=args.model, layer=args.layer)
+    meta = {
+        "kind": args.kind, "model": args.model, "layer": args.layer, "setting": setting,
+        "pooling": args.pooling or DEFAULT_POOLING[args.kind], "source": str(found[0].path),
+        "alpha_select": args.alpha_select,
+    }
+    meta.update({"ctx_words": args.ctx_words} if args.kind == "text" else {"tr_win": args.tr_win})
+    params = TransformParams(pca_dim=args.pca_dim, fir_window=args.fir_window, fir_offset=args.fir_offset)
+    model = fit_encoding_model(features, fmris, subjects, params, resolve_alphas(args),
+                               alpha_select=args.alpha_select, meta=meta)
+    out_dir = model.save(Path(args.out_dir) if args.out_dir else bundle_dir(args.kind, args.model, setting, args.layer))
+    print(f"[serving] fitted {len(subjects)} subjects x {model.n_targets} targets from {found[0].path}", flush=True)
+    print(f"[serving] alphas: {alpha_summary(model.alphas)}", flush=True)
+    print(f"[serving] saved: {out_dir}", flush=True)
+    return 0
+
+
+def run_serve(args: argparse.Namespace) -> int:
+    import torch
+
+    from src.encoding_model import EncodingModel
+    from src.serving import EncodingService, featurizer_from_meta, serve_http
+
+    t0 = time.perf_counter()
+    model = EncodingModel.load(args.bundle)
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    extra = {"batch_size": args.batch_size} if args.batch_size else {}
+    featurizer = featurizer_from_meta(model.meta, device=device, trust_remote_code=args.trust_remote_code,
+                                      autocast=args.autocast, **extra)
+    service = EncodingService(model, featurizer, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms).start()
+    meta = model.meta
+    print(f"[serving] loaded {meta['kind']} {meta['model']} layer={meta['layer']} ({meta['setting']}), "
+          f"{len(model.subjects)} subjects x {model.n_targets} targets in {time.perf_counter() - t0:.1f}s", flush=True)
+
+    # 预热一次, 使第一个真实请求不承担懒加载 / kernel 初始化的开销
+    if meta["kind"] == "text":
+        warm = service.predict_text([("hello", 0.5), ("world", 1.0)], duration=3 * TR_SECONDS)
+    else:
+        warm = service.predict_audio(np.zeros(int(AUDIO_SR * TR_SECONDS * 2), dtype=np.float32))
+    print(f"[serving] warm-up: {warm.latency['total_ms']:.1f} ms", flush=True)
+
+    server = serve_http(service, args.host, args.port)
+    print(f"[serving] listening on http://{args.host}:{args.port} (POST /predict, GET /stats, GET /health)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        print(f"[serving] stats: {service.stats()}", flush=True)
+    return 0
+
+
+def main() -> int:
+    args = parse_args()
+    if args.command == "fit":
+        return run_fit(args)
+    return run_serve(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
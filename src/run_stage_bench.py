@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+流水线各阶段的离线基准: 在合成数据 (src/bench/synthetic.py) 上按不同规模计时, 结果写入 JSON.
+
+    python -m src.run_stage_bench --scales small medium --out results/stage_bench.json
+    python -m src.run_stage_bench --compare results/stage_bench_base.json   # 与旧基线对比, 变慢时返回 1
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from src.bench.stages import STAGE_NAMES, run_scale
+from src.bench.synthetic import SCALES, write_atlas
+from src.config import PROJECT_ROOT
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Synthetic end-to-end stage benchmark")
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=list(SCALES), help="数据规模")
+    parser.add_argument("--stages", nargs="+", default=None, choices=STAGE_NAMES, help="只计时指定阶段")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段重复次数")
+    parser.add_argument("--atlas-root", type=str, default=None,
+                        help="save_corr_map 使用的图谱目录 (默认生成合成 ico6 图谱)")
+    parser.add_argument("--no-render", action="store_true", help="跳过 save_corr_map")
+    parser.add_argument("--out", type=str, default="results/stage_bench.json", help="输出 JSON")
+    parser.add_argument("--compare", type=str, default=None, help="对比的基线 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="中位数变慢超过该比例 (且超过 10ms) 视为退化")
+    return parser.parse_args()
+
+
+def git_commit() -> str:
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True, check=True)
+        return proc.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(base: dict, new: dict, tolerance: float) -> list[str]:
+    """打印两次结果各阶段中位数的对比, 返回退化的 (scale, stage) 列表."""
+    regressions = []
+    print(f"[bench] compare {base.get('commit') or '?'} -> {new.get('commit') or '?'}", flush=True)
+    print(f"{'scale':<8} {'stage':<28} {'base_s':>10} {'new_s':>10} {'ratio':>7}")
+    for scale, stages in new["scales"].items():
+        for stage, res in stages.items():
+            old = base.get("scales", {}).get(scale, {}).get(stage)
+            if old is None:
+                continue
+            ratio = res["median_s"] / max(old["median_s"], 1e-12)
+            slower = ratio > 1 + tolerance and res["median_s"] - old["median_s"] > 0.01
+            flag = "  <-- slower" if slower else ""
+            print(f"{scale:<8} {stage:<28} {old['median_s']:>10.4f} {res['median_s']:>10.4f} {ratio:>7.2f}{flag}")
+            if slower:
+                regressions.append(f"{scale}:{stage}")
+    return regressions
+
+
+def main() -> int:
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="stage_bench_") as tmp:
+        work_dir = Path(tmp)
+        atlas_root = None
+        if not args.no_render:
+            atlas_root = Path(args.atlas_root) if args.atlas_root else write_atlas(work_dir / "atlas")
+        results = {}
+        for name in args.scales:
+            print(f"[bench] scale start: {name}", flush=True)
+            results[name] = run_scale(SCALES[name], args.repeat, work_dir, atlas_root, args.stages)
+
+    payload = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "repeat": args.repeat,
+        "sizes": {name: vars(SCALES[name]) for name in args.scales},
+        "scales": results,
+    }
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"已保存阶段耗时: {out_path}")
+
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(base, payload, args.tolerance)
+        if regressions:
+            print(f"[bench] slower than baseline: {', '.join(regressions)}", flush=True)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
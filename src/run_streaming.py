@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+流式预测的回放测试: 用 run_serving fit 保存的模型, 把录音 (音频模型) 或对齐表 (文本模型) 逐帧送入,
+每个 TR 输出一行预测并记录延迟:
+
+    python -m src.run_streaming --bundle results/serving/audio/facebook_wav2vec2-base-960h/3TR/layer7 \\
+        --wav data/raw/21styear_audio.wav --max-seconds 120 --realtime
+    python -m src.run_streaming --bundle results/serving/text/gpt2/win200/layer9 --words data/raw/21styear_align.csv
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.config import AUDIO_SR, TR_SECONDS
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay a recording through the streaming predictor")
+    parser.add_argument("--bundle", required=True, help="run_serving fit 保存的模型目录")
+    parser.add_argument("--wav", type=str, default=None, help="回放的音频 (音频模型必需; 文本模型可选, 用于确定时长)")
+    parser.add_argument("--words", type=str, default=None,
+                        help="回放的词对齐表 (格式同 21styear_align.csv, 文本模型必需)")
+    parser.add_argument("--max-seconds", type=float, default=None, help="只回放前若干秒")
+    parser.add_argument("--frame-ms", type=float, default=20.0, help="每次送入的音频帧 / 时钟步长 (毫秒)")
+    parser.add_argument("--realtime", action="store_true", help="按墙钟节奏送入 (默认尽快送入)")
+    parser.add_argument("--subjects", nargs="+", type=int, default=None, help="只预测这些被试")
+    parser.add_argument("--device", default=None, help="设备 (默认有 GPU 时用 cuda)")
+    parser.add_argument("--autocast", action="store_true", help="使用 autocast")
+    parser.add_argument("--trust-remote-code", action="store_true", help="使用 trust_remote_code")
+    parser.add_argument("--out", type=str, default=None, help="保存预测 (n_subjects, n_trs, n_targets) 的 .npy")
+    return parser.parse_args()
+
+
+def main() -> int:
+    import torch
+
+    from src.data import load_align_df, load_audio
+    from src.encoding_model import EncodingModel
+    from src.serving import featurizer_from_meta
+    from src.streaming import AudioStream, TextStream, latency_report, replay
+
+    args = parse_args()
+    model = EncodingModel.load(args.bundle)
+    kind = model.meta["kind"]
+    if kind == "audio" and not args.wav:
+        raise ValueError("音频模型需要 --wav")
+    if kind == "text" and not args.words:
+        raise ValueError("文本模型需要 --words")
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    featurizer = featurizer_from_meta(model.meta, device=device, trust_remote_code=args.trust_remote_code,
+                                      autocast=args.autocast)
+
+    wav, words, duration = None, None, None
+    if args.wav:
+        wav, _ = load_audio(Path(args.wav), sr=AUDIO_SR)
+        if args.max_seconds:
+            wav = wav[:int(args.max_seconds * AUDIO_SR)]
+        duration = len(wav) / AUDIO_SR
+    if args.words:
+        df = load_align_df(Path(args.words))
+        words = [(w, float(t)) for w, t in zip(df.cased, df.start_ts)
+                 if args.max_seconds is None or t <= args.max_seconds]
+        if duration is None and args.max_seconds:
+            duration = args.max_seconds
+
+    stream = (AudioStream(model, featurizer, args.subjects) if kind == "audio"
+              else TextStream(model, featurizer, args.subjects))
+    print(f"[stream] {kind} {model.meta['model']} layer={model.meta['layer']} ({model.meta['setting']}), "
+          f"{'realtime' if args.realtime else 'as fast as possible'}, frame={args.frame_ms:g} ms", flush=True)
+    t0 = time.perf_counter()
+    rows = replay(stream, wav=wav, words=words, frame_ms=args.frame_ms, realtime=args.realtime, duration=duration)
+    wall = time.perf_counter() - t0
+
+    report = latency_report(rows)
+    stream_seconds = len(rows) * TR_SECONDS
+    report["wall_s"] = round(wall, 3)
+    report["realtime_factor"] = round(wall / stream_seconds, 4) if stream_seconds else None
+    print(f"[stream] {json.dumps(report)}", flush=True)
+    if report.get("over_budget"):
+        print(f"[stream] {report['over_budget']} TRs exceeded the {TR_SECONDS}s budget", flush=True)
+    if args.out and rows:
+        out = Path(args.out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        np.save(out, np.stack([r.predictions for r in rows], axis=1).astype(np.float32))
+        print(f"[stream] saved: {out}", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
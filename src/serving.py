@@ -0,0 +1,429 @@
+"""
+serving.py
+
+常驻内存的编码模型服务: 特征提取模型 (tokenizer/模型 或 processor/模型)、TransformPipeline 与
+每个被试的岭回归权重 (encoding_model.EncodingModel) 只加载一次, 对新刺激给出预测的 (被试, TR, ROI) 响应.
+刺激为带起始时间的词序列 (文本模型) 或波形 (音频模型), 特征提取方式与 run_text_models / run_audio_models 相同.
+
+micro-batching: 请求先进入队列, 后台线程把 max_wait_ms 内到达的请求 (至多 max_batch 个) 合并,
+文本的上下文窗口 / 音频的 chunk 拼接后做一次前向, 再按请求切回各自对齐和预测.
+每个结果带有 queue/extract/predict/total 毫秒数与所在批大小; stats() 给出最近请求的延迟分位数.
+
+Python:
+    service = EncodingService(EncodingModel.load(bundle_dir), featurizer_from_meta(meta)).start()
+    result = service.predict_text([("So", 0.4), ("this", 0.6), ...])
+    result.predictions                           # (n_subjects, T, n_targets) float32
+HTTP (仅本机, 见 run_serving):
+    POST /predict  {"words": [["So", 0.4], ...], "duration": 30.0}
+                   {"audio_path": "clip.wav"} 或 {"audio": <base64 float32>, "sr": 16000}
+                   可选 "subjects": [75, 131], "average": true (返回被试平均 (T, n_targets))
+    GET  /stats    延迟统计
+    GET  /health   模型描述
+"""
+from __future__ import annotations
+
+import base64
+import json
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.config import AUDIO_SR, TR_SECONDS
+from src.encoding_model import EncodingModel
+
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_WAIT_MS = 10.0
+LATENCY_STAGES = ("queue_ms", "extract_ms", "predict_ms", "total_ms")
+
+
+def words_frame(words: Iterable[tuple[str, float]], tr_seconds: float = TR_SECONDS) -> pd.DataFrame:
+    """[(词, 起始秒), ...] -> 与 data.load_align_df 相同列的对齐表 (cased / start_ts / tr)."""
+    rows = [(str(word), float(start)) for word, start in words]
+    if not rows:
+        raise ValueError("No words in request.")
+    df = pd.DataFrame(rows, columns=["cased", "start_ts"])
+    # 第 k 个 TR 覆盖 ((k-1)*TR, k*TR]; 0 秒处的词归入第 1 个 TR
+    df["tr"] = np.maximum(np.ceil(df.start_ts / tr_seconds), 1).astype(int)
+    return df
+
+
+class TextFeaturizer:
+    """
+    Parameters
+    ----------
+        tokenizer, model : 已加载的 tokenizer 与文本模型 (见 from_pretrained)
+        layer : 提取的层
+        ctx_words : 上下文 token 数 (与 build_context_tokens 相同)
+        pooling : token pooling 方式
+        device, batch_size, autocast : 见 extract_text_features
+    """
+
+    kind = "text"
+
+    def __init__(self, tokenizer, model, layer: int, ctx_words: int, pooling: str = "last",
+                 device: Any = "cpu", batch_size: int = 64, autocast: bool = False):
+        self.tokenizer = tokenizer
+        self.model = model.eval().to(device)
+        self.layer = layer
+        self.ctx_words = ctx_words
+        self.pooling = pooling
+        self.device = device
+        self.batch_size = batch_size
+        self.autocast = autocast
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, layer: int, ctx_words: int, trust_remote_code: bool = False,
+                        **kwargs) -> "TextFeaturizer":
+        from transformers import AutoModel, AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+        if getattr(tokenizer, "add_prefix_space", None) is not None:
+            tokenizer.add_prefix_space = True
+        model = AutoModel.from_pretrained(model_name, output_hidden_states=True, trust_remote_code=trust_remote_code)
+        return cls(tokenizer, model, layer, ctx_words, **kwargs)
+
+    def prepare(self, request: dict) -> tuple[list[list[str]], tuple[pd.DataFrame, int]]:
+        """请求 -> (逐词的上下文 token 列表, 对齐所需的 (对齐表, TR 数))."""
+        from src.text_pipeline import build_context_tokens
+
+        if "words" not in request:
+            raise ValueError("Text model expects 'words': [[word, start_seconds], ...].")
+        df = words_frame(request["words"])
+        n_trs = int(df.tr.max())
+        if request.get("duration") is not None:
+            n_trs = max(n_trs, math.ceil(float(request["duration"]) / TR_SECONDS))
+        return build_context_tokens(df, self.tokenizer, self.ctx_words), (df, n_trs)
+
+    @staticmethod
+    def concat(items: list[list[list[str]]]) -> list[list[str]]:
+        return [tokens for item in items for tokens in item]
+
+    @staticmethod
+    def size(item: list[list[str]]) -> int:
+        return len(item)
+
+    def extract(self, tokens: list[list[str]]) -> np.ndarray:
+        from src.text_pipeline import extract_text_layers
+
+        return extract_text_layers(tokens, self.tokenizer, self.model, [self.layer], self.device,
+                                   self.batch_size, self.autocast, self.pooling, verbose=False)[self.layer]
+
+    @staticmethod
+    def finish(context: tuple[pd.DataFrame, int], features: np.ndarray) -> np.ndarray:
+        from src.text_pipeline import align_word_features_to_tr
+
+        df, n_trs = context
+        return align_word_features_to_tr(df, features, n_trs, pooling="mean")
+
+
+class AudioFeaturizer:
+    """
+    Parameters
+    ----------
+        processor, model : 已加载的音频 processor 与模型 (见 from_pretrained)
+        layer : 提取的层
+        tr_win : 每个 TR 的音频窗口 (TR 数, 与 chunk_audio 相同)
+        pooling : 时间维 pooling 方式
+        device, batch_size, autocast : 见 extract_audio_features
+    """
+
+    kind = "audio"
+
+    def __init__(self, processor, model, layer: int, tr_win: int, pooling: str = "mean",
+                 device: Any = "cpu", batch_size: int = 16, autocast: bool = False):
+        self.processor = processor
+        self.model = model.eval().to(device)
+        self.layer = layer
+        self.tr_win = tr_win
+        self.pooling = pooling
+        self.device = device
+        self.batch_size = batch_size
+        self.autocast = autocast
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, layer: int, tr_win: int, trust_remote_code: bool = False,
+                        **kwargs) -> "AudioFeaturizer":
+        from transformers import AutoFeatureExtractor, AutoModel, AutoProcessor
+
+        try:
+            processor = AutoProcessor.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+        except Exception:
+            processor = AutoFeatureExtractor.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+        model = AutoModel.from_pretrained(model_name, output_hidden_states=True, trust_remote_code=trust_remote_code)
+        return cls(processor, model, layer, tr_win, **kwargs)
+
+    def prepare(self, request: dict):
+        """请求 -> (每个 TR 一个音频窗口的 chunk 张量, None). 只保留完整的 TR, 窗口不足时在开头补零."""
+        from src.audio_pipeline import chunk_audio
+
+        if "audio_path" in request:
+            from src.data import load_audio
+
+            wav, sr = load_audio(Path(request["audio_path"]), sr=AUDIO_SR)
+        elif "audio" in request:
+            wav = request["audio"]
+            if isinstance(wav, str):
+                wav = np.frombuffer(base64.b64decode(wav), dtype="<f4")
+            wav, sr = np.array(wav, dtype=np.float32), int(request.get("sr", AUDIO_SR))
+            if sr != AUDIO_SR:
+                import librosa
+
+                wav, sr = librosa.resample(wav, orig_sr=sr, target_sr=AUDIO_SR), AUDIO_SR
+        else:
+            raise ValueError("Audio model expects 'audio_path' or 'audio' (+ 'sr').")
+        tr_frames = int(sr * TR_SECONDS)
+        n_trs = len(wav) // tr_frames
+        if n_trs == 0:
+            raise ValueError(f"Audio shorter than one TR ({TR_SECONDS}s).")
+        wav = wav[len(wav) - n_trs * tr_frames:]
+        if n_trs < self.tr_win:
+            wav = np.pad(wav, ((self.tr_win - n_trs) * tr_frames, 0))
+        chunks = chunk_audio(np.ascontiguousarray(wav), sr, n_trs=n_trs, tr_seconds=TR_SECONDS, tr_win=self.tr_win)
+        return chunks, None
+
+    @staticmethod
+    def concat(items: list) -> Any:
+        import torch
+
+        return items[0] if len(items) == 1 else torch.cat(items, dim=0)
+
+    @staticmethod
+    def size(item) -> int:
+        return int(item.shape[0])
+
+    def extract(self, chunks) -> np.ndarray:
+        from src.audio_pipeline import extract_audio_layers
+
+        return extract_audio_layers(chunks, self.processor, self.model, [self.layer], self.device,
+                                    self.batch_size, self.autocast, self.pooling, AUDIO_SR, verbose=False)[self.layer]
+
+    @staticmethod
+    def finish(context: None, features: np.ndarray) -> np.ndarray:
+        return features
+
+
+def featurizer_from_meta(meta: dict, device: Any = "cpu", trust_remote_code: bool = False,
+                         **kwargs) -> TextFeaturizer | AudioFeaturizer:
+    """按 EncodingModel.meta (kind / model / layer / ctx_words 或 tr_win / pooling) 加载特征提取模型."""
+    common = dict(pooling=meta["pooling"], device=device, trust_remote_code=trust_remote_code, **kwargs)
+    if meta["kind"] == "text":
+        return TextFeaturizer.from_pretrained(meta["model"], int(meta["layer"]), int(meta["ctx_words"]), **common)
+    if meta["kind"] == "audio":
+        return AudioFeaturizer.from_pretrained(meta["model"], int(meta["layer"]), int(meta["tr_win"]), **common)
+    raise ValueError(f"Unsupported encoding model kind: {meta['kind']}")
+
+
+@dataclass
+class PredictResult:
+    """predictions: (n_subjects, T, n_targets) float32; latency: 各阶段毫秒数与 batch_size."""
+
+    predictions: np.ndarray
+    subjects: list[int]
+    latency: dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class _Pending:
+    request: dict
+    future: Future
+    t_submit: float
+
+
+class EncodingService:
+    """
+    Parameters
+    ----------
+        model : 已加载的 EncodingModel
+        featurizer : TextFeaturizer / AudioFeaturizer, 与 model.meta 的特征设置一致
+        max_batch : 一次合并的最多请求数
+        max_wait_ms : 收到第一个请求后等待其他请求的最长时间
+        history : stats() 统计的最近请求数
+    """
+
+    def __init__(self, model: EncodingModel, featurizer: TextFeaturizer | AudioFeaturizer,
+                 max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 history: int = 1000):
+        self.model = model
+        self.featurizer = featurizer
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue[_Pending | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._latencies: deque[dict[str, float]] = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._n_batches = 0
+
+    def start(self) -> "EncodingService":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="encoding-service", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "EncodingService":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def submit(self, request: dict) -> Future:
+        """提交一个请求 (格式同 HTTP 的 JSON), 返回 Future[PredictResult]."""
+        if self._thread is None:
+            raise RuntimeError("EncodingService is not started.")
+        future: Future = Future()
+        self._queue.put(_Pending(request, future, time.perf_counter()))
+        return future
+
+    def predict(self, request: dict, timeout: float | None = None) -> PredictResult:
+        return self.submit(request).result(timeout)
+
+    def predict_text(self, words: Iterable[tuple[str, float]], duration: float | None = None,
+                     subjects: Iterable[int] | None = None) -> PredictResult:
+        return self.predict({"words": list(words), "duration": duration, "subjects": subjects})
+
+    def predict_audio(self, wav: np.ndarray, sr: int = AUDIO_SR,
+                      subjects: Iterable[int] | None = None) -> PredictResult:
+        return self.predict({"audio": wav, "sr": sr, "subjects": subjects})
+
+    def _collect(self, first: _Pending) -> tuple[list[_Pending], bool]:
+        batch, deadline = [first], time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self) -> None:
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list[_Pending]) -> None:
+        t_start = time.perf_counter()
+        prepared = []
+        for pending in batch:
+            try:
+                prepared.append((pending, *self.featurizer.prepare(pending.request)))
+            except Exception as exc:  # 单个请求格式错误不影响同批的其他请求
+                pending.future.set_exception(exc)
+        if not prepared:
+            return
+        try:
+            features = self.featurizer.extract(self.featurizer.concat([item for _, item, _ in prepared]))
+        except Exception as exc:
+            for pending, _, _ in prepared:
+                pending.future.set_exception(exc)
+            return
+        t_extract = time.perf_counter()
+        self._n_batches += 1
+
+        start = 0
+        for pending, item, context in prepared:
+            n = self.featurizer.size(item)
+            t0 = time.perf_counter()
+            try:
+                tr_features = self.featurizer.finish(context, features[start:start + n])
+                subjects = pending.request.get("subjects")
+                pred = self.model.predict(tr_features, subjects)
+            except Exception as exc:
+                pending.future.set_exception(exc)
+                continue
+            finally:
+                start += n
+            t_done = time.perf_counter()
+            latency = {
+                "queue_ms": (t_start - pending.t_submit) * 1000,
+                "extract_ms": (t_extract - t_start) * 1000,
+                "predict_ms": (t_done - t0) * 1000,
+                "total_ms": (t_done - pending.t_submit) * 1000,
+                "batch_size": len(prepared),
+            }
+            with self._lock:
+                self._latencies.append(latency)
+            pending.future.set_result(PredictResult(
+                predictions=pred, subjects=list(subjects) if subjects is not None else list(self.model.subjects),
+                latency=latency))
+
+    def stats(self) -> dict:
+        """最近请求的各阶段延迟 (mean / p50 / p95 / max, 毫秒) 与平均批大小."""
+        with self._lock:
+            rows = list(self._latencies)
+        out: dict[str, Any] = {"n_requests": len(rows), "n_batches": self._n_batches}
+        if not rows:
+            return out
+        out["mean_batch_size"] = float(np.mean([r["batch_size"] for r in rows]))
+        for stage in LATENCY_STAGES:
+            values = np.array([r[stage] for r in rows])
+            out[stage] = {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)),
+                          "p95": float(np.percentile(values, 95)), "max": float(values.max())}
+        return out
+
+
+def make_handler(service: EncodingService) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == "/stats":
+                self._send(200, service.stats())
+            elif self.path == "/health":
+                self._send(200, {"meta": service.model.meta, "subjects": service.model.subjects,
+                                 "n_targets": service.model.n_targets})
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path != "/predict":
+                self._send(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                result = service.predict(request)
+            except (ValueError, KeyError) as exc:
+                self._send(400, {"error": str(exc)})
+                return
+            except Exception as exc:
+                self._send(500, {"error": f"{type(exc).__name__}: {exc}"})
+                return
+            pred = result.predictions.mean(0) if request.get("average") else result.predictions
+            self._send(200, {"subjects": result.subjects, "shape": list(pred.shape),
+                             "predictions": np.round(pred, 5).tolist(), "latency": result.latency})
+
+        def log_message(self, fmt: str, *args) -> None:
+            pass  # 延迟统计见 /stats, 不逐条打印访问日志
+
+    return Handler
+
+
+def serve_http(service: EncodingService, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+    """创建 HTTP 服务 (并发请求各占一个线程, 在 service 的队列中合并); 调用方负责 serve_forever / shutdown."""
+    return ThreadingHTTPServer((host, port), make_handler(service))
@@ -0,0 +1,204 @@
+"""
+streaming.py
+
+流式 (实时) 预测: 音频帧 / 带时间戳的词逐步到达, 每过一个 TR (1.5 s) 输出一行预测的 ROI 响应.
+模型与特征提取同 serving (EncodingModel + AudioFeaturizer / TextFeaturizer), 每个 TR 与离线流水线一一对应:
+    音频 : 定长缓冲保存最近 tr_win 个 TR 的采样, 每凑满一个 TR 对该窗口做一次前向 (即 chunk_audio 的第 t 个 chunk);
+    文本 : 环形缓冲 (deque) 保存最近 ctx_words 个 token, 每个词到达时记下它的上下文 (同 build_context_tokens);
+           TR 结束时对该 TR 内的词做一次前向并取平均, 没有词的 TR 沿用上一个 TR 的特征 (同 align_word_features_to_tr);
+    FIR  : 环形缓冲保存最近 fir_offset + fir_window 个 TR 的降维特征, 拼出当前 TR 的 FIR 行, 与所有被试的权重相乘.
+每个 TR 的计算量固定 (一次窗口前向或该 TR 内的几个词, 加一次 (1, n_params) 矩阵乘), 延迟有界.
+与离线结果只在开头不同 (前 tr_win - 1 个 TR 及其后 FIR 窗口内): 不足 tr_win 个 TR 时离线重复第一个完整窗口, 这里在前面补零;
+文本流只输出已结束的 TR, 不含末尾不完整的 TR.
+
+    stream = AudioStream(EncodingModel.load(bundle_dir), featurizer)
+    for frames in mic:                      # 任意长度的采样块
+        for row in stream.push(frames):     # 每完成一个 TR 一行
+            row.predictions                 # (n_subjects, n_targets)
+"""
+from __future__ import annotations
+
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+
+from src.config import AUDIO_SR, TR_SECONDS
+from src.encoding_model import EncodingModel
+from src.serving import AudioFeaturizer, TextFeaturizer
+
+
+@dataclass
+class TRPrediction:
+    """
+    tr : TR 序号 (从 1 开始, 与对齐表的 tr 列相同)
+    predictions : shape (n_subjects, n_targets)
+    extract_ms : 该 TR 的特征提取耗时
+    latency_ms : 从 TR 结束 (最后一个采样 / 时钟越过 TR 边界) 到预测完成
+    """
+
+    tr: int
+    predictions: np.ndarray
+    extract_ms: float
+    latency_ms: float
+
+
+class StreamingPredictor:
+    """逐 TR 的特征 -> 降维 -> FIR 行 -> 预测; 子类负责从音频 / 词得到每个 TR 的特征."""
+
+    def __init__(self, model: EncodingModel, subjects: Iterable[int] | None = None):
+        self.model = model
+        self.subjects = list(subjects) if subjects is not None else None
+        self._zero = np.zeros(model.n_components)
+        self._reduced: deque[np.ndarray] = deque(maxlen=model.fir_offset + model.fir_window)
+        self.n_trs = 0
+
+    def _emit(self, features: np.ndarray, t_ready: float, extract_ms: float) -> TRPrediction:
+        # _reduced[k] 为 k 个 TR 之前的降维特征, FIR 行依次取延迟 fir_offset .. fir_offset + fir_window - 1
+        self._reduced.appendleft(self.model.transform.reduce(features[None])[0])
+        lags = range(self.model.fir_offset, self.model.fir_offset + self.model.fir_window)
+        row = np.concatenate([self._reduced[k] if k < len(self._reduced) else self._zero for k in lags])
+        pred = self.model.predict_design(row[None], self.subjects)[:, 0]
+        self.n_trs += 1
+        return TRPrediction(tr=self.n_trs, predictions=pred, extract_ms=extract_ms,
+                            latency_ms=(time.perf_counter() - t_ready) * 1000)
+
+
+class AudioStream(StreamingPredictor):
+    """
+    Parameters
+    ----------
+        model : EncodingModel (音频特征)
+        featurizer : AudioFeaturizer, tr_win 与模型的特征设置一致
+        subjects : 只预测这些被试 (默认全部)
+        sr : 输入采样率 (须为 config.AUDIO_SR, 其他采样率请先重采样)
+    """
+
+    def __init__(self, model: EncodingModel, featurizer: AudioFeaturizer,
+                 subjects: Iterable[int] | None = None, sr: int = AUDIO_SR):
+        if sr != AUDIO_SR:
+            raise ValueError(f"AudioStream expects {AUDIO_SR} Hz input, got {sr}.")
+        super().__init__(model, subjects)
+        self.featurizer = featurizer
+        self.tr_frames = int(sr * TR_SECONDS)
+        self._window = np.zeros(featurizer.tr_win * self.tr_frames, dtype=np.float32)
+        self._filled = 0  # 当前 TR 已到达的采样数
+
+    def push(self, frames: np.ndarray) -> list[TRPrediction]:
+        """追加任意长度的采样, 返回其间完成的 TR 的预测."""
+        import torch
+
+        frames = np.asarray(frames, dtype=np.float32).reshape(-1)
+        out = []
+        tail = self._window.shape[0] - self.tr_frames
+        while frames.size:
+            take = min(self.tr_frames - self._filled, frames.size)
+            self._window[tail + self._filled:tail + self._filled + take] = frames[:take]
+            self._filled += take
+            frames = frames[take:]
+            if self._filled < self.tr_frames:
+                break
+            t_ready = time.perf_counter()
+            features = self.featurizer.extract(torch.from_numpy(self._window.copy()[None]))[0]
+            extract_ms = (time.perf_counter() - t_ready) * 1000
+            out.append(self._emit(features, t_ready, extract_ms))
+            # 窗口左移一个 TR, 为下一个 TR 腾出末尾
+            self._window[:tail] = self._window[self.tr_frames:]
+            self._filled = 0
+        return out
+
+
+class TextStream(StreamingPredictor):
+    """
+    Parameters
+    ----------
+        model : EncodingModel (文本特征)
+        featurizer : TextFeaturizer, ctx_words 与模型的特征设置一致
+        subjects : 只预测这些被试 (默认全部)
+
+    词按起始时间顺序 push, 时钟由 advance(t) 推进 (push 也会把时钟推进到该词的起始时间).
+    第 k 个 TR 覆盖 ((k-1)*TR, k*TR], 时钟越过 k*TR 后输出.
+    """
+
+    def __init__(self, model: EncodingModel, featurizer: TextFeaturizer, subjects: Iterable[int] | None = None):
+        super().__init__(model, subjects)
+        self.featurizer = featurizer
+        self._tokens: deque[str] = deque(maxlen=featurizer.ctx_words)
+        self._contexts: list[list[str]] = []  # 当前 TR 内各词的上下文
+        self._last = np.zeros(model.n_features)  # 第一个词之前为零 (同离线的补零)
+
+    def push(self, word: str, start: float) -> list[TRPrediction]:
+        out = self.advance(start)
+        self._tokens.extend(self.featurizer.tokenizer.tokenize(word, add_special_tokens=False))
+        self._contexts.append(list(self._tokens))
+        return out
+
+    def advance(self, t: float) -> list[TRPrediction]:
+        """把时钟推进到 t 秒, 返回其间结束的 TR 的预测."""
+        out = []
+        while (self.n_trs + 1) * TR_SECONDS < t:
+            t_ready = time.perf_counter()
+            if self._contexts:
+                self._last = self.featurizer.extract(self._contexts).mean(0)
+                self._contexts = []
+            extract_ms = (time.perf_counter() - t_ready) * 1000
+            out.append(self._emit(self._last, t_ready, extract_ms))
+        return out
+
+
+def replay(stream: AudioStream | TextStream, wav: np.ndarray | None = None,
+           words: list[tuple[str, float]] | None = None, frame_ms: float = 20.0,
+           realtime: bool = False, duration: float | None = None) -> list[TRPrediction]:
+    """
+    按 frame_ms 的步长回放录音 (AudioStream) 或带时间戳的词 (TextStream).
+
+    realtime=True 时按墙钟节奏送入 (每步等到对应的流时间), 否则尽快送入;
+    两种情况下 latency_ms 都只包含 TR 结束之后的计算时间.
+    duration 为回放总时长 (默认音频长度, 或最后一个词之后再一个 TR).
+    """
+    if isinstance(stream, AudioStream) and wav is None:
+        raise ValueError("AudioStream replay needs wav.")
+    if isinstance(stream, TextStream) and not words:
+        raise ValueError("TextStream replay needs words.")
+    if duration is None:
+        duration = len(wav) / AUDIO_SR if wav is not None else max(start for _, start in words) + TR_SECONDS
+    step = frame_ms / 1000
+    n_steps = int(np.ceil(duration / step))
+    frame = int(round(step * AUDIO_SR))
+    pending = sorted(words or [], key=lambda w: w[1])
+    out: list[TRPrediction] = []
+    t_wall = time.perf_counter()
+    w = 0
+    for i in range(n_steps):
+        t_stream = min((i + 1) * step, duration)
+        if realtime:
+            delay = t_wall + t_stream - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if isinstance(stream, AudioStream):
+            out.extend(stream.push(wav[i * frame:(i + 1) * frame]))
+        else:
+            while w < len(pending) and pending[w][1] <= t_stream:
+                out.extend(stream.push(*pending[w]))
+                w += 1
+            out.extend(stream.advance(t_stream))
+    return out
+
+
+def latency_report(rows: list[TRPrediction], budget_ms: float = TR_SECONDS * 1000) -> dict:
+    """逐 TR 延迟的汇总: mean / p50 / p95 / max 毫秒与超出 budget (默认一个 TR) 的 TR 数."""
+    if not rows:
+        return {"n_trs": 0}
+    latency = np.array([r.latency_ms for r in rows])
+    extract = np.array([r.extract_ms for r in rows])
+    return {
+        "n_trs": len(rows),
+        "latency_mean_ms": float(latency.mean()),
+        "latency_p50_ms": float(np.percentile(latency, 50)),
+        "latency_p95_ms": float(np.percentile(latency, 95)),
+        "latency_max_ms": float(latency.max()),
+        "extract_mean_ms": float(extract.mean()),
+        "over_budget": int((latency > budget_ms).sum()),
+    }
@@ -0,0 +1,432 @@
+"""
+surface_raster.py
+
+save_corr_map 的栅格化模板渲染器.
+
+模板在第一次使用时构建: 按原 save_corr_map 的版式 (2x2 视角 + colorbar) 用 matplotlib 画一次
+空白底图, 然后对每个半球/视角把 inflated 表面投影到该面板的像素网格上做光栅化,
+得到每个像素所在三角形的 3 个顶点 ROI 标签与重心坐标 (pixel -> ROI 查找表), 并把 sulc 灰度底图烘焙进底图.
+
+绘制新的 corr map 时只需: ROI 值查表 + 重心加权 + colormap, 写入底图副本, 再画 colorbar 刻度.
+光栅化遵循 tripcolor 的绘制顺序 (后绘制的三角形覆盖先绘制的), 输出与原 PNG 视觉一致.
+模板按图谱指纹缓存在图谱缓存目录下.
+"""
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from src.atlas_cache import AtlasBundle, default_cache_dir
+
+TEMPLATE_VERSION = 2
+FIG_SIZE = (12, 4.6)
+FIG_DPI = 220
+PANELS = (
+    ("L", "lateral", "Left (lateral)"),
+    ("L", "medial", "Left (medial)"),
+    ("R", "medial", "Right (medial)"),
+    ("R", "lateral", "Right (lateral)"),
+)
+# 三角形包围盒不超过该尺寸时走向量化路径, 更大的三角形逐个处理
+_MAX_VECTORIZED_BOX = 24
+# 与 matplotlib 默认 ytick 样式一致 (单位: pt)
+_TICK_LENGTH, _TICK_WIDTH, _TICK_PAD, _TICK_FONTSIZE = 3.5, 0.8, 3.5, 10.0
+
+_TEMPLATES: dict[str, "CorrMapTemplate"] = {}
+
+
+def project_view(coords: np.ndarray, hemi: str, view: str) -> tuple[np.ndarray, np.ndarray]:
+    """与 viz._project_front 相同的正交投影 (沿 x 轴)."""
+    y = np.asarray(coords[:, 1], dtype=np.float64)
+    z = np.asarray(coords[:, 2], dtype=np.float64)
+    if view not in ("lateral", "medial"):
+        raise ValueError(f"Unknown view: {view}")
+    if hemi == "L":
+        x2d = -y if view == "lateral" else y
+    else:
+        x2d = y if view == "lateral" else -y
+    return x2d, z
+
+
+def _barycentric(tri_xy: np.ndarray, px: np.ndarray, py: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """tri_xy: (N, 3, 2); px/py: (N,). 返回 (weights (N, 3), valid (N,))."""
+    a, b, c = tri_xy[:, 0], tri_xy[:, 1], tri_xy[:, 2]
+    v0, v1 = b - a, c - a
+    v2x, v2y = px - a[:, 0], py - a[:, 1]
+    d00 = (v0 * v0).sum(1)
+    d01 = (v0 * v1).sum(1)
+    d11 = (v1 * v1).sum(1)
+    d20 = v2x * v0[:, 0] + v2y * v0[:, 1]
+    d21 = v2x * v1[:, 0] + v2y * v1[:, 1]
+    denom = d00 * d11 - d01 * d01
+    valid = np.abs(denom) > 1e-12
+    denom = np.where(valid, denom, 1.0)
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+    u = 1.0 - v - w
+    return np.stack([u, v, w], axis=1), valid
+
+
+def rasterize(col: np.ndarray, row: np.ndarray, faces: np.ndarray,
+              shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    把像素坐标下的三角网格光栅化 (像素中心位于整数坐标).
+
+    重叠时取面片序号最大的三角形 (= 最后绘制的三角形), 与 tripcolor 的覆盖关系一致.
+
+    Parameters
+    ----------
+        col, row : 每个顶点的像素坐标 (列, 行), 行方向向下
+        faces : 三角形顶点索引, shape (F, 3)
+        shape : 输出 (H, W)
+
+    Returns
+    -------
+        tri_index : (H, W) int32, 未覆盖为 -1
+        weights : (H, W, 3) float32, 重心坐标
+    """
+    H, W = shape
+    faces = np.asarray(faces, dtype=np.int64)
+    tri_xy = np.stack([col[faces], row[faces]], axis=-1)  # (F, 3, 2)
+
+    c0 = np.ceil(tri_xy[:, :, 0].min(1)).astype(np.int64)
+    c1 = np.floor(tri_xy[:, :, 0].max(1)).astype(np.int64)
+    r0 = np.ceil(tri_xy[:, :, 1].min(1)).astype(np.int64)
+    r1 = np.floor(tri_xy[:, :, 1].max(1)).astype(np.int64)
+    c0, r0 = np.maximum(c0, 0), np.maximum(r0, 0)
+    c1, r1 = np.minimum(c1, W - 1), np.minimum(r1, H - 1)
+    bw, bh = c1 - c0 + 1, r1 - r0 + 1
+
+    best = np.full(H * W, -1, dtype=np.int64)
+    eps = 1e-6
+    tri_ids = np.arange(faces.shape[0])
+    nonempty = (bw > 0) & (bh > 0)
+    small = nonempty & (bw <= _MAX_VECTORIZED_BOX) & (bh <= _MAX_VECTORIZED_BOX)
+
+    # 向量化: 对包围盒内的每个偏移量, 同时测试所有小三角形
+    ids_small = tri_ids[small]
+    for dy in range(int(bh[small].max(initial=0))):
+        for dx in range(int(bw[small].max(initial=0))):
+            sel = ids_small[(bw[ids_small] > dx) & (bh[ids_small] > dy)]
+            if sel.size == 0:
+                continue
+            bary, valid = _barycentric(tri_xy[sel], (c0[sel] + dx).astype(np.float64),
+                                       (r0[sel] + dy).astype(np.float64))
+            inside = valid & (bary >= -eps).all(1)
+            if inside.any():
+                flat = (r0[sel] + dy)[inside] * W + (c0[sel] + dx)[inside]
+                np.maximum.at(best, flat, sel[inside])
+
+    # 极少数大三角形逐个处理
+    for t in tri_ids[nonempty & ~small]:
+        rr, cc = np.mgrid[r0[t]:r1[t] + 1, c0[t]:c1[t] + 1]
+        rr, cc = rr.reshape(-1), cc.reshape(-1)
+        bary, valid = _barycentric(np.repeat(tri_xy[t][None], rr.size, 0), cc.astype(np.float64),
+                                   rr.astype(np.float64))
+        inside = valid & (bary >= -eps).all(1)
+        flat = rr[inside] * W + cc[inside]
+        best[flat] = np.maximum(best[flat], t)
+
+    weights = np.zeros((H * W, 3), dtype=np.float32)
+    pix = np.flatnonzero(best >= 0)
+    bary, _ = _barycentric(tri_xy[best[pix]], (pix % W).astype(np.float64), (pix // W).astype(np.float64))
+    bary = np.clip(bary, 0.0, 1.0)
+    weights[pix] = bary / bary.sum(1, keepdims=True)
+    return best.reshape(H, W).astype(np.int32), weights.reshape(H, W, 3)
+
+
+@dataclass
+class ViewRaster:
+    """
+    单个面板 (半球/视角) 的栅格模板, 位于底图的 [top:top+H, left:left+W].
+
+    pixels : (N,) 被表面覆盖的像素在面板内的扁平索引
+    roi_idx : (N, 3) int16, 像素所在三角形 3 个顶点的 ROI 标签 (0 = medial wall)
+    vert_idx : (N, 3) int32, 像素所在三角形 3 个顶点在该半球内的顶点编号 (用于顶点级 corr map)
+    weights : (N, 3) float32, 对应的重心坐标
+    """
+
+    hemi: str
+    top: int
+    left: int
+    shape: tuple[int, int]
+    pixels: np.ndarray
+    roi_idx: np.ndarray
+    vert_idx: np.ndarray
+    weights: np.ndarray
+
+    def roi_image_values(self, roi_values: np.ndarray) -> np.ndarray:
+        """ROI 值 (ROI r 对应 roi_values[r - 1]) -> 每个覆盖像素的插值结果 (N,), medial wall 为 nan."""
+        lut = np.concatenate([[np.nan], np.asarray(roi_values, dtype=np.float32)]).astype(np.float32)
+        return np.einsum("nk,nk->n", lut[self.roi_idx], self.weights)
+
+    def vertex_image_values(self, vertex_values: np.ndarray) -> np.ndarray:
+        """该半球的顶点值 (n_vertices,) -> 每个覆盖像素的插值结果 (N,)."""
+        vals = np.asarray(vertex_values, dtype=np.float32)
+        return np.einsum("nk,nk->n", vals[self.vert_idx], self.weights)
+
+
+def _build_view_raster(bundle: AtlasBundle, hemi: str, view: str, ax_bbox: tuple[int, int, int, int],
+                       data_to_pixel) -> tuple[ViewRaster, np.ndarray, np.ndarray | None]:
+    """
+    ax_bbox: 面板在底图中的 (top, left, H, W); data_to_pixel: (x, y) -> (col, row) 的仿射变换.
+
+    原实现分两层 tripcolor: sulc 层画全部三角形, corr 层中含 medial wall (nan) 顶点的三角形不绘制,
+    因此这里分别光栅化: ROI 层只用三个顶点都属于 ROI 的三角形, 底图层用全部三角形.
+
+    Returns
+    -------
+        raster : ROI 层栅格
+        sulc_pixels, sulc_vals : 底图层覆盖像素及其 sulc 插值 (无 sulc 时 sulc_vals 为 None)
+    """
+    coords, faces = bundle.coords[hemi], bundle.faces[hemi]
+    if coords is None or faces is None:
+        raise FileNotFoundError(f"Missing inflated surface for hemi-{hemi} in {bundle.root}")
+    top, left, H, W = ax_bbox
+    x2d, y2d = project_view(np.asarray(coords), hemi, view)
+    col, row = data_to_pixel(x2d, y2d)
+    col, row = col - left, row - top
+    faces = np.asarray(faces, dtype=np.int64)
+    labels = np.asarray(bundle.labels[hemi]).astype(np.int16)
+
+    roi_faces = faces[(labels[faces] != 0).all(1)]
+    tri_index, weights = rasterize(col, row, roi_faces, (H, W))
+    pixels = np.flatnonzero(tri_index.reshape(-1) >= 0)
+    vert_idx = roi_faces[tri_index.reshape(-1)[pixels]]
+    raster = ViewRaster(hemi=hemi, top=top, left=left, shape=(H, W), pixels=pixels.astype(np.int32),
+                        roi_idx=labels[vert_idx], vert_idx=vert_idx.astype(np.int32),
+                        weights=weights.reshape(-1, 3)[pixels])
+
+    # sulc 底图 (与原实现相同的归一化 + Greys colormap)
+    sulc_vals = None
+    tri_index, weights = rasterize(col, row, faces, (H, W))
+    sulc_pixels = np.flatnonzero(tri_index.reshape(-1) >= 0)
+    if bundle.sulc[hemi] is not None:
+        s = np.asarray(bundle.sulc[hemi], dtype=np.float64)
+        s = (s - np.nanmin(s)) / (np.nanmax(s) - np.nanmin(s) + 1e-8)
+        vert_idx = faces[tri_index.reshape(-1)[sulc_pixels]]
+        sulc_vals = np.einsum("nk,nk->n", s[vert_idx], weights.reshape(-1, 3)[sulc_pixels].astype(np.float64))
+    return raster, sulc_pixels, sulc_vals
+
+
+def text_bitmap(text: str, fontsize: float, dpi: float) -> np.ndarray:
+    """用 matplotlib 自带的 FreeType 直接把字符串渲染成灰度覆盖率位图 (0..255)."""
+    from matplotlib.font_manager import FontProperties, findfont
+    from matplotlib.ft2font import FT2Font
+
+    font = FT2Font(findfont(FontProperties()))
+    font.set_size(fontsize, dpi)
+    font.set_text(text, 0.0)
+    font.draw_glyphs_to_bitmap()
+    return np.asarray(font.get_image())
+
+
+def _format_ticks(ticks: np.ndarray) -> list[str]:
+    """与 ScalarFormatter 相同的效果: 使用能区分所有刻度的最少小数位, 负号为 U+2212."""
+    decimals = 0
+    for decimals in range(0, 7):
+        if np.allclose(np.round(ticks, decimals), ticks, rtol=0, atol=1e-9):
+            break
+    return [f"{t:.{decimals}f}".replace("-", "−") for t in ticks + 0.0]
+
+
+@dataclass
+class CorrMapTemplate:
+    """
+    save_corr_map 的整图模板.
+
+    base : (H, W, 3) uint8, 已裁剪 (bbox_inches="tight") 的底图: 标题/colorbar 渐变/sulc 底图
+    panels : 4 个 ViewRaster
+    cbar_box : colorbar 在底图中的 (top, bottom, right) 像素坐标, 用于绘制每张图的刻度
+    tick_space : colorbar 长轴可容纳的刻度数 (对应 AutoLocator 的 nbins='auto')
+    """
+
+    base: np.ndarray
+    panels: list[ViewRaster]
+    cbar_box: tuple[int, int, int]
+    tick_space: int
+
+    def render(self, values: dict[str, np.ndarray], vmin: float, vmax: float, vertex: bool = False) -> np.ndarray:
+        """
+        渲染一张 corr map.
+
+        Parameters
+        ----------
+            values : {hemi: 该半球的 ROI 值}, ROI r 对应 values[hemi][r - 1];
+                     vertex=True 时为 {hemi: 该半球每个顶点的值}
+            vmin, vmax : colormap 范围
+
+        Returns
+        -------
+            img : (H, W, 3) uint8
+        """
+        import matplotlib
+        from matplotlib.colors import Normalize
+
+        cmap = matplotlib.colormaps["coolwarm"]
+        norm = Normalize(vmin=vmin, vmax=vmax)
+        img = self.base.copy()
+        for panel in self.panels:
+            if vertex:
+                vals = panel.vertex_image_values(values[panel.hemi])
+            else:
+                vals = panel.roi_image_values(values[panel.hemi])
+            finite = np.isfinite(vals)
+            H, W = panel.shape
+            view = img[panel.top:panel.top + H, panel.left:panel.left + W].reshape(-1, 3)
+            view[panel.pixels[finite]] = cmap(norm(vals[finite]), bytes=True)[:, :3]
+            img[panel.top:panel.top + H, panel.left:panel.left + W] = view.reshape(H, W, 3)
+        self._draw_ticks(img, vmin, vmax)
+        return img
+
+    def _draw_ticks(self, img: np.ndarray, vmin: float, vmax: float) -> None:
+        from matplotlib.ticker import MaxNLocator
+
+        top, bottom, right = self.cbar_box
+        px_per_pt = FIG_DPI / 72.0
+        tick_len = int(round(_TICK_LENGTH * px_per_pt))
+        tick_w = max(1, int(round(_TICK_WIDTH * px_per_pt)))
+        pad = int(round(_TICK_PAD * px_per_pt))
+
+        locator = MaxNLocator(nbins=max(1, self.tick_space), steps=[1, 2, 2.5, 5, 10])
+        ticks = locator.tick_values(vmin, vmax)
+        span = vmax - vmin
+        ticks = ticks[(ticks >= vmin - 1e-10 * abs(span)) & (ticks <= vmax + 1e-10 * abs(span))]
+        if span <= 0 or ticks.size == 0:
+            return
+        for tick, label in zip(ticks, _format_ticks(ticks)):
+            y = int(round(bottom - (tick - vmin) / span * (bottom - top)))
+            y0 = max(0, y - tick_w // 2)
+            img[y0:y0 + tick_w, right:right + tick_len] = 0
+
+            bitmap = text_bitmap(label, _TICK_FONTSIZE, FIG_DPI)
+            h, w = bitmap.shape
+            r0, c0 = y - h // 2, right + tick_len + pad
+            r1, c1 = min(r0 + h, img.shape[0]), min(c0 + w, img.shape[1])
+            if r0 < 0 or r1 <= r0 or c1 <= c0:
+                continue
+            alpha = bitmap[:r1 - r0, :c1 - c0, None].astype(np.float32) / 255.0
+            region = img[r0:r1, c0:c1].astype(np.float32)
+            img[r0:r1, c0:c1] = (region * (1.0 - alpha)).astype(np.uint8)
+
+
+def build_template(bundle: AtlasBundle) -> CorrMapTemplate:
+    """按原 save_corr_map 的版式画一次底图, 并为每个面板构建栅格."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import Normalize
+
+    fig = plt.figure(figsize=FIG_SIZE, dpi=FIG_DPI)
+    gs = fig.add_gridspec(2, 2, wspace=0.02, hspace=0.10)
+    axes = [fig.add_subplot(gs[i // 2, i % 2]) for i in range(4)]
+    for ax, (hemi, view, title) in zip(axes, PANELS):
+        x2d, y2d = project_view(np.asarray(bundle.coords[hemi]), hemi, view)
+        # 与 tripcolor 的自动缩放一致: 数据范围外留 5% 边距
+        ax.update_datalim(np.column_stack([x2d, y2d]))
+        ax.autoscale_view()
+        ax.set_aspect("equal")
+        ax.axis("off")
+        ax.set_title(title, fontsize=10)
+    cbar = fig.colorbar(ScalarMappable(norm=Normalize(0.0, 1.0), cmap="coolwarm"), ax=axes, shrink=0.72, pad=0.01)
+    cbar.set_label("Correlation", fontsize=9)
+    # 用有代表性宽度的占位刻度确定版式, 刻度本身设为透明, 之后按每张图的数值重画
+    cbar.set_ticks([0.0, 0.5, 1.0], labels=["−0.00"] * 3)
+    cbar.ax.tick_params(length=0, labelcolor=(0, 0, 0, 0))
+
+    fig.canvas.draw()
+    renderer = fig.canvas.get_renderer()
+    canvas = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+    fig_h = canvas.shape[0]
+
+    # 裁剪 (等价于 savefig(bbox_inches="tight", pad_inches=0.1))
+    tight = fig.get_tightbbox(renderer).padded(matplotlib.rcParams["savefig.pad_inches"])
+    crop_left = max(0, int(np.floor(tight.x0 * FIG_DPI)))
+    crop_right = min(canvas.shape[1], int(np.ceil(tight.x1 * FIG_DPI)))
+    crop_top = max(0, fig_h - int(np.ceil(tight.y1 * FIG_DPI)))
+    crop_bottom = min(fig_h, fig_h - int(np.floor(tight.y0 * FIG_DPI)))
+    base = canvas[crop_top:crop_bottom, crop_left:crop_right].copy()
+
+    def to_crop(x_disp, y_disp):
+        # display 坐标 (原点在左下) -> 裁剪后图像的 (col, row), 像素中心在整数坐标
+        return x_disp - crop_left - 0.5, (fig_h - y_disp) - crop_top - 0.5
+
+    panels = []
+    for ax, (hemi, view, _) in zip(axes, PANELS):
+        bbox = ax.get_window_extent(renderer)
+        left, right = to_crop(bbox.x0, 0)[0], to_crop(bbox.x1, 0)[0]
+        top, bottom = to_crop(0, bbox.y1)[1], to_crop(0, bbox.y0)[1]
+        top_i, left_i = max(0, int(np.ceil(top))), max(0, int(np.ceil(left)))
+        bottom_i = min(base.shape[0] - 1, int(np.floor(bottom)))
+        right_i = min(base.shape[1] - 1, int(np.floor(right)))
+        ax_box = (top_i, left_i, bottom_i - top_i + 1, right_i - left_i + 1)
+        trans = ax.transData
+
+        def data_to_pixel(x, y, trans=trans):
+            disp = trans.transform(np.column_stack([x, y]))
+            return to_crop(disp[:, 0], disp[:, 1])
+
+        raster, sulc_pixels, sulc_vals = _build_view_raster(bundle, hemi, view, ax_box, data_to_pixel)
+        if sulc_vals is not None:
+            H, W = raster.shape
+            view_px = base[raster.top:raster.top + H, raster.left:raster.left + W].reshape(-1, 3)
+            view_px[sulc_pixels] = matplotlib.colormaps["Greys"](np.clip(sulc_vals, 0.0, 1.0), bytes=True)[:, :3]
+            base[raster.top:raster.top + H, raster.left:raster.left + W] = view_px.reshape(H, W, 3)
+        panels.append(raster)
+
+    cbox = cbar.ax.get_window_extent(renderer)
+    cbar_box = (int(round(to_crop(0, cbox.y1)[1])), int(round(to_crop(0, cbox.y0)[1])),
+                int(round(to_crop(cbox.x1, 0)[0])))
+    tick_space = int(cbar.ax.yaxis.get_tick_space())
+    plt.close(fig)
+    return CorrMapTemplate(base=base, panels=panels, cbar_box=cbar_box, tick_space=tick_space)
+
+
+def _template_path(bundle: AtlasBundle) -> Path:
+    import matplotlib
+
+    return default_cache_dir(bundle.root) / (
+        f"corrmap_template_v{TEMPLATE_VERSION}_{bundle.fingerprint}_mpl{matplotlib.__version__}.npz"
+    )
+
+
+def load_template(bundle: AtlasBundle) -> CorrMapTemplate:
+    """读取 (必要时构建并缓存到磁盘) 整图模板, 进程内复用."""
+    if bundle.fingerprint in _TEMPLATES:
+        return _TEMPLATES[bundle.fingerprint]
+
+    path = _template_path(bundle)
+    if path.exists():
+        with np.load(path) as data:
+            panels = []
+            for i, (hemi, _, _) in enumerate(PANELS):
+                geom = data[f"geom{i}"]
+                panels.append(ViewRaster(hemi=hemi, top=int(geom[0]), left=int(geom[1]),
+                                         shape=(int(geom[2]), int(geom[3])), pixels=data[f"pixels{i}"],
+                                         roi_idx=data[f"roi_idx{i}"], vert_idx=data[f"vert_idx{i}"],
+                                         weights=data[f"weights{i}"]))
+            template = CorrMapTemplate(base=data["base"], panels=panels,
+                                       cbar_box=tuple(int(v) for v in data["cbar_box"]),
+                                       tick_space=int(data["tick_space"]))
+    else:
+        print(f"[viz] building corr map template: {path.name}", flush=True)
+        template = build_template(bundle)
+        arrays = {"base": template.base, "cbar_box": np.asarray(template.cbar_box),
+                  "tick_space": np.asarray(template.tick_space)}
+        for i, panel in enumerate(template.panels):
+            arrays[f"geom{i}"] = np.asarray([panel.top, panel.left, *panel.shape])
+            arrays[f"pixels{i}"] = panel.pixels
+            arrays[f"roi_idx{i}"] = panel.roi_idx
+            arrays[f"vert_idx{i}"] = panel.vert_idx
+            arrays[f"weights{i}"] = panel.weights
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.tmp{os.getpid()}.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+    _TEMPLATES[bundle.fingerprint] = template
+    return template
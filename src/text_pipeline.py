@@ -2,17 +2,19 @@ from __future__ import annotations
 
 from collections import defaultdict
 from pathlib import Path
-from typing import Iterable, Literal
+from typing import TYPE_CHECKING, Iterable, Literal
 
 import numpy as np
 import pandas as pd
-import torch
-from transformers import PreTrainedTokenizer, PreTrainedModel
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
 
 from src.utils import extract_text_features
 
+if TYPE_CHECKING:
+    import torch
+    from transformers import PreTrainedTokenizer, PreTrainedModel
+
+    from src.extract_checkpoint import ExtractionCheckpoint
+
 
 def build_context_tokens(df: pd.DataFrame, tokenizer: PreTrainedTokenizer, ctx_words: int) -> list[list[str]]:
     token_ids: list[str] = []
@@ -30,7 +32,9 @@ def build_context_tokens(df: pd.DataFrame, tokenizer: PreTrainedTokenizer, ctx_w
 def extract_text_layers(tokens: list[list[str]], tokenizer: PreTrainedTokenizer,
                         model: PreTrainedModel, layers: Iterable[int],
                         device: torch.device, batch_size: int,
-                        autocast: bool, pooling: Literal["mean", "last"]) -> dict[int, np.ndarray]:
+                        autocast: bool, pooling: Literal["mean", "last"],
+                        checkpoint: ExtractionCheckpoint | None = None,
+                        verbose: bool = True) -> dict[int, np.ndarray]:
     return extract_text_features(
         tokens=tokens,
         tokenizer=tokenizer,
@@ -40,6 +44,8 @@ def extract_text_layers(tokens: list[list[str]], tokenizer: PreTrainedTokenizer,
         batch_size=batch_size,
         autocast=autocast,
         pooling=pooling,
+        checkpoint=checkpoint,
+        verbose=verbose,
     )
 
 
@@ -63,10 +69,9 @@ def align_word_features_to_tr(df: pd.DataFrame, layer_feature: np.ndarray,
 
 
 def reduce_pca(features: np.ndarray, pca_dim: int) -> np.ndarray:
-    scaler = StandardScaler()
-    features_std = scaler.fit_transform(features)
-    pca = PCA(n_components=pca_dim)
-    return pca.fit_transform(features_std)
+    from src.transforms import TransformParams, TransformPipeline
+
+    return TransformPipeline(TransformParams(pca_dim=pca_dim), cache_dir=None).fit_reduce(features)
 
 
 def save_layer_features(layer_features: dict[int, np.ndarray], out_dir: Path,
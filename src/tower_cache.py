@@ -0,0 +1,110 @@
+"""
+tower_cache.py
+
+双塔多模态模型 (CLAP) 的逐塔特征缓存. 双塔模型的文本塔与音频塔互不依赖, 多模态特征只是两个塔逐层 pooled 结果的拼接;
+这里把每个塔的逐层结果分别落盘, key 只由该塔自己的输入决定:
+    文本塔 : 模型名 + autocast + TR 文本窗口
+    音频塔 : 模型名 + autocast + 音频 chunk (波形内容与切分方式) + 采样率
+只换文本窗口 (或只换音频) 时, 只有输入变化的那个塔重新前向, 另一个塔直接读缓存;
+同一组输入换拟合参数 (alpha 选择、群体模式、扫描等) 重跑时两个塔都不再前向.
+
+目录结构 (<root>/<model>/<tower>/<key>/):
+    layer<L>.npy  : 该塔第 L 层的 pooled 特征 (n_items, hidden), float32
+    key.json      : 生成该条目的 key
+    .checkpoint/  : 提取中的断点分片 (见 extract_checkpoint.py), 该塔完成后删除
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+from src.config import RESULTS_ROOT
+from src.extract_checkpoint import DEFAULT_CHECKPOINT_EVERY, ExtractionCheckpoint, digest_strings
+from src.transforms import array_digest
+
+if TYPE_CHECKING:
+    import torch
+
+    from src.audio_pipeline import AudioChunks
+
+TOWER_CACHE_VERSION = 1
+DEFAULT_TOWER_CACHE_DIR = RESULTS_ROOT / "cache" / "towers"
+TOWERS = ("text", "audio")
+
+
+def text_digest(texts: list[str]) -> str:
+    return digest_strings([texts])
+
+
+def chunks_digest(audio_chunks: torch.Tensor | AudioChunks, sr: int) -> str:
+    """音频塔输入的摘要: chunk 内容 + 采样率."""
+    digest = audio_chunks.digest() if hasattr(audio_chunks, "digest") else array_digest(np.asarray(audio_chunks))
+    return f"{digest}|sr={int(sr)}"
+
+
+class TowerCache:
+    """
+    Parameters
+    ----------
+        root : 缓存根目录
+        model_name : 模型名 (HuggingFace 名称)
+        autocast : 是否使用 autocast (影响数值, 计入 key)
+        every : 塔内提取每多少个 batch 落盘一次断点, 0 表示不落盘
+    """
+
+    def __init__(self, root: Path | str = DEFAULT_TOWER_CACHE_DIR, model_name: str = "", autocast: bool = False,
+                 every: int = DEFAULT_CHECKPOINT_EVERY):
+        self.root = Path(root) / model_name.replace("/", "_")
+        self.key = {"version": TOWER_CACHE_VERSION, "model": model_name, "autocast": bool(autocast)}
+        self.every = int(every)
+        self.hits = 0
+        self.misses = 0
+
+    def entry_dir(self, tower: str, input_digest: str) -> Path:
+        key = json.dumps({**self.key, "tower": tower, "inputs": input_digest}, sort_keys=True)
+        return self.root / tower / hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def get(self, tower: str, input_digest: str, layers: list[int],
+            compute: Callable[[list[int], ExtractionCheckpoint | None], dict[int, np.ndarray]]
+            ) -> dict[int, np.ndarray]:
+        """
+        返回该塔各层的特征: 已缓存的层直接读取, 其余层调用 compute(缺失的层, 断点) 计算后落盘.
+        compute 返回 {layer: (n_items, hidden)}.
+        """
+        if tower not in TOWERS:
+            raise ValueError(f"Unknown tower: {tower}")
+        entry = self.entry_dir(tower, input_digest)
+        missing = [layer for layer in layers if not (entry / f"layer{layer}.npy").exists()]
+        if missing:
+            self.misses += 1
+            print(f"[tower-cache] {tower} tower: computing layers {missing} -> {entry}", flush=True)
+            checkpoint = None
+            if self.every > 0:
+                checkpoint = ExtractionCheckpoint(entry / ".checkpoint", {
+                    **self.key, "tower": tower, "inputs": input_digest, "layers": missing,
+                }, self.every)
+            computed = compute(missing, checkpoint)
+            entry.mkdir(parents=True, exist_ok=True)
+            for layer in missing:
+                path = entry / f"layer{layer}.npy"
+                tmp = path.with_name(f"{path.stem}.tmp{os.getpid()}.npy")
+                np.save(tmp, np.asarray(computed[layer], dtype=np.float32))
+                os.replace(tmp, path)
+            key_path = entry / "key.json"
+            if not key_path.exists():
+                key_path.write_text(json.dumps({**self.key, "tower": tower, "inputs": input_digest}, indent=2),
+                                    encoding="utf-8")
+            if checkpoint is not None:
+                checkpoint.clear()
+        else:
+            self.hits += 1
+            print(f"[tower-cache] {tower} tower: cached ({entry})", flush=True)
+        return {layer: np.load(entry / f"layer{layer}.npy") for layer in layers}
+
+    def stats(self) -> str:
+        return f"hits={self.hits} misses={self.misses}"
@@ -0,0 +1,244 @@
+"""
+tracing.py
+
+各 run_* 脚本共用的结构化阶段追踪. 每个阶段 (tokenize / extract / align / pca / fir / fit / save ...)
+结束时向 JSONL 文件写一条事件, 包含墙钟时间、CPU 时间、阶段内峰值 RSS、相关数组的大小,
+以及当前的模型/层/被试等标签. 未调用 init_tracing 时 trace() 不做任何事, 库函数可以无条件埋点.
+
+用法:
+    init_tracing("text", trace_dir)
+    set_tags(model=model_name, layer=layer)       # 之后的事件都带上这些标签
+    with trace("extract") as span:
+        feats = ...
+        span.array("features", feats)
+
+阶段内峰值 RSS: Linux 上在阶段开始时写 /proc/self/clear_refs 重置 VmHWM, 结束时读取
+(嵌套阶段的峰值会向外层传递); 不支持时退回进程生命周期内的峰值 (peak_scope="process").
+
+汇总: python -m src.tracing results/traces [--by stage model]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator
+
+from src.config import RESULTS_ROOT
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+DEFAULT_TRACE_DIR = RESULTS_ROOT / "traces"
+
+_STATE: dict[str, Any] = {"file": None, "script": "", "tags": {}, "stack": [], "clear_refs": None}
+
+
+def _read_status_kb(field: str) -> float | None:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field):
+                    return float(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak() -> bool:
+    if _STATE["clear_refs"] is False:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _STATE["clear_refs"] = True
+    except OSError:
+        _STATE["clear_refs"] = False
+    return bool(_STATE["clear_refs"])
+
+
+def _peak_rss_mb() -> float:
+    hwm = _read_status_kb("VmHWM:") if _STATE["clear_refs"] else None
+    if hwm is not None:
+        return hwm / 1024
+    # ru_maxrss: Linux 上单位为 KB, macOS 上为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _array_info(arr: Any) -> dict:
+    shape = list(getattr(arr, "shape", ()))
+    nbytes = getattr(arr, "nbytes", None)
+    if nbytes is None and hasattr(arr, "element_size"):  # torch.Tensor
+        nbytes = arr.element_size() * arr.nelement()
+    return {"shape": shape, "dtype": str(getattr(arr, "dtype", "")), "mb": round((nbytes or 0) / 2**20, 3)}
+
+
+class Span:
+    """一个进行中的阶段. 可在阶段内补充标签 (set) 与数组大小 (array)."""
+
+    def __init__(self, stage: str, tags: dict):
+        self.stage = stage
+        self.tags = tags
+        self.arrays: dict[str, dict] = {}
+        self.child_peak = 0.0
+
+    def set(self, **tags: Any) -> None:
+        self.tags.update(tags)
+
+    def array(self, name: str, arr: Any) -> None:
+        self.arrays[name] = _array_info(arr)
+
+
+def init_tracing(script: str, trace_dir: Path | str | None = DEFAULT_TRACE_DIR) -> Path | None:
+    """打开 <trace_dir>/<script>_<host>_<pid>_<time>.jsonl; trace_dir 为 None 时关闭追踪."""
+    if _STATE["file"] is not None:
+        _STATE["file"].close()
+        _STATE["file"] = None
+    if trace_dir is None:
+        return None
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    path = trace_dir / f"{script}_{socket.gethostname()}_{os.getpid()}_{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+    _STATE["file"] = path.open("a", encoding="utf-8", buffering=1)
+    _STATE["script"] = script
+    _STATE["tags"] = {}
+    return path
+
+
+def add_trace_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--trace-dir", type=str, default=str(DEFAULT_TRACE_DIR),
+                        help="阶段追踪 JSONL 的输出目录 (汇总: python -m src.tracing <dir>)")
+    parser.add_argument("--no-trace", action="store_true", help="不记录阶段追踪")
+
+
+def init_from_args(script: str, args: argparse.Namespace) -> Path | None:
+    return init_tracing(script, None if args.no_trace else args.trace_dir)
+
+
+def set_tags(**tags: Any) -> None:
+    """设置之后所有事件共有的标签 (如 model/layer); 值为 None 时删除该标签."""
+    for key, value in tags.items():
+        if value is None:
+            _STATE["tags"].pop(key, None)
+        else:
+            _STATE["tags"][key] = value
+
+
+@contextmanager
+def trace(stage: str, **tags: Any) -> Iterator[Span]:
+    """记录一个阶段; 未初始化时只返回一个空 Span."""
+    parent_tags = _STATE["stack"][-1].tags if _STATE["stack"] else _STATE["tags"]
+    span = Span(stage, {**parent_tags, **tags})
+    if _STATE["file"] is None:
+        yield span
+        return
+
+    stack: list[Span] = _STATE["stack"]
+    if stack:
+        # 重置前把外层阶段到目前为止的峰值记下来
+        stack[-1].child_peak = max(stack[-1].child_peak, _peak_rss_mb())
+    scoped = _reset_peak()
+    stack.append(span)
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    ok = True
+    try:
+        yield span
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        stack.pop()
+        peak = max(_peak_rss_mb(), span.child_peak)
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        rss = _read_status_kb("VmRSS:")
+        event = {
+            "ts": time.time() - wall,
+            "script": _STATE["script"],
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "stage": stage,
+            "path": "/".join([s.stage for s in stack] + [stage]),
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu, 6),
+            "rss_peak_mb": round(peak, 2),
+            "rss_mb": round(rss / 1024, 2) if rss is not None else None,
+            "peak_scope": "stage" if scoped else "process",
+            "ok": ok,
+            "tags": span.tags,
+            "arrays": span.arrays,
+        }
+        _STATE["file"].write(json.dumps(event, default=str) + "\n")
+
+
+def load_events(paths: list[Path]) -> pd.DataFrame:
+    import pandas as pd
+
+    files: list[Path] = []
+    for path in paths:
+        files.extend(sorted(path.rglob("*.jsonl")) if path.is_dir() else [path])
+    rows = []
+    for file in files:
+        with file.open(encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    event = json.loads(line)
+                    tags = event.pop("tags", {}) or {}
+                    event.pop("arrays", None)
+                    rows.append({**{f"tag_{k}": v for k, v in tags.items()}, **event})
+    return pd.DataFrame(rows)
+
+
+def hotspots(events: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """按 by 分组汇总: 次数、总/平均/最大墙钟时间、CPU 时间、最大峰值 RSS, 按总时间降序."""
+    keys = [k if k in ("stage", "path", "script", "host") else f"tag_{k}" for k in by]
+    keys = [k for k in keys if k in events.columns]
+    # 嵌套阶段的时间已包含在外层阶段中, 占比以最外层阶段的总时间为分母
+    top_total = events.loc[~events["path"].str.contains("/"), "wall_s"].sum()
+    table = events.groupby(keys, dropna=False).agg(
+        count=("wall_s", "size"),
+        wall_total_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        wall_max_s=("wall_s", "max"),
+        cpu_total_s=("cpu_s", "sum"),
+        rss_peak_mb=("rss_peak_mb", "max"),
+    ).reset_index()
+    table["share"] = table["wall_total_s"] / top_total if top_total > 0 else float("nan")
+    table.columns = [c[4:] if c.startswith("tag_") else c for c in table.columns]
+    return table.sort_values("wall_total_s", ascending=False, ignore_index=True)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="汇总阶段追踪 (per-stage hotspots)")
+    parser.add_argument("paths", nargs="*", default=[str(DEFAULT_TRACE_DIR)], help="JSONL 文件或目录")
+    parser.add_argument("--by", nargs="+", default=["stage"],
+                        help="分组字段: stage/path/script/host 或任意标签 (model/layer/subject ...)")
+    parser.add_argument("--top", type=int, default=20, help="显示前 N 行")
+    parser.add_argument("--out", type=str, default=None, help="另存为 CSV")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    events = load_events([Path(p) for p in args.paths])
+    if events.empty:
+        print("[trace] no events found", flush=True)
+        return 1
+    table = hotspots(events, args.by)
+    print(f"[trace] {len(events)} events", flush=True)
+    print(table.head(args.top).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    if args.out:
+        table.to_csv(args.out, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
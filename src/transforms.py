@@ -0,0 +1,199 @@
+"""
+transforms.py
+
+特征预处理流水线: 标准化 -> PCA -> FIR, 所有 run_* 脚本共用.
+
+TransformPipeline 记录自身参数与拟合得到的组件 (均值/尺度/PCA 基), 并按
+(参数, 输入数组摘要) 把组件与降维输出缓存到磁盘. 同一份特征再次评估 (换 alpha / CV 方式等) 时
+直接读取缓存, 不再重新标准化和拟合 PCA.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from src.config import DEFAULT_FIR_OFFSET, DEFAULT_FIR_WINDOW, DEFAULT_PCA_DIM, RESULTS_ROOT
+from src.lagged_design import LaggedDesign
+from src.modeling import build_fir
+from src.tracing import trace
+
+TRANSFORM_VERSION = 1
+DEFAULT_CACHE_DIR = RESULTS_ROOT / "cache" / "transforms"
+
+
+def array_digest(arr: np.ndarray) -> str:
+    """数组内容 (dtype/shape/数据) 的 sha1 摘要."""
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1(f"{arr.dtype.str}|{arr.shape}".encode())
+    h.update(memoryview(arr).cast("B"))
+    return h.hexdigest()
+
+
+@dataclass
+class TransformParams:
+    """
+    standardize : 是否按列 z-score (ddof=0, 方差为 0 的列保持为 0)
+    pca_dim : PCA 维度, 0/None 或不小于特征维度时跳过 PCA
+    fir_window, fir_offset : build_fir 参数
+    """
+
+    standardize: bool = True
+    pca_dim: int | None = DEFAULT_PCA_DIM
+    fir_window: int = DEFAULT_FIR_WINDOW
+    fir_offset: int = DEFAULT_FIR_OFFSET
+
+
+@dataclass
+class TransformPipeline:
+    """
+    标准化 -> PCA -> FIR 流水线.
+
+    用法:
+        pipe = TransformPipeline(TransformParams(pca_dim=250, fir_window=4, fir_offset=1))
+        X = pipe.fit_transform(features)     # (T, fir_window * n_components)
+        X_new = pipe.transform(new_features)  # 复用已拟合的组件
+
+    cache_dir 为 None 时不读写磁盘缓存.
+    """
+
+    params: TransformParams = field(default_factory=TransformParams)
+    cache_dir: Path | None = DEFAULT_CACHE_DIR
+    mean_: np.ndarray | None = None
+    scale_: np.ndarray | None = None
+    components_: np.ndarray | None = None
+    pca_mean_: np.ndarray | None = None
+    input_digest: str = ""
+
+    @property
+    def fitted(self) -> bool:
+        return bool(self.input_digest)
+
+    def _key(self, digest: str) -> str:
+        payload = json.dumps({"version": TRANSFORM_VERSION, "params": asdict(self.params), "input": digest},
+                             sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()[:24]
+
+    def _cache_path(self, digest: str) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        return Path(self.cache_dir) / f"{self._key(digest)}.npz"
+
+    def fit_reduce(self, features: np.ndarray) -> np.ndarray:
+        """拟合标准化与 PCA, 返回降维后的特征 (T, n_components), 命中缓存时直接读取."""
+        features = np.asarray(features)
+        if features.ndim != 2:
+            raise ValueError("features should be a 2D array with shape (T, D).")
+        with trace("pca", pca_dim=self.params.pca_dim) as span:
+            span.array("features", features)
+            reduced = self._fit_reduce(features, span)
+            span.array("reduced", reduced)
+        return reduced
+
+    def _fit_reduce(self, features: np.ndarray, span) -> np.ndarray:
+        digest = array_digest(features)
+        path = self._cache_path(digest)
+        if path is not None and path.exists():
+            try:
+                reduced = self._load(path, digest)
+                span.set(cache_hit=True)
+                return reduced
+            except (OSError, KeyError, ValueError):
+                pass  # 损坏的缓存文件: 重新拟合并覆盖
+
+        x = features.astype(np.float64, copy=True)
+        self.mean_, self.scale_ = None, None
+        if self.params.standardize:
+            self.mean_ = x.mean(0)
+            scale = x.std(0)
+            scale[scale == 0] = 1.0
+            self.scale_ = scale
+            x -= self.mean_
+            x /= self.scale_
+
+        self.components_, self.pca_mean_ = None, None
+        if self.params.pca_dim and self.params.pca_dim < x.shape[1]:
+            from sklearn.decomposition import PCA
+
+            pca = PCA(n_components=self.params.pca_dim).fit(x)
+            self.components_ = pca.components_
+            self.pca_mean_ = pca.mean_
+            # 用投影而不是 fit_transform 的 U * S: 随机 SVD 下二者略有差异, 投影保证与 reduce() 一致
+            x = (x - self.pca_mean_) @ self.components_.T
+
+        self.input_digest = digest
+        if path is not None:
+            self._save(path, x)
+        return x
+
+    def reduce(self, features: np.ndarray) -> np.ndarray:
+        """用已拟合的组件对新特征做标准化 + PCA."""
+        if not self.fitted:
+            raise RuntimeError("TransformPipeline is not fitted.")
+        x = np.asarray(features, dtype=np.float64)
+        if self.mean_ is not None:
+            x = (x - self.mean_) / self.scale_
+        if self.components_ is not None:
+            x = (x - self.pca_mean_) @ self.components_.T
+        return x
+
+    def fir(self, reduced: np.ndarray, implicit: bool = False) -> np.ndarray | LaggedDesign:
+        """
+        构建 FIR 设计矩阵. implicit=True 时返回 LaggedDesign (不生成 window 倍大小的副本),
+        fit_encoding_single / fit_encoding_cv 可直接使用.
+        """
+        with trace("fir", fir_window=self.params.fir_window, fir_offset=self.params.fir_offset,
+                   implicit=implicit) as span:
+            if implicit:
+                return LaggedDesign.from_fir(reduced, window=self.params.fir_window, offset=self.params.fir_offset)
+            fir = build_fir(np.ascontiguousarray(reduced), window=self.params.fir_window,
+                            offset=self.params.fir_offset)
+            span.array("fir", fir)
+            return fir
+
+    def fit_transform(self, features: np.ndarray, implicit: bool = False) -> np.ndarray | LaggedDesign:
+        return self.fir(self.fit_reduce(features), implicit=implicit)
+
+    def transform(self, features: np.ndarray, implicit: bool = False) -> np.ndarray | LaggedDesign:
+        return self.fir(self.reduce(features), implicit=implicit)
+
+    def _save(self, path: Path, reduced: np.ndarray) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {"reduced": reduced}
+        for name in ("mean_", "scale_", "components_", "pca_mean_"):
+            value = getattr(self, name)
+            if value is not None:
+                arrays[name] = value
+        meta = {"version": TRANSFORM_VERSION, "params": asdict(self.params), "input_digest": self.input_digest}
+        tmp = path.with_name(f"{path.stem}.tmp{os.getpid()}.npz")
+        np.savez(tmp, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp, path)
+
+    def _load(self, path: Path, digest: str) -> np.ndarray:
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["input_digest"] != digest or meta["params"] != asdict(self.params):
+                raise ValueError("transform cache mismatch")
+            for name in ("mean_", "scale_", "components_", "pca_mean_"):
+                setattr(self, name, data[name] if name in data.files else None)
+            reduced = data["reduced"]
+        self.input_digest = digest
+        return reduced
+
+    def save(self, path: Path) -> None:
+        """保存已拟合的组件 (不含输出), 供 serving 等场景加载."""
+        if not self.fitted:
+            raise RuntimeError("TransformPipeline is not fitted.")
+        self._save(Path(path), np.empty((0, 0)))
+
+    @classmethod
+    def load(cls, path: Path) -> "TransformPipeline":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+        pipe = cls(TransformParams(**meta["params"]), cache_dir=None)
+        pipe._load(Path(path), meta["input_digest"])
+        return pipe
@@ -8,21 +8,41 @@ Created: 2025-11-10
 """
 
 
+from __future__ import annotations
+
 import re
+import functools
 from pathlib import Path
 from collections import defaultdict
-from typing import Iterable, Literal, Union, Optional
+from typing import TYPE_CHECKING, Iterable, Literal, Union, Optional
 import gc
 import numpy as np
-from tqdm import tqdm
-from sklearn.model_selection import KFold
-from sklearn.linear_model import Ridge, RidgeCV
-import torch
-from torch import nn
-import torch.nn.functional as F
-from torch.utils.data import DataLoader
-from transformers import BatchEncoding, PreTrainedTokenizer
-import nibabel as nib
+
+from src.dedup import Dedup, array_key, tokens_key
+
+# torch / transformers / sklearn / tqdm / nibabel 均在函数内部按需导入,
+# 使只用到 corr_with_np / extract_hemi_data_from_files 的分析脚本无需加载深度学习依赖.
+if TYPE_CHECKING:
+    import torch
+    from torch import nn
+    from sklearn.model_selection import KFold
+    from sklearn.linear_model import Ridge, RidgeCV
+    from transformers import BatchEncoding, PreTrainedTokenizer
+
+    from src.extract_checkpoint import ExtractionCheckpoint
+
+
+def _inference_mode(fn):
+    """与 @torch.inference_mode() 等价, 但在首次调用时才导入 torch."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        import torch
+
+        with torch.inference_mode():
+            return fn(*args, **kwargs)
+
+    return wrapper
 
 
 def get_tokenizer_valid_len(tokenizer: PreTrainedTokenizer
@@ -58,14 +78,15 @@ def get_tokenizer_valid_len(tokenizer: PreTrainedTokenizer
     return max_len - len(cls_ids) - len(eos_ids), (cls_ids, eos_ids)
 
 
-@torch.inference_mode()
+@_inference_mode
 def extract_text_features(tokens: list[list[str]], tokenizer: PreTrainedTokenizer,
                           model: nn.Module, layers: Union[int, Iterable[int]],
                           device: Union[str, int, torch.device], batch_size: int = 1,
-                          autocast: bool = False, pooling: Literal['mean', 'last'] = 'last'
-                          ) -> dict[int, np.ndarray]:
+                          autocast: bool = False, pooling: Literal['mean', 'last'] = 'last',
+                          checkpoint: Optional[ExtractionCheckpoint] = None,
+                          verbose: bool = True) -> dict[int, np.ndarray]:
     """
-    使用预训练语言模型提取文本特征.
+    使用预训练语言模型提取文本特征. 相同的上下文只前向一次 (见 dedup.py).
 
     Parameters
     ----------
@@ -77,12 +98,18 @@ def extract_text_features(tokens: list[list[str]], tokenizer: PreTrainedTokenize
         batch_size : 批量大小
         autocast : 是否使用混合精度推理 (仅在GPU上有效, 默认False)
         pooling : 池化方法, 'mean'表示平均池化, 'last'表示取最后一个token的特征 (对于GPT2等自回归模型)
+        checkpoint : 断点续跑 (见 extract_checkpoint.py), 为 None 时全部结果保留在内存中
+        verbose : 是否打印提示与进度条 (serving / 流式预测的小批量调用时关闭)
 
     Returns
     -------
         dict : keys是层索引, values是对应层的文本特征数组 (shape: [num_texts, feature_dim])
     """
 
+    import torch
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token or tokenizer.sep_token
     if tokenizer.pad_token is None:
@@ -96,7 +123,12 @@ def extract_text_features(tokens: list[list[str]], tokenizer: PreTrainedTokenize
                          truncation=True,
                          return_tensors='pt')
     
-    dataloader = DataLoader(tokens, batch_size=batch_size,
+    # 只对唯一的上下文前向 (分词为空的词会重复上一个上下文), 最后按下标散回
+    dedup = Dedup(tokens_key(t) for t in tokens)
+    unique_tokens = [tokens[i] for i in dedup.unique]
+    n_batches = (len(unique_tokens) + batch_size - 1) // batch_size
+    start = checkpoint.begin(n_batches, batch_size) if checkpoint is not None else 0
+    dataloader = DataLoader(unique_tokens[start * batch_size:], batch_size=batch_size,
                             collate_fn=collate_fn, shuffle=False)
     
     if isinstance(layers, int):
@@ -106,10 +138,12 @@ def extract_text_features(tokens: list[list[str]], tokenizer: PreTrainedTokenize
     # 提取指定层的特征
     hidden_states = defaultdict(list)
 
-    print('Start extracting text features !!!')
+    if verbose:
+        print('Start extracting text features !!!')
+        print(f'[dedup] text: {dedup.summary()}', flush=True)
     # 遍历数据集, 提取特征
     # tqdm显示进度条
-    for ii, batch in tqdm(enumerate(dataloader), total=len(dataloader)):
+    for ii, batch in tqdm(enumerate(dataloader, start=start), total=n_batches, initial=start, disable=not verbose):
         batch = batch.to(device)
 
         # 使用 autocast 进行混合精度推理 (对于Llama等较大的模型, autocast可以显著节省显存)
@@ -137,18 +171,22 @@ def extract_text_features(tokens: list[list[str]], tokenizer: PreTrainedTokenize
             del pooling_state
         
         del outputs, batch, layer_state
+        if checkpoint is not None:
+            checkpoint.step(ii, hidden_states)
         if (ii + 1) % 50 == 0:
             # 释放显存 (可选)
             gc.collect()
             torch.cuda.empty_cache()
     
+    if checkpoint is not None:
+        return dedup.scatter(checkpoint.finalize(hidden_states))
     # 拼接所有batch的特征
     layer_features = {l: np.concatenate(states, 0) for l, states in hidden_states.items()}
-    return layer_features
+    return dedup.scatter(layer_features)
 
 
-@torch.inference_mode()
-def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks张量 [n_chunks, chunk_len]
+@_inference_mode
+def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks [n_chunks, chunk_len], 张量或 AudioChunks
                            processor,                    # 音频处理器（如Wav2Vec2Processor）
                            model: torch.nn.Module,       # 音频模型（如Wav2Vec2Model）
                            layers: Union[int, Iterable[int], list[int]],
@@ -156,13 +194,16 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
                            batch_size: int = 32,
                            autocast: bool = False,
                            pooling: Literal['mean', 'last'] = 'mean',
-                           sampling_rate: int = 16000) -> dict[int, np.ndarray]:
+                           sampling_rate: int = 16000,
+                           checkpoint: Optional[ExtractionCheckpoint] = None,
+                           verbose: bool = True) -> dict[int, np.ndarray]:
     """
-    使用预训练音频模型提取音频chunks的特征
+    使用预训练音频模型提取音频chunks的特征, 内容相同的chunk只前向一次 (见 dedup.py)
     
     Parameters
     ----------
-        audio_chunks : 音频chunks张量, shape (n_chunks, chunk_len)
+        audio_chunks : 音频chunks, shape (n_chunks, chunk_len); torch 张量 (chunk_audio)
+                       或按 batch 取零拷贝视图的 AudioChunks (lazy_chunk_audio)
         processor : 音频处理器（负责标准化、分词化）
         model : 预训练音频模型
         layers : 要提取的层索引（单个整数或列表）
@@ -170,12 +211,17 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
         batch_size : 批次大小
         autocast : 是否使用混合精度
         pooling : 池化方式 - 'mean'平均池化, 'last'取最后一个时间步
+        checkpoint : 断点续跑 (见 extract_checkpoint.py), 为 None 时全部结果保留在内存中
+        verbose : 是否打印提示与进度条
         
     Returns
     -------
         dict : 层索引 -> 特征数组 [n_chunks, feature_dim]
     """
-    
+    import torch
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+
     is_whisper = getattr(getattr(model, "config", None), "model_type", "") == "whisper"
 
     # 1. 定义内部collate函数
@@ -183,8 +229,8 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
 
     def collate_audio_fn(batch: list[torch.Tensor]) -> dict:
         """将一批音频chunk转换为模型输入格式"""
-        # 转换为numpy数组并确保为float32
-        audio_arrays = [chunk.numpy().astype(np.float32) for chunk in batch]
+        # 转换为numpy数组并确保为float32 (已是 float32 时不复制)
+        audio_arrays = [np.asarray(chunk, dtype=np.float32) for chunk in batch]
         
         # 使用音频处理器处理
         if is_whisper:
@@ -218,11 +264,16 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
             )
         return inputs
     
+    # 去重 (左侧补齐的 chunk 与第一个 chunk 相同), 只对唯一的 chunk 前向, 最后按下标散回
+    dedup = Dedup(array_key(audio_chunks[i]) for i in range(int(audio_chunks.shape[0])))
+
     # 2. 创建DataLoader
+    n_batches = (dedup.n_unique + batch_size - 1) // batch_size
+    start = checkpoint.begin(n_batches, batch_size) if checkpoint is not None else 0
     dataloader = DataLoader(
-        audio_chunks,                     # 你的audio_chunks张量
+        dedup.unique[start * batch_size:].tolist(),  # 唯一 chunk 的下标 (续跑时跳过已完成的 batch)
         batch_size=batch_size,
-        collate_fn=collate_audio_fn,      # 使用内部collate函数
+        collate_fn=lambda idx: collate_audio_fn([audio_chunks[i] for i in idx]),  # 使用内部collate函数
         shuffle=False
     )
     
@@ -234,7 +285,9 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
     model = model.eval().to(device)
     hidden_states = defaultdict(list)     # 存储各层特征
     
-    print('开始提取音频特征...')
+    if verbose:
+        print('开始提取音频特征...')
+        print(f'[dedup] audio: {dedup.summary()}', flush=True)
     
     def pick_hidden_states(outputs) -> tuple:
         for attr in ("hidden_states", "encoder_hidden_states", "audio_hidden_states"):
@@ -250,7 +303,7 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
         raise ValueError("Model outputs do not contain hidden states.")
 
     # 5. 逐批次提取特征
-    for ii, batch in tqdm(enumerate(dataloader), total=len(dataloader)):
+    for ii, batch in tqdm(enumerate(dataloader, start=start), total=n_batches, initial=start, disable=not verbose):
         # 移动数据到设备
         batch = {k: v.to(device) for k, v in batch.items()}
         
@@ -300,19 +353,23 @@ def extract_audio_features(audio_chunks: torch.Tensor,  # 输入：音频chunks
             # 存储到CPU
             hidden_states[layer_idx].append(pooling_state.cpu().float().numpy())
         
+        if checkpoint is not None:
+            checkpoint.step(ii, hidden_states)
         # 7. 定期清理显存（可选）
         if (ii + 1) % 50 == 0:
             gc.collect()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
     
+    if checkpoint is not None:
+        return dedup.scatter(checkpoint.finalize(hidden_states))
     # 8. 合并所有批次的特征
     layer_features = {
         layer_idx: np.concatenate(states, axis=0) 
         for layer_idx, states in hidden_states.items()
     }
     
-    return layer_features
+    return dedup.scatter(layer_features)
 
 def concat_feature(features: np.ndarray, window: int, offset: int = 2) -> np.ndarray:
     """
@@ -329,6 +386,9 @@ def concat_feature(features: np.ndarray, window: int, offset: int = 2) -> np.nda
         concatenated_features : 拼接后的特征, shape (T, window, D)
     """
 
+    import torch
+    import torch.nn.functional as F
+
     if features.ndim != 2:
         raise ValueError("features should be a 2D array with shape (T, D).")
 
@@ -381,57 +441,61 @@ def corr_with_np(a: np.ndarray, b: np.ndarray) -> np.ndarray:
         corrs : pearson corr, 对于常数列返回nan, shape (n_features,)
     """
 
+    from src.corr_kernel import batched_corr
+
     if a.shape != b.shape:
         raise ValueError("Shapes of a and b must be the same.")
-    a_norm = a - a.mean(axis=0)
-    b_norm = b - b.mean(axis=0)
-    std_a, std_b = a.std(0), b.std(0)
-
-    # 计算pearson相关系数, 对于常数列返回nan
-    corrs = np.full(a.shape[1], np.nan)
-    valid = (std_a != 0) & (std_b != 0)
-    corrs[valid] = np.mean(
-        a_norm[:, valid] * b_norm[:, valid], 0
-        ) / (std_a[valid] * std_b[valid])
-    
-    return corrs
-    
+    # 批量 corr 核 (src/corr_kernel.py) 的单批次 float64 情形
+    return batched_corr(a, b, dtype=np.float64)
+
 
 def fit_encoding_cv(X: np.ndarray, y: np.ndarray, cv_splitter: KFold,
                     excluded_start: int = 5, excluded_end: int = 5,
-                    alphas: Iterable[float] = [10000., 100000., 1000000.]
+                    alphas: Iterable[float] = [10000., 100000., 1000000.],
+                    return_pred: bool = False
                     ) -> tuple[Union[Ridge, RidgeCV], np.ndarray]:
     """
     使用岭回归进行5折交叉验证, 并在测试集上评估性能.
 
     Parameters
     ----------
-        X : 特征矩阵, shape (n_samples, n_features)
+        X : 特征矩阵, shape (n_samples, n_features); 或隐式 FIR 设计 LaggedDesign
         y : 目标变量矩阵, shape (n_samples, n_targets)
         excluded_start : 排除开头的样本数 (默认5)
         excluded_end : 排除结尾的样本数 (默认5)
         cv_splitter : 划分数据集的splitter
         alphas : 岭回归的正则化参数列表 (默认[10000., 100000., 1000000.])
+        return_pred : 是否同时返回各折测试集的预测
 
     Returns
     -------
         model : 训练好的岭回归模型
         corrs : 交叉验证测试集的平均corr, shape (n_targets,)
+        y_pred : (return_pred 时) 各折测试集预测按折顺序拼接, shape (n_test_total, n_targets)
     """
 
+    from sklearn.linear_model import RidgeCV
+    from src.lagged_design import LaggedDesign, ridge_cv
+
     X, y = X[excluded_start: -excluded_end], y[excluded_start: -excluded_end]
     z_corrs = []
-
-    for i, (train_idx, test_idx) in enumerate(cv_splitter.split(X)):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-
-        # model = Ridge(alpha=1000.)
-        model = RidgeCV(alphas=alphas, cv=5)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
+    preds = []
+
+    for i, (train_idx, test_idx) in enumerate(cv_splitter.split(np.arange(X.shape[0]))):
+        y_test = y[test_idx]
+        if isinstance(X, LaggedDesign):
+            # 隐式 FIR 设计: 由错位 Gram 块求解, 不生成稠密设计矩阵
+            model = ridge_cv(X, y, train_idx, alphas, inner_folds=5)
+            y_pred = model.predict(X, test_idx)
+        else:
+            # model = Ridge(alpha=1000.)
+            model = RidgeCV(alphas=alphas, cv=5)
+            model.fit(X[train_idx], y[train_idx])
+            y_pred = model.predict(X[test_idx])
         
         corr = corr_with_np(y_pred, y_test)
+        if return_pred:
+            preds.append(y_pred)
 
         # Fisher z-transform: 使样本相关系数更接近正态分布
         # ref: https://en.wikipedia.org/wiki/Fisher_transformation
@@ -439,6 +503,8 @@ def fit_encoding_cv(X: np.ndarray, y: np.ndarray, cv_splitter: KFold,
         z_corrs.append(z_corr)
     
     corrs = np.tanh(np.mean(z_corrs, 0))
+    if return_pred:
+        return model, corrs, np.concatenate(preds, axis=0)
     
     return model, corrs
 
@@ -446,23 +512,34 @@ def fit_encoding_cv(X: np.ndarray, y: np.ndarray, cv_splitter: KFold,
 def fit_encoding_single(X: np.ndarray, y: np.ndarray,
                         excluded_start: int = 5, excluded_end: int = 5,
                         alpha: float = 10000.0,
-                        test_ratio: float = 0.2
+                        test_ratio: float = 0.2,
+                        return_pred: bool = False
                         ) -> tuple[Ridge, np.ndarray]:
     """
     单次划分训练/测试，避免K折交叉验证带来的开销.
+    X 也可以是 src.lagged_design.LaggedDesign (隐式 FIR 设计), 此时返回 GramRidge.
+    return_pred 时额外返回测试集预测 (model, corrs, y_pred).
     """
+    from sklearn.linear_model import Ridge
+    from src.lagged_design import LaggedDesign, ridge_single
+
     X, y = X[excluded_start: -excluded_end], y[excluded_start: -excluded_end]
     n = X.shape[0]
     split = int(n * (1 - test_ratio))
     if split <= 0 or split >= n:
         raise ValueError("Invalid test_ratio for current sample size.")
-    X_train, y_train = X[:split], y[:split]
-    X_test, y_test = X[split:], y[split:]
+    y_train, y_test = y[:split], y[split:]
 
-    model = Ridge(alpha=alpha)
-    model.fit(X_train, y_train)
-    y_pred = model.predict(X_test)
+    if isinstance(X, LaggedDesign):
+        model = ridge_single(X, y, np.arange(split), alpha)
+        y_pred = model.predict(X, np.arange(split, n))
+    else:
+        model = Ridge(alpha=alpha)
+        model.fit(X[:split], y_train)
+        y_pred = model.predict(X[split:])
     corrs = corr_with_np(y_pred, y_test)
+    if return_pred:
+        return model, corrs, y_pred
     return model, corrs
 
 
@@ -486,6 +563,8 @@ def extract_hemi_data_from_files(surf_files: list[Path],
         whole_brain_signals : 拼接后的全脑数据, shape (n_vertices,) or list of ndarray
     """
 
+    import nibabel as nib
+
     if len(surf_files) != 2:
         raise ValueError("Expect exactly two surface files (L & R hemisphere)!!")
     
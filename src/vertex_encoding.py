@@ -0,0 +1,154 @@
+"""
+vertex_encoding.py
+
+顶点级 (fsaverage6, 约 81k 个目标) 编码模型. 目标列按块流式读取:
+设计矩阵的 Gram / 特征分解 / Cholesky 因子与目标无关, 每个外层划分只计算一次, 被试与目标块共用;
+每个块只需计算 Xᵀy、求解、预测与相关, 结果直接写入 memmap 输出 (n_subjects, n_targets).
+峰值内存由 block_size 决定, 与目标总数无关.
+
+划分方式与 alpha 选择规则与 run_cv_multi_subjects 一致 (kfold <= 1: 前 80% 训练 + alphas[0];
+否则不打乱的 KFold + RidgeCV(cv=5) 规则, alpha 由全部目标的平均 R² 选出, 因此每个外层折需两遍扫描目标).
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from src.corr_kernel import batched_corr
+from src.lagged_design import (
+    CenteredSystem,
+    GramRidge,
+    LaggedDesign,
+    SplitGrams,
+    cholesky_factor,
+    outer_splits,
+    r2_score_columns,
+    split_grams,
+)
+from src.tracing import trace
+
+DEFAULT_BLOCK_SIZE = 4096
+
+
+class _PreparedSplit:
+    """一个外层划分上与目标无关的量: Gram、内层各折特征分解、各 alpha 的 Cholesky 因子."""
+
+    def __init__(self, design: LaggedDesign, train: np.ndarray, test: np.ndarray, inner_folds: int | None):
+        self.design = design
+        self.train = train
+        self.test = test
+        self.grams: SplitGrams = split_grams(design, train, inner_folds)
+        self._inner_eigs: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self._factors: dict[float, np.ndarray] = {}
+        x_mean = self.grams.s / train.shape[0]
+        self.gram_c = self.grams.G - train.shape[0] * np.outer(x_mean, x_mean)
+
+    def inner_eig(self, fold: int, system: CenteredSystem) -> tuple[np.ndarray, np.ndarray]:
+        if fold not in self._inner_eigs:
+            self._inner_eigs[fold] = system.eigh()
+        return self._inner_eigs[fold]
+
+    def factor(self, alpha: float) -> np.ndarray:
+        if alpha not in self._factors:
+            self._factors[alpha] = cholesky_factor(self.gram_c, alpha)
+        return self._factors[alpha]
+
+
+def _blocks(n_targets: int, block_size: int) -> list[tuple[int, int]]:
+    return [(a, min(a + block_size, n_targets)) for a in range(0, n_targets, block_size)]
+
+
+def _select_alpha(prep: _PreparedSplit, y: np.ndarray, alphas: list[float], block_size: int) -> float:
+    """第一遍: 按块累加内层各折、各 alpha 的 R² 之和 (除以目标数即各目标平均), 返回最优 alpha."""
+    design, train = prep.design, prep.train
+    scores = np.zeros(len(alphas))
+    n = train.shape[0]
+    for a, b in _blocks(y.shape[1], block_size):
+        y_train = np.asarray(y[train, a:b], dtype=np.float64)
+        XtY = design.cross(y_train, train)
+        y_sum = y_train.sum(0)
+        for fold, (inner_val, G_val, s_val) in enumerate(prep.grams.inner):
+            val_rows = train[inner_val]
+            y_val = y_train[inner_val]
+            system = CenteredSystem.build(prep.grams.G - G_val, prep.grams.s - s_val,
+                                          XtY - design.cross(y_val, val_rows),
+                                          y_sum - y_val.sum(0), n - inner_val.shape[0])
+            for k, model in enumerate(system.solve(alphas, eig=prep.inner_eig(fold, system))):
+                scores[k] += r2_score_columns(y_val, model.predict(design, val_rows)).sum()
+    return alphas[int(np.argmax(scores))]
+
+
+def _fit_block(prep: _PreparedSplit, y_block: np.ndarray, alpha: float) -> np.ndarray:
+    """第二遍: 用全部训练行求解一个目标块, 返回测试集 corr."""
+    from scipy.linalg import cho_solve
+
+    design, train, test = prep.design, prep.train, prep.test
+    y_train = y_block[train]
+    system = CenteredSystem.build(prep.grams.G, prep.grams.s, design.cross(y_train, train),
+                                  y_train.sum(0), train.shape[0])
+    coef = cho_solve((prep.factor(alpha), True), system.cross)
+    model = GramRidge(coef_=coef, intercept_=system.y_mean - system.x_mean @ coef, alpha_=alpha)
+    return batched_corr(model.predict(design, test), y_block[test])
+
+
+def run_cv_multi_subjects_chunked(X: np.ndarray | LaggedDesign, fmris: dict, subjects: Iterable[int],
+                                  excluded_start: int, excluded_end: int,
+                                  alphas: Iterable[float], kfold: int, out_path: Path,
+                                  block_size: int = DEFAULT_BLOCK_SIZE) -> tuple[list[float], np.ndarray]:
+    """
+    分块版 run_cv_multi_subjects, 用于目标数很多 (如顶点级) 的情形.
+
+    Parameters
+    ----------
+        X : 设计矩阵 (稠密数组或 LaggedDesign)
+        fmris : {subject: (T, n_targets)}, 建议为 memmap (见 data.load_fmri_vertices)
+        out_path : 输出 .npy, shape (n_subjects, n_targets) float32, 行顺序与 subjects 相同
+        block_size : 每次读入的目标列数
+
+    Returns
+    -------
+        corr_means : 每个被试 corr map 的均值 (忽略 nan, 如 medial wall 上的常数时间序列)
+        corr_maps : out_path 的只读 memmap
+    """
+    subjects = list(subjects)
+    alphas = list(alphas)
+    design = X if isinstance(X, LaggedDesign) else LaggedDesign(np.asarray(X), [0])
+    design = design[excluded_start:-excluded_end]
+    n_targets = int(fmris[subjects[0]].shape[1])
+
+    preps = [_PreparedSplit(design, train, test, inner_folds=5 if kfold > 1 else None)
+             for train, test in outer_splits(len(design), kfold)]
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f"{out_path.stem}.tmp{os.getpid()}.npy")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(subjects), n_targets))
+
+    corr_means: list[float] = []
+    for si, sub in enumerate(subjects):
+        with trace("fit", subject=sub, block_size=block_size) as span:
+            y = fmris[sub]
+            y = y[excluded_start:y.shape[0] - excluded_end]
+            span.array("y", y)
+            z_sum = np.zeros(n_targets) if len(preps) > 1 else None
+            for prep in preps:
+                alpha = _select_alpha(prep, y, alphas, block_size) if prep.grams.inner else alphas[0]
+                for a, b in _blocks(n_targets, block_size):
+                    corr = _fit_block(prep, np.asarray(y[:, a:b], dtype=np.float64), alpha)
+                    if z_sum is None:
+                        out[si, a:b] = corr
+                    else:
+                        # 多折时与 fit_encoding_cv 相同: Fisher z 平均
+                        z_sum[a:b] += np.arctanh(corr)
+            if z_sum is not None:
+                out[si] = np.tanh(z_sum / len(preps))
+        corr_means.append(float(np.nanmean(out[si])))
+        print(f"[vertex] subject {sub}: mean corr={corr_means[-1]:.4f}", flush=True)
+
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    return corr_means, np.load(out_path, mmap_mode="r")
@@ -4,31 +4,29 @@ from pathlib import Path
 from typing import Tuple
 
 import numpy as np
-import nibabel as nib
+
+from src.atlas_cache import load_atlas_bundle, surf_path
+from src.surface_raster import FIG_DPI, FIG_SIZE, PANELS, load_template, text_bitmap
+
+_WORKER: dict = {}
 
 
 def _load_surf(atlas_root: Path, hemi: str, kind: str = "inflated") -> Tuple[np.ndarray, np.ndarray]:
-    surf = atlas_root / "atlases" / "fsaverage" / f"tpl-fsaverage_den-41k_hemi-{hemi}_{kind}.surf.gii"
-    if not surf.exists():
-        raise FileNotFoundError(f"Missing surface: {surf}")
-    gii = nib.load(surf)
-    coords = np.asarray(gii.darrays[0].data)
-    faces = np.asarray(gii.darrays[1].data)
+    if kind != "inflated":
+        raise ValueError(f"Only inflated surfaces are cached, got kind={kind}")
+    bundle = load_atlas_bundle(atlas_root)
+    coords, faces = bundle.coords[hemi], bundle.faces[hemi]
+    if coords is None or faces is None:
+        raise FileNotFoundError(f"Missing surface: {surf_path(atlas_root, hemi, kind)}")
     return coords, faces
 
 
 def _load_sulc(atlas_root: Path, hemi: str) -> np.ndarray | None:
-    sulc = atlas_root / "atlases" / "fsaverage" / f"tpl-fsaverage_den-41k_hemi-{hemi}_desc-sulc_midthickness.shape.gii"
-    if not sulc.exists():
-        return None
-    return np.asarray(nib.load(sulc).agg_data())
+    return load_atlas_bundle(atlas_root).sulc[hemi]
 
 
 def _load_mmp_labels(atlas_root: Path, hemi: str) -> np.ndarray:
-    label = atlas_root / f"tpl-fsaverage6_hemi-{hemi}_desc-MMP_dseg.label.gii"
-    if not label.exists():
-        raise FileNotFoundError(f"Missing label GIFTI: {label}")
-    return np.asarray(nib.load(label).agg_data()).astype(int)
+    return load_atlas_bundle(atlas_root).labels[hemi]
 
 
 def _roi_to_vertex_values(corr_map: np.ndarray, labels: np.ndarray, hemi: str) -> np.ndarray:
@@ -38,19 +36,47 @@ def _roi_to_vertex_values(corr_map: np.ndarray, labels: np.ndarray, hemi: str) -
       - len==180: each hemi independently
     labels: 0..180 (0=medialwall)
     """
-    if corr_map.ndim != 1:
-        corr_map = corr_map.reshape(-1)
+    corr = _hemi_roi_values(corr_map, hemi)
+
+    # 查表代替逐 ROI 的 labels == roi 掩码循环: lut[0] 为 medial wall
+    lut = np.concatenate([[np.nan], np.asarray(corr, dtype=np.float32)]).astype(np.float32)
+    return lut[np.asarray(labels)]
+
+
+def _hemi_roi_values(corr_map: np.ndarray, hemi: str) -> np.ndarray:
+    corr_map = np.asarray(corr_map).reshape(-1)
     if corr_map.shape[0] == 360:
-        corr = corr_map[:180] if hemi == "L" else corr_map[180:]
-    elif corr_map.shape[0] == 180:
-        corr = corr_map
-    else:
-        raise ValueError(f"Unsupported corr_map length={corr_map.shape[0]} for ROI plotting.")
+        return corr_map[:180] if hemi == "L" else corr_map[180:]
+    if corr_map.shape[0] == 180:
+        return corr_map
+    raise ValueError(f"Unsupported corr_map length={corr_map.shape[0]} for ROI plotting.")
+
 
-    out = np.full(labels.shape[0], np.nan, dtype=np.float32)
-    for roi in range(1, 181):
-        out[labels == roi] = float(corr[roi - 1])
-    return out
+def _is_vertex_map(bundle, corr_map: np.ndarray) -> bool:
+    """顶点级 corr map: 长度等于全脑顶点数 (L 在前, 与 bundle.rois 的顺序一致)."""
+    return np.asarray(corr_map).reshape(-1).shape[0] == bundle.rois.shape[0]
+
+
+def _hemi_vertex_values(bundle, corr_map: np.ndarray, hemi: str) -> np.ndarray:
+    """顶点级 corr map -> 该半球的顶点值, medial wall (标签 0) 为 nan."""
+    corr_map = np.asarray(corr_map).reshape(-1)
+    n_left = bundle.labels["L"].shape[0]
+    values = corr_map[:n_left] if hemi == "L" else corr_map[n_left:]
+    values = np.asarray(values, dtype=np.float32).copy()
+    values[np.asarray(bundle.labels[hemi]) == 0] = np.nan
+    return values
+
+
+def _color_limits(data_L: np.ndarray, data_R: np.ndarray) -> tuple[float, float]:
+    finite = np.concatenate([data_L[np.isfinite(data_L)], data_R[np.isfinite(data_R)]])
+    if finite.size == 0:
+        return 0.0, 1.0
+    vmax = float(np.nanpercentile(finite, 99))
+    vmin = float(np.nanpercentile(finite, 1))
+    if vmax <= vmin:
+        vmax = float(np.nanmax(finite))
+        vmin = float(np.nanmin(finite))
+    return vmin, vmax
 
 
 def _project_front(coords: np.ndarray, hemi: str, view: str) -> tuple[np.ndarray, np.ndarray]:
@@ -73,39 +99,148 @@ def _project_front(coords: np.ndarray, hemi: str, view: str) -> tuple[np.ndarray
     return x2d, y2d
 
 
-def save_corr_map(corr_map: np.ndarray, atlas_root: Path, out_file: Path) -> None:
+def save_corr_map(corr_map: np.ndarray, atlas_root: Path, out_file: Path,
+                  renderer: str = "raster") -> None:
     """
     Render a cortical map to PNG using only matplotlib (no VTK/brainspace).
     Designed for ROI-level corr maps (HCP-MMP 360), with clear lateral/medial views.
+    Vertex-level maps (one value per fsaverage6 vertex, L then R) are drawn directly.
+
+    renderer="raster" uses the cached pixel->ROI templates from src.surface_raster
+    (a colormap lookup per map); renderer="tripcolor" draws the triangulated surface
+    with gouraud shading as before.
     """
-    import matplotlib
+    out_file = Path(out_file)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
 
-    matplotlib.use("Agg")
-    import matplotlib.pyplot as plt
-    import matplotlib.tri as mtri
+    # 所有图共享同一个 (mmap) 图谱缓存, 不再为每张图重新解析 GIFTI
+    bundle = load_atlas_bundle(atlas_root)
+    data = _vertex_data(bundle, corr_map)
+    vmin, vmax = _color_limits(data["L"], data["R"])
+
+    if renderer == "raster":
+        _render_raster(bundle, corr_map, vmin, vmax, out_file)
+    elif renderer == "tripcolor":
+        _render_tripcolor(atlas_root, bundle, data, vmin, vmax, out_file)
+    else:
+        raise ValueError(f"Unknown renderer: {renderer}")
+
+
+def _vertex_data(bundle, corr_map: np.ndarray) -> dict[str, np.ndarray]:
+    if _is_vertex_map(bundle, corr_map):
+        return {hemi: _hemi_vertex_values(bundle, corr_map, hemi) for hemi in ("L", "R")}
+    return {hemi: _roi_to_vertex_values(corr_map, bundle.labels[hemi], hemi) for hemi in ("L", "R")}
+
+
+def _render_raster(bundle, corr_map: np.ndarray, vmin: float, vmax: float, out_file: Path) -> None:
+    save_png(render_corr_image(bundle, corr_map, vmin, vmax), out_file)
+
+
+def render_corr_image(bundle, corr_map: np.ndarray, vmin: float, vmax: float,
+                      template=None) -> np.ndarray:
+    """用栅格模板把 corr map (ROI 级或顶点级) 渲染为 (H, W, 3) uint8 图像 (不落盘)."""
+    template = template or load_template(bundle)
+    if _is_vertex_map(bundle, corr_map):
+        values = {hemi: _hemi_vertex_values(bundle, corr_map, hemi) for hemi in ("L", "R")}
+        return template.render(values, vmin, vmax, vertex=True)
+    values = {hemi: _hemi_roi_values(corr_map, hemi) for hemi in ("L", "R")}
+    return template.render(values, vmin, vmax)
 
+
+def save_png(img: np.ndarray, out_file: Path) -> None:
+    from PIL import Image
+
+    # 低压缩等级: PNG 编码是栅格渲染路径中最耗时的一步
+    Image.fromarray(img).save(Path(out_file).as_posix(), format="PNG", compress_level=1)
+
+
+def _init_render_worker(atlas_root: Path) -> None:
+    # 每个 worker 只加载一次图谱缓存与栅格模板
+    bundle = load_atlas_bundle(atlas_root)
+    _WORKER["bundle"] = bundle
+    _WORKER["template"] = load_template(bundle)
+
+
+def _render_job(job: tuple[np.ndarray, Path, bool]) -> np.ndarray | None:
+    corr_map, out_file, keep_image = job
+    bundle, template = _WORKER["bundle"], _WORKER["template"]
+    data = _vertex_data(bundle, corr_map)
+    vmin, vmax = _color_limits(data["L"], data["R"])
+    img = render_corr_image(bundle, corr_map, vmin, vmax, template=template)
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    save_png(img, out_file)
+    return img if keep_image else None
+
+
+def save_corr_maps(corr_maps: list[np.ndarray], atlas_root: Path, out_files: list[Path],
+                   workers: int | None = None, keep_images: list[bool] | None = None) -> list[np.ndarray | None]:
+    """
+    批量渲染 corr map (栅格渲染器), 与逐个调用 save_corr_map 的输出相同.
+
+    Parameters
+    ----------
+        corr_maps : corr map 列表
+        out_files : 与 corr_maps 等长的输出 PNG 路径
+        workers : 进程数, 默认 os.cpu_count(); <=1 时在当前进程内渲染
+        keep_images : 为 True 的位置返回渲染后的 (H, W, 3) uint8 图像 (供拼图使用), 其余返回 None
+
+    Returns
+    -------
+        images : 与 corr_maps 等长的列表
+    """
+    import os
+
+    if len(corr_maps) != len(out_files):
+        raise ValueError("Number of corr maps and output files must match.")
+    keep_images = keep_images or [False] * len(corr_maps)
+    jobs = [(np.asarray(c), Path(o), bool(k)) for c, o, k in zip(corr_maps, out_files, keep_images)]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+
+    # 先在主进程构建 (或读取) 模板, worker 直接读取磁盘缓存, 避免并发重复构建
+    _init_render_worker(atlas_root)
+    if workers <= 1:
+        return [_render_job(job) for job in jobs]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(atlas_root,)) as pool:
+        return list(pool.map(_render_job, jobs))
+
+
+def save_montage(images: list[np.ndarray], titles: list[str], out_file: Path,
+                 fontsize: float = 12.0, pad: int = 24) -> None:
+    """把若干已渲染的图像 (H, W, 3) 上下拼接成一张图, 每张图上方绘制标题."""
+    if not images:
+        return
+    width = max(img.shape[1] for img in images) + 2 * pad
+    rows = []
+    for img, title in zip(images, titles):
+        bitmap = text_bitmap(title, fontsize, FIG_DPI)
+        h, w = bitmap.shape
+        band = np.full((h + pad, width, 3), 255, dtype=np.uint8)
+        c0 = max(0, (width - w) // 2)
+        w = min(w, width - c0)
+        alpha = bitmap[:, :w, None].astype(np.float32) / 255.0
+        band[pad:, c0:c0 + w] = (255.0 * (1.0 - alpha)).astype(np.uint8)
+        rows.append(band)
+
+        body = np.full((img.shape[0] + pad, width, 3), 255, dtype=np.uint8)
+        c0 = (width - img.shape[1]) // 2
+        body[pad // 2:pad // 2 + img.shape[0], c0:c0 + img.shape[1]] = img[..., :3]
+        rows.append(body)
     out_file = Path(out_file)
     out_file.parent.mkdir(parents=True, exist_ok=True)
+    save_png(np.concatenate(rows, axis=0), out_file)
 
-    coords_L, faces_L = _load_surf(atlas_root, "L", kind="inflated")
-    coords_R, faces_R = _load_surf(atlas_root, "R", kind="inflated")
-    sulc_L = _load_sulc(atlas_root, "L")
-    sulc_R = _load_sulc(atlas_root, "R")
-    labels_L = _load_mmp_labels(atlas_root, "L")
-    labels_R = _load_mmp_labels(atlas_root, "R")
 
-    data_L = _roi_to_vertex_values(corr_map, labels_L, "L")
-    data_R = _roi_to_vertex_values(corr_map, labels_R, "R")
+def _render_tripcolor(atlas_root: Path, bundle, data: dict[str, np.ndarray],
+                      vmin: float, vmax: float, out_file: Path) -> None:
+    import matplotlib
 
-    finite = np.concatenate([data_L[np.isfinite(data_L)], data_R[np.isfinite(data_R)]])
-    if finite.size == 0:
-        vmin, vmax = 0.0, 1.0
-    else:
-        vmax = float(np.nanpercentile(finite, 99))
-        vmin = float(np.nanpercentile(finite, 1))
-        if vmax <= vmin:
-            vmax = float(np.nanmax(finite))
-            vmin = float(np.nanmin(finite))
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.tri as mtri
 
     def _plot(ax, coords, faces, sulc, values, hemi: str, view: str, title: str):
         x2d, y2d = _project_front(coords, hemi=hemi, view=view)
@@ -120,19 +255,15 @@ def save_corr_map(corr_map: np.ndarray, atlas_root: Path, out_file: Path) -> Non
         ax.set_title(title, fontsize=10)
         return im
 
-    fig = plt.figure(figsize=(12, 4.6), dpi=220)
+    fig = plt.figure(figsize=FIG_SIZE, dpi=FIG_DPI)
     gs = fig.add_gridspec(2, 2, wspace=0.02, hspace=0.10)
-    ax1 = fig.add_subplot(gs[0, 0])
-    ax2 = fig.add_subplot(gs[0, 1])
-    ax3 = fig.add_subplot(gs[1, 0])
-    ax4 = fig.add_subplot(gs[1, 1])
-
-    im = _plot(ax1, coords_L, faces_L, sulc_L, data_L, hemi="L", view="lateral", title="Left (lateral)")
-    _plot(ax2, coords_L, faces_L, sulc_L, data_L, hemi="L", view="medial", title="Left (medial)")
-    _plot(ax3, coords_R, faces_R, sulc_R, data_R, hemi="R", view="medial", title="Right (medial)")
-    _plot(ax4, coords_R, faces_R, sulc_R, data_R, hemi="R", view="lateral", title="Right (lateral)")
+    axes = [fig.add_subplot(gs[i // 2, i % 2]) for i in range(4)]
+    ims = []
+    for ax, (hemi, view, title) in zip(axes, PANELS):
+        coords, faces = _load_surf(atlas_root, hemi, kind="inflated")
+        ims.append(_plot(ax, coords, faces, bundle.sulc[hemi], data[hemi], hemi=hemi, view=view, title=title))
 
-    cbar = fig.colorbar(im, ax=[ax1, ax2, ax3, ax4], shrink=0.72, pad=0.01)
+    cbar = fig.colorbar(ims[0], ax=axes, shrink=0.72, pad=0.01)
     cbar.set_label("Correlation", fontsize=9)
     fig.savefig(out_file.as_posix(), facecolor="white", bbox_inches="tight")
     plt.close(fig)
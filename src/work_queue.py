@@ -0,0 +1,331 @@
+"""
+work_queue.py
+
+多机协作跑实验网格: 各机器共享同一个 (NFS) 目录, 通过租约文件认领任务, 避免重复计算.
+
+目录结构 (<work_dir>/<grid>/):
+    manifest.json       : 网格中的全部任务 (各 worker 启动时合并写入)
+    <job>.lease         : 租约, 内容为持有者信息; 持有者后台线程定期 touch (heartbeat)
+    <job>.done          : 完成标记, 任务结果落盘之后原子写入
+
+认领用 os.link 创建租约 (在 NFS 上同样是原子的, O_EXCL 在旧 NFS 上不可靠);
+mtime 超过 ttl 的租约视为失效 (持有者崩溃或断网), 其他 worker 先把它原子 rename 走
+(只有一个 worker 能成功), 再重新认领. 失去租约的 worker 会在 heartbeat 时读到其他持有者, 打印警告;
+结果文件本身都是原子替换写入, 重复计算不会产生损坏的结果.
+各机器的时钟需大致同步 (NTP), ttl 应远大于 heartbeat 间隔与时钟误差.
+
+用法:
+    queue = WorkQueue(work_dir, "text", owner=None, ttl=900)
+    for model_name in queue.drain(args.models, key=lambda m: f"{m}/win200"):
+        ...  # 循环体正常结束 (含 continue) 时任务被标记为完成; 抛出异常时释放租约
+
+查看进度: python -m src.work_queue --work-dir results/queue
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_TTL = 900.0
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def job_filename(job: str) -> str:
+    """任务 key -> 文件名 (路径分隔符与特殊字符替换为 _)."""
+    return re.sub(r"[^A-Za-z0-9._=@+-]", "_", job.replace("/", "__"))
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    tmp = path.with_name(f"{path.name}.tmp{os.getpid()}.{uuid.uuid4().hex[:6]}")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class Lease:
+    """一个已认领的任务. heartbeat 线程在持有期间定期刷新租约文件的 mtime."""
+
+    def __init__(self, queue: "WorkQueue", job: str):
+        self.queue = queue
+        self.job = job
+        self.path = queue.lease_path(job)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name=f"lease-{job}", daemon=True)
+        self._thread.start()
+
+    def holder(self) -> str | None:
+        """租约文件中的持有者; 文件不存在或读取失败时为 None."""
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8")).get("owner", "?")
+        except (OSError, ValueError):
+            return None
+
+    def owned(self) -> bool:
+        return self.holder() == self.queue.owner
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.queue.heartbeat):
+            holder = self.holder()
+            if holder is None:
+                # 其他 worker 复查失效租约时会短暂移走再放回 (_break_stale), 下一次 heartbeat 再确认
+                continue
+            if holder != self.queue.owner:
+                self.lost = True
+                print(f"[queue] WARNING lease lost: {self.job} (taken over as stale)", flush=True)
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def _stop_heartbeat(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def complete(self) -> None:
+        """写入完成标记并删除租约."""
+        self._stop_heartbeat()
+        meta = {"owner": self.queue.owner, "finished": time.time(), "lost_lease": self.lost}
+        _write_atomic(self.queue.done_path(self.job), json.dumps(meta))
+        self._remove()
+
+    def release(self) -> None:
+        """放弃任务 (未完成), 其他 worker 可立即重新认领."""
+        self._stop_heartbeat()
+        self._remove()
+
+    def _remove(self) -> None:
+        if self.owned():
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class WorkQueue:
+    """
+    一个实验网格的任务队列.
+
+    Parameters
+    ----------
+        work_dir : 各机器共享的队列根目录
+        grid : 网格名 (text/audio/multimodal/fusion), 对应子目录
+        ttl : 租约失效时间 (秒)
+        heartbeat : 刷新间隔 (秒), 默认 ttl / 10
+    """
+
+    def __init__(self, work_dir: Path, grid: str, owner: str | None = None,
+                 ttl: float = DEFAULT_TTL, heartbeat: float | None = None):
+        self.root = Path(work_dir) / grid
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.grid = grid
+        self.owner = owner or default_owner()
+        self.ttl = float(ttl)
+        self.heartbeat = float(heartbeat) if heartbeat is not None else self.ttl / 10
+
+    def lease_path(self, job: str) -> Path:
+        return self.root / f"{job_filename(job)}.lease"
+
+    def done_path(self, job: str) -> Path:
+        return self.root / f"{job_filename(job)}.done"
+
+    def is_done(self, job: str) -> bool:
+        return self.done_path(job).exists()
+
+    def register(self, jobs: Iterable[str]) -> None:
+        """把任务合并写入 manifest (并发写入时以最后一次为准, 各 worker 的网格相同时没有影响)."""
+        path = self.root / "manifest.json"
+        known: list[str] = []
+        if path.exists():
+            try:
+                known = json.loads(path.read_text(encoding="utf-8"))["jobs"]
+            except (OSError, ValueError, KeyError):
+                known = []
+        merged = list(dict.fromkeys([*known, *jobs]))
+        if merged != known:
+            _write_atomic(path, json.dumps({"grid": self.grid, "jobs": merged}, indent=2))
+
+    def manifest(self) -> list[str]:
+        path = self.root / "manifest.json"
+        if not path.exists():
+            return []
+        return json.loads(path.read_text(encoding="utf-8"))["jobs"]
+
+    def lease_age(self, job: str) -> float | None:
+        """租约距上次 heartbeat 的秒数, 无租约时为 None."""
+        try:
+            return time.time() - self.lease_path(job).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _break_stale(self, job: str) -> bool:
+        path = self.lease_path(job)
+        age = self.lease_age(job)
+        if age is None or age <= self.ttl:
+            return False
+        # rename 是原子的: 多个 worker 同时发现失效时只有一个能移走租约
+        grave = path.with_name(f"{path.name}.stale.{uuid.uuid4().hex[:8]}")
+        try:
+            os.rename(path, grave)
+        except FileNotFoundError:
+            return False
+        # 检查与 rename 之间其他 worker 可能已移走失效租约并认领: 在 grave 中复查, 是新租约则放回
+        try:
+            holder = json.loads(grave.read_text(encoding="utf-8")).get("owner", "?")
+        except (OSError, ValueError):
+            holder = "?"
+        try:
+            age = time.time() - grave.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if age <= self.ttl:
+            try:
+                # link 不覆盖已存在的租约 (rename 会); 放回失败时原持有者会在 heartbeat 时读到新持有者
+                os.link(grave, path)
+            except FileExistsError:
+                pass
+            grave.unlink(missing_ok=True)
+            return False
+        print(f"[queue] recovered stale lease: {job} (holder={holder}, idle {age:.0f}s)", flush=True)
+        grave.unlink(missing_ok=True)
+        return True
+
+    def claim(self, job: str) -> Lease | None:
+        """尝试认领任务; 已完成或被其他 worker 持有 (且未失效) 时返回 None."""
+        if self.is_done(job):
+            return None
+        path = self.lease_path(job)
+        tmp = path.with_name(f"{path.name}.tmp{os.getpid()}.{uuid.uuid4().hex[:6]}")
+        tmp.write_text(json.dumps({"owner": self.owner, "job": job, "claimed": time.time()}), encoding="utf-8")
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, path)
+                except FileExistsError:
+                    if self._break_stale(job):
+                        continue
+                    return None
+                # 认领后再次确认: 其他 worker 可能在我们检查之后刚好写完 done
+                if self.is_done(job):
+                    path.unlink(missing_ok=True)
+                    return None
+                return Lease(self, job)
+            return None
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def drain(self, items: Iterable[T], key: Callable[[T], str]) -> Iterator[T]:
+        """
+        依次认领 items 中的任务并 yield 给调用方.
+        调用方处理完一个任务 (进入下一次迭代) 时标记完成; 循环因异常或 break 退出时释放租约.
+        被其他 worker 持有的任务留在待办中: 每隔 heartbeat 秒重新扫描, 租约被释放或超过 ttl 未刷新
+        (持有者崩溃) 时由 claim 接管; 所有任务都完成后才返回.
+        """
+        items = list(items)
+        jobs = [key(item) for item in items]
+        self.register(jobs)
+        pending = list(range(len(items)))
+        n_waiting = 0
+        while pending:
+            for i in pending:
+                lease = self.claim(jobs[i])
+                if lease is None:
+                    continue
+                print(f"[queue] claimed {self.grid}:{jobs[i]} ({self.owner})", flush=True)
+                try:
+                    yield items[i]
+                except BaseException:
+                    lease.release()
+                    raise
+                lease.complete()
+            pending = [i for i in pending if not self.is_done(jobs[i])]
+            if pending:
+                if len(pending) != n_waiting:
+                    print(f"[queue] {self.grid}: waiting for {len(pending)} job(s) held by other workers", flush=True)
+                n_waiting = len(pending)
+                time.sleep(self.heartbeat)
+
+    def status(self) -> dict[str, int]:
+        counts = {"total": 0, "done": 0, "running": 0, "stale": 0, "pending": 0}
+        for job in self.manifest():
+            counts["total"] += 1
+            age = self.lease_age(job)
+            if self.is_done(job):
+                counts["done"] += 1
+            elif age is None:
+                counts["pending"] += 1
+            elif age > self.ttl:
+                counts["stale"] += 1
+            else:
+                counts["running"] += 1
+        return counts
+
+
+def claim_each(queue: WorkQueue | None, items: Iterable[T], key: Callable[[T], str]) -> Iterator[T]:
+    """queue 为 None (单机运行) 时依次返回全部 items, 否则等价于 queue.drain."""
+    if queue is None:
+        return iter(items)
+    return queue.drain(items, key)
+
+
+def open_queue(work_dir: str | Path | None, grid: str, ttl: float = DEFAULT_TTL) -> WorkQueue | None:
+    return WorkQueue(Path(work_dir), grid, ttl=ttl) if work_dir else None
+
+
+def grid_name(base: str, args: argparse.Namespace) -> str:
+    """按运行模式区分网格: 只提取特征 / 扫描 / 顶点级 / 群体模式 / 闭式 alpha 选择运行的完成标记不影响常规运行."""
+    if getattr(args, "extract_only", False):
+        return f"{base}-extract"
+    if getattr(args, "pca_dims", None):
+        return f"{base}-pca-sweep"
+    if getattr(args, "fir_windows", None) or getattr(args, "fir_offsets", None):
+        return f"{base}-fir-sweep"
+    if getattr(args, "targets", "roi") != "roi":
+        return f"{base}-{args.targets}"
+    if getattr(args, "group_mode", None):
+        return f"{base}-group-{args.group_mode}"
+    if getattr(args, "alpha_select", "nested") != "nested":
+        return f"{base}-alpha-{args.alpha_select}"
+    return base
+
+
+def add_queue_args(parser: argparse.ArgumentParser) -> None:
+    """各 run_* 脚本共用的队列参数."""
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="多机共享的任务队列目录 (如 results/queue); 给出时按租约认领任务, 已完成的任务跳过")
+    parser.add_argument("--lease-ttl", type=float, default=DEFAULT_TTL,
+                        help="租约失效时间 (秒), 超过该时间没有 heartbeat 的任务会被其他 worker 接管")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="查看多机任务队列进度")
+    parser.add_argument("--work-dir", type=str, required=True, help="队列根目录 (各脚本的 --work-dir)")
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL, help="租约失效时间 (秒)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    root = Path(args.work_dir)
+    for grid_dir in sorted(p for p in root.iterdir() if (p / "manifest.json").exists()):
+        queue = WorkQueue(root, grid_dir.name, owner="status", ttl=args.ttl)
+        counts = queue.status()
+        print(f"[queue] {grid_dir.name}: " + " ".join(f"{k}={v}" for k, v in counts.items()), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())